@@ -165,6 +165,10 @@ def init_backends(backend_opts: StimelaBackendOptions, log: logging.Logger):
 
 def close_backends(log: logging.Logger):
     global initialized
+    # shut down the session-wide worker pool (imported here to avoid circular imports)
+    from stimela.worker_pool import shutdown_pool
+
+    shutdown_pool()
     if initialized is not None:
         result = _call_backends(initialized, log, "close", "closing")
         initialized = None
@@ -488,6 +488,9 @@ def run(
             gentle_ctrl_c=True,
             log_command=" ".join(log_args),
             log_result=False,
+            output_overflow=cab.management.output_overflow,
+            output_rate_limit=cab.management.output_rate_limit,
+            output_rate_limit_logfile=cab.management.output_rate_limit_logfile,
         )
 
         # check if output marked it as a fail
@@ -24,11 +24,12 @@ from scabha.substitutions import SubstitutionNS
 import stimela
 import stimela.backends
 import stimela.config
-from stimela import log_exception, logger, stimelogging, task_stats
+from stimela import journal, log_exception, logger, stimelogging, task_stats
 from stimela.config import ConfigExceptionTypes
 from stimela.display.display import display
 from stimela.exceptions import RecipeValidationError, StepSelectionError, StepValidationError, StimelaRuntimeError
-from stimela.kitchen.recipe import Recipe, RecipeSchema, Step
+from stimela.kitchen import recipe_cache
+from stimela.kitchen.recipe import RecipeSchema, Step
 from stimela.kitchen.run_state import graph_to_constraints
 
 
@@ -263,6 +264,28 @@ def load_recipe_files(filenames: List[str]):
     is_flag=True,
     help="""forces execution of steps with a skip_if_outputs: exist property.""",
 )
+@click.option(
+    "--disable-cached-skips",
+    "disable_cached_skips",
+    is_flag=True,
+    help="""forces execution of steps with a skip_if_outputs: cached property.""",
+)
+@click.option(
+    "--resume",
+    "resume",
+    metavar="LOGDIR",
+    help="""resumes a failed or interrupted run, given its log directory. Steps completed by that run (as recorded
+                in its journal) are not run again, but have their outputs restored.""",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    "jobs",
+    metavar="N",
+    type=int,
+    help="""run up to N independent recipe steps concurrently (-1 for unlimited). Equivalent to
+                -C opts.parallel_steps N.""",
+)
 @click.option(
     "-c",
     "--config",
@@ -356,6 +379,9 @@ def run(
     skip_ranges: List[str] = [],
     disable_fresh_skips=False,
     disable_exist_skips=False,
+    disable_cached_skips=False,
+    resume: Optional[str] = None,
+    jobs: Optional[int] = None,
     build=False,
     rebuild=False,
     build_skips=False,
@@ -377,6 +403,10 @@ def run(
         stimela.CONFIG.opts.disable_skips.fresh = True
     if disable_exist_skips:
         stimela.CONFIG.opts.disable_skips.exist = True
+    if disable_cached_skips:
+        stimela.CONFIG.opts.disable_skips.cached = True
+    if jobs is not None:
+        stimela.CONFIG.opts.parallel_steps = jobs
 
     def convert_value(value):
         if value == "=UNSET":
@@ -537,6 +567,7 @@ def run(
         step_logger.propagate = True
         try:
             outer_step.finalize(fqname=cab_name, log=step_logger)
+            outer_step.validate_backend()
             outer_step.prevalidate(root=True, subst=subst)
         except ScabhaBaseException as exc:
             log_exception(exc)
@@ -560,11 +591,9 @@ def run(
 
     # else run a recipe
     else:
-        # create recipe object from the config
-        kwargs = dict(**stimela.CONFIG.lib.recipes[recipe_name])
-        kwargs.setdefault("name", recipe_name)
+        # create recipe object from the config (or load it from the compiled recipe cache)
         try:
-            recipe = Recipe(**kwargs)
+            recipe = recipe_cache.load_recipe(recipe_name, log)
         except Exception as exc:
             traceback.print_exc()
             log_exception(f"error loading recipe '{recipe_name}'", exc)
@@ -596,18 +625,8 @@ def run(
         # split out parameters
         params = {key: value for key, value in params.items() if key in recipe.inputs_outputs}
 
-        stimelogging.declare_chapter("prevalidation")
-        log.info("pre-validating the recipe")
-        outer_step = Step(recipe=recipe, name=f"{recipe_name}", info=recipe_name, params=params)
-        try:
-            params = outer_step.prevalidate(root=True, subst=subst)
-        except Exception as exc:
-            log_exception(RecipeValidationError(f"pre-validation of recipe '{recipe_name}' failed", exc))
-            for line in traceback.format_exc().split("\n"):
-                log.debug(line)
-            sys.exit(1)
-
-        # select recipe substeps based on command line, and exit if nothing to run
+        # select recipe substeps based on command line, and exit if nothing to run. This is done before
+        # prevalidation, so that backend settings only need to be checked for the steps that will actually run
         if not build_skips:
             graph = recipe.to_dag()  # Convert to directed acyclic graph.
 
@@ -627,6 +646,25 @@ def run(
                 log_exception(exc)
                 sys.exit(2)
 
+        stimelogging.declare_chapter("prevalidation")
+        log.info("pre-validating the recipe")
+        outer_step = Step(recipe=recipe, name=f"{recipe_name}", info=recipe_name, params=params)
+        try:
+            outer_step.finalize()
+            outer_step.validate_backend()
+        except Exception as exc:
+            log_exception(RecipeValidationError(f"error validating backend settings of recipe '{recipe_name}'", exc))
+            for line in traceback.format_exc().split("\n"):
+                log.debug(line)
+            sys.exit(1)
+        try:
+            params = outer_step.prevalidate(root=True, subst=subst)
+        except Exception as exc:
+            log_exception(RecipeValidationError(f"pre-validation of recipe '{recipe_name}' failed", exc))
+            for line in traceback.format_exc().split("\n"):
+                log.debug(line)
+            sys.exit(1)
+
         logdir = stimelogging.get_logfile_dir(recipe.log) or "."
         log.info(f"recipe logs will be saved under {logdir}")
 
@@ -634,6 +672,15 @@ def run(
         stimela.config.CONFIG_DEPS.save(filename)
         log.info(f"saved recipe dependencies to {filename}")
 
+        # start journal of completed steps, loading the journal of the resumed run if asked to
+        try:
+            journal.init(logdir, resume=resume)
+        except Exception as exc:
+            log_exception(f"error loading journal of resumed run from {resume}", exc)
+            sys.exit(2)
+        if resume is not None:
+            log.info(f"resuming run from {resume}: {journal.num_resumable()} completed step(s) will be restored")
+
     # in debug mode, pretty-print the recipe
     if log.isEnabledFor(logging.DEBUG):
         log.debug("---------- prevalidated step follows ----------")
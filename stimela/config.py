@@ -51,6 +51,19 @@ class StimelaProfilingOptions(object):
 class StimelaDisableSkipOptions(object):
     fresh: bool = False
     exist: bool = False
+    cached: bool = False
+
+
+@dataclass
+class StimelaCacheOptions(object):
+    dir: str = ".stimela-cache"  # directory for step cache entries (used by skip_if_outputs: cached)
+    max_entries: int = 1000  # max number of entries, least recently used ones are evicted first (0 is unlimited)
+    max_age: float = 30  # entries not used for this many days are evicted (0 is unlimited)
+    hash_contents: bool = True  # fingerprint files by content hash, rather than size and mtime
+    hash_directories: bool = False  # fingerprint files within directories (e.g. MSs) by content hash as well
+    recipes: bool = True  # cache compiled recipes, so that unchanged recipes are reloaded quickly
+    # directory for compiled recipes. Default is stimela/recipes under $XDG_CACHE_HOME (or ~/.cache)
+    recipes_dir: Optional[str] = None
 
 
 @dataclass
@@ -66,6 +79,14 @@ class StimelaOptions(object):
     profile: StimelaProfilingOptions = EmptyClassDefault(StimelaProfilingOptions)
     ## Disables skip_if_outputs checks
     disable_skips: StimelaDisableSkipOptions = EmptyClassDefault(StimelaDisableSkipOptions)
+    ## Step cache options
+    cache: StimelaCacheOptions = EmptyClassDefault(StimelaCacheOptions)
+    ## Default number of independent recipe steps to run concurrently (0 runs steps sequentially, -1 is unlimited).
+    ## Recipes can override this via their 'parallel' setting.
+    parallel_steps: int = 0
+    ## Global budget of worker processes used for scattered for-loops and concurrent steps (0 is unlimited).
+    ## The worker pool is shared by all such loops and steps during a run.
+    max_workers: int = 0
 
 
 def DefaultDirs():
@@ -1,7 +1,9 @@
 from __future__ import annotations
 
 import atexit
-from typing import TYPE_CHECKING, Optional
+import contextlib
+import threading
+from typing import TYPE_CHECKING, Iterator, Optional
 
 from rich.console import Console
 from rich.control import Control
@@ -71,6 +73,8 @@ class Display:
         self.console = console
         self.variant_override = None
         self.current_display = None
+        # set in threads whose updates are ignored (see muted())
+        self._muted = threading.local()
 
         msg = Text("DISPLAY HAS NOT BEEN CONFIGURED", justify="center")
         msg.stylize("bold red")
@@ -80,8 +84,27 @@ class Display:
         # Configure a simple, local display as the default.
         self.set_display_style(variant="simple")
 
+    @contextlib.contextmanager
+    def muted(self) -> Iterator[None]:
+        """Context manager under which updates and style changes from the current thread are ignored.
+
+        This is used by threads running scattered loop iterations, which, like worker processes, have no display
+        of their own.
+        """
+        self._muted.value = True
+        try:
+            yield
+        finally:
+            self._muted.value = False
+
+    @property
+    def is_muted(self):
+        return getattr(self._muted, "value", False)
+
     def reset_current_task(self):
         """Calls the reset method of the current DisplayStyle object."""
+        if self.is_muted:
+            return
         self.current_display.reset()
 
     def enable(self):
@@ -123,6 +146,9 @@ class Display:
                 if variant_override is set on this object. Current options are
                 'simple' and 'fancy'.
         """
+        if self.is_muted:
+            return
+
         # If the variant override has been set, prefer it over the input.
         variant = self.variant_override or variant
 
@@ -154,6 +180,8 @@ class Display:
             report:
                 A Report object containing resource monitoring.
         """
+        if self.is_muted:
+            return
         return self.current_display.update(task_info, report)
 
 
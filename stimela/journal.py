@@ -0,0 +1,94 @@
+import json
+import os
+import os.path
+import time
+from typing import Any, Dict, Optional, Tuple
+
+# name of journal file within the log directory
+JOURNAL_FILENAME = "stimela.journal"
+
+# path to journal file of the current run (None if journalling is disabled)
+_journal_path = None
+# completed steps from the journal of a previous run that is being resumed: task name -> record
+_resumed = {}
+# path to journal being resumed
+_resumed_path = None
+
+
+def init(logdir: str, resume: Optional[str] = None):
+    """Starts a journal in the given log directory, optionally loading the journal of a previous run for resumption.
+
+    Args:
+        logdir (str): log directory of the current run
+        resume (str, optional): log directory (or journal file) of the run being resumed
+
+    Raises:
+        FileNotFoundError: if the journal of the run being resumed doesn't exist
+    """
+    global _journal_path, _resumed, _resumed_path
+    _journal_path = os.path.abspath(os.path.join(logdir, JOURNAL_FILENAME))
+    _resumed, _resumed_path = {}, None
+    if resume is not None:
+        path = os.path.join(resume, JOURNAL_FILENAME) if os.path.isdir(resume) else resume
+        with open(path) as fileobj:
+            for line in fileobj:
+                # a run that was killed may have left a truncated last line
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                _resumed[record["task"]] = record
+        _resumed_path = os.path.abspath(path)
+
+
+def get_state() -> Tuple:
+    """Returns a picklable snapshot of the journal state, for passing to worker processes"""
+    return _journal_path, _resumed, _resumed_path
+
+
+def set_state(state: Tuple):
+    """Re-establishes journal state (as returned by get_state()) in a worker process"""
+    global _journal_path, _resumed, _resumed_path
+    _journal_path, _resumed, _resumed_path = state
+
+
+def num_resumable() -> int:
+    """Returns number of completed steps available for resumption"""
+    return len(_resumed)
+
+
+def lookup(taskname: str) -> Optional[Dict[str, Any]]:
+    """Returns the journal record of a step completed by a previous run, or None if the step wasn't completed"""
+    return _resumed.get(taskname)
+
+
+def record(taskname: str, params: Dict[str, Any], elapsed: Optional[float] = None, restored: bool = False):
+    """Appends a record of a completed step to the journal.
+
+    Args:
+        taskname (str): name of step task (including loop iteration counters, e.g. "recipe.loop.3.step")
+        params (Dict[str, Any]): validated parameters of the step, including outputs. Values that can't be
+            represented in the journal are omitted.
+        elapsed (float, optional): time taken by the step, in seconds
+        restored (bool): True if the step was restored from the journal being resumed
+    """
+    if _journal_path is None:
+        return
+    # no need to record restored steps again, if we're appending to the journal being resumed
+    if restored and _journal_path == _resumed_path:
+        return
+    saved_params = {}
+    for name, value in params.items():
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            continue
+        saved_params[name] = value
+    entry = dict(task=taskname, time=time.time(), elapsed=elapsed, params=saved_params)
+    line = json.dumps(entry) + "\n"
+    # a single append-mode write, since concurrently running steps and loop iterations may be recording too
+    fd = os.open(_journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
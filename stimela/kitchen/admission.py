@@ -0,0 +1,70 @@
+import logging
+from typing import Any, Optional
+
+from stimela.monitoring import local
+
+
+class AdmissionControl(object):
+    """Decides when further iterations of a scattered loop may be started, based on their declared resource
+    requirements (see ForLoopResources), and on live resource usage of the node.
+
+    Declared requirements are checked against the node's capacity: iterations are admitted only while the total
+    declared by the running iterations fits into the node. This guards against iterations that all start up at
+    the same time, and only reach their peak memory use later. Live usage (available memory, load) is checked on
+    top of that, to account for anything else running on the node.
+    """
+
+    def __init__(self, resources: Any, log: logging.Logger):
+        """
+        Args:
+            resources (ForLoopResources): per-iteration resource declarations and thresholds
+            log (logging.Logger): logger for messages
+        """
+        self.resources = resources
+        self.log = log
+        self.poll_interval = resources.poll_interval
+        # set once an iteration has been held back
+        self._held_back = False
+
+    def check(self, num_running: int) -> Optional[str]:
+        """Checks if one more iteration may be started.
+
+        Args:
+            num_running (int): number of iterations currently running
+
+        Returns:
+            Optional[str]: None if an iteration may be started, else the reason for holding it back
+        """
+        res = self.resources
+        node = local.get_node_resources()
+        if res.cores and (num_running + 1) * res.cores > node.n_cpu:
+            return f"{num_running} running iteration(s) use {num_running * res.cores:g} of {node.n_cpu} cores"
+        if res.mem and (num_running + 1) * res.mem > node.mem_total - res.min_free_mem:
+            return (
+                f"{num_running} running iteration(s) use up to {num_running * res.mem:g}GB of "
+                f"{node.mem_total:.1f}GB memory"
+            )
+        if res.mem or res.min_free_mem:
+            if node.mem_available < res.mem + res.min_free_mem:
+                return f"{node.mem_available:.1f}GB memory available, need {res.mem + res.min_free_mem:g}GB"
+        if res.max_load and node.load > res.max_load:
+            return f"load is {node.load:.0f}%, limit is {res.max_load:g}%"
+        return None
+
+    def admit(self, num_running: int) -> bool:
+        """Returns True if one more iteration may be started. If nothing is running, an iteration is always admitted,
+        since nothing would otherwise free up resources.
+
+        Args:
+            num_running (int): number of iterations currently running
+        """
+        reason = self.check(num_running) if num_running else None
+        if reason is None:
+            return True
+        # only report the first occurrence at info level, since this is rechecked every poll_interval
+        if self._held_back:
+            self.log.debug(f"holding back further iterations: {reason}")
+        else:
+            self.log.info(f"holding back further iterations until resources are available: {reason}")
+            self._held_back = True
+        return False
@@ -0,0 +1,150 @@
+import logging
+import string
+from typing import Any, Dict, List, Optional, Tuple
+
+from omegaconf import DictConfig, ListConfig
+from scabha.exceptions import SubstitutionErrorList
+from scabha.substitutions import SubstitutionNS
+from scabha.validate import Unresolved, evaluate_and_substitute
+
+# marks a namespace lookup that found nothing
+_MISSING = object()
+
+# types of values that are safe to compare by value when checking whether the inputs of an assignment have changed
+_SCALAR_TYPES = (str, int, float, bool, type(None))
+
+_formatter = string.Formatter()
+
+
+def is_static(value: Any) -> bool:
+    """Returns True if evaluating the value is a no-op, i.e. it is a plain scalar, or a string without
+    {}-substitutions or formulas
+    """
+    if type(value) is str:
+        return "{" not in value and not value.startswith("=")
+    return not isinstance(value, (dict, list, DictConfig, ListConfig, Unresolved))
+
+
+def substitution_fields(value: str) -> Optional[List[str]]:
+    """Returns list of namespace keys read by a {}-substitution string, or None if these can't be determined (e.g.
+    for formulas, wildcard or positional lookups, or nested format specs)
+    """
+    if value.startswith("="):
+        return None
+    fields = []
+    try:
+        for _, field_name, format_spec, _ in _formatter.parse(value):
+            if field_name is None:
+                continue
+            if not field_name or "*" in field_name or "?" in field_name or (format_spec and "{" in format_spec):
+                return None
+            # index lookups are tracked via the value of the indexed object
+            fields.append(field_name.split("[", 1)[0])
+    except ValueError:
+        return None
+    return fields
+
+
+def _lookup(subst: SubstitutionNS, name: str) -> Any:
+    """Looks up a dotted name in a substitution namespace, without invoking substitutions"""
+    value = subst
+    for comp in name.split("."):
+        if type(value) is not SubstitutionNS:
+            return _MISSING
+        value = dict.get(value, comp, _MISSING)
+        if value is _MISSING:
+            break
+    return value
+
+
+class AssignmentEvaluator(object):
+    """Incrementally evaluates the assignments of a recipe (and its steps).
+
+    Assignments are re-evaluated several times per step (and per loop iteration), but most of them don't change
+    between evaluations. Static values (constants) are passed through without invoking the evaluator at all. For
+    {}-substitution strings, the evaluator records the values of the namespace keys that they read, and reuses the
+    previous result for as long as these stay the same. Formulas, and substitutions whose inputs can't be determined
+    (or are themselves substitutions or containers), are always re-evaluated.
+    """
+
+    def __init__(self):
+        # (owner fqname, name, value) -> (tuple of input types and values, result)
+        self._memo: Dict[Tuple[str, str, str], Tuple[Tuple, Any]] = {}
+
+    def _get_inputs(self, value: str, subst: SubstitutionNS) -> Optional[Tuple]:
+        """Returns current types and values of inputs of a {}-substitution, or None if these can't be tracked. Types
+        are included since equal values of different types (e.g. 1, 1.0 and True) substitute differently.
+        """
+        fields = substitution_fields(value)
+        if fields is None:
+            return None
+        inputs = []
+        for name in fields:
+            input_value = _lookup(subst, name)
+            if input_value is not _MISSING and not (type(input_value) in _SCALAR_TYPES and is_static(input_value)):
+                return None
+            inputs.append((type(input_value), input_value))
+        return tuple(inputs)
+
+    def evaluate(
+        self,
+        owner: Any,
+        assignments: Dict[str, Any],
+        subst: SubstitutionNS,
+        location: List[str] = [],
+        ignore_subst_errors: bool = False,
+        log: Optional[logging.Logger] = None,
+    ) -> Dict[str, Any]:
+        """Evaluates assignments, with the same semantics as evaluate_and_substitute(assignments, subst, subst.recipe)
+
+        Args:
+            owner (Any): recipe or step that the assignments belong to (identified by its fqname)
+            assignments (Dict[str, Any]): assignments to evaluate
+            subst (SubstitutionNS): substitution namespace
+            location (List[str]): location, for error messages
+            ignore_subst_errors (bool): if False, raises an error if any substitutions are unresolved
+            log (logging.Logger, optional): logger for messages
+
+        Returns:
+            Dict[str, Any]: evaluated assignments
+        """
+        results = {}
+        pending = {}
+        tracked = {}
+        for name, value in assignments.items():
+            results[name] = value
+            if is_static(value):
+                continue
+            if type(value) is str:
+                inputs = self._get_inputs(value, subst)
+                if inputs is not None:
+                    key = (owner.fqname, name, value)
+                    memo = self._memo.get(key)
+                    if memo is not None and memo[0] == inputs:
+                        results[name] = subst.recipe[name] = memo[1]
+                        continue
+                    tracked[name] = key, inputs
+            pending[name] = value
+
+        if pending:
+            evaluated = evaluate_and_substitute(
+                pending, subst, subst.recipe, location=location, ignore_subst_errors=True, log=log
+            )
+            for name in pending:
+                # evaluations returning UNSET remove the assignment
+                if name not in evaluated:
+                    del results[name]
+                    continue
+                results[name] = evaluated[name]
+                if name in tracked and type(evaluated[name]) is str:
+                    key, inputs = tracked[name]
+                    self._memo[key] = inputs, evaluated[name]
+
+        if not ignore_subst_errors:
+            errors = []
+            for value in results.values():
+                if type(value) is Unresolved:
+                    errors += value.errors
+            if errors:
+                raise SubstitutionErrorList("unresolved {}-substitutions", errors)
+        return results
@@ -18,6 +18,7 @@ from scabha.substitutions import substitutions_from
 
 from stimela.backends import StimelaBackendSchema, flavours
 from stimela.exceptions import CabValidationError, StimelaBaseImageError, StimelaCabRuntimeError
+from stimela.utils import xrun_asyncio
 
 from . import wranglers
 
@@ -29,6 +30,14 @@ class CabManagement(object):  # defines common cab management behaviours
     environment: Optional[Dict[str, str]] = EmptyDictDefault()
     cleanup: Optional[Dict[str, ListOrString]] = EmptyDictDefault()
     wranglers: Optional[Dict[str, ListOrString]] = EmptyDictDefault()
+    # what to do when output comes in faster than it can be logged: "block" reading it until it's caught up, or "drop"
+    # lines (below WARNING severity), logging a count of them instead
+    output_overflow: str = "block"
+    # max number of lines of output per second shown on the console. Lines beyond this are counted, and summarized
+    # once per second. Lines of WARNING severity and above are always shown
+    output_rate_limit: Optional[int] = None
+    # if set, the rate limit applies to log files too. Otherwise, log files get all output
+    output_rate_limit_logfile: bool = False
 
 
 @dataclass
@@ -141,6 +150,15 @@ class Cab(Cargo):
         for pattern, actions in self.management.wranglers.items():
             self._wranglers.append(wranglers.create_list(pattern, actions))
 
+        if self.management.output_overflow not in xrun_asyncio.OUTPUT_OVERFLOW_POLICIES:
+            raise CabValidationError(
+                f"cab {self.name}: management.output_overflow must be one of "
+                f"{', '.join(xrun_asyncio.OUTPUT_OVERFLOW_POLICIES)}"
+            )
+
+        if self.management.output_rate_limit is not None and self.management.output_rate_limit < 1:
+            raise CabValidationError(f"cab {self.name}: management.output_rate_limit must be at least 1")
+
         # check flavours
         self.flavour = flavours.init_cab_flavour(self)
 
@@ -414,6 +432,7 @@ class Cab(Cargo):
         def __init__(self, cab: "Cab", extra_wranglers: List = []):
             self.cab = cab
             self.wranglers = list(cab._wranglers) + list(extra_wranglers)
+            self._matcher = wranglers.WranglerMatcher(self.wranglers)
             self._success = None
             self._errors = []
             self._warnings = []
@@ -453,11 +472,17 @@ class Cab(Cargo):
             self._outputs.update(**outputs)
 
         def apply_wranglers(self, output, severity):
-            # make sure any unintended [rich style] tags are escaped in output
-            output = rich.markup.escape(output)
+            # make sure any unintended [rich style] tags are escaped in output (escape() only changes lines containing
+            # a "[", or ending with a backslash)
+            if "[" in output or output.endswith("\\"):
+                output = rich.markup.escape(output)
+            # most lines don't match any wrangler, so only run the patterns that may match
+            candidates = self._matcher.candidates(output)
             suppress = False
-            # NOTE(JSKenyon): Changed to _wranglers to avoid shadowing import.
-            for regex, _wranglers in self.wranglers:
+            while candidates:
+                index = candidates.pop(0)
+                # NOTE(JSKenyon): Changed to _wranglers to avoid shadowing import.
+                regex, _wranglers = self.wranglers[index]
                 match = regex.search(output)
                 if match:
                     for wrangler in _wranglers:
@@ -466,6 +491,10 @@ class Cab(Cargo):
                         if mod_output is None:
                             suppress = True
                         else:
+                            # subsequent patterns are matched against the modified output (unless it has become a
+                            # FunkyMessage)
+                            if type(mod_output) is str and mod_output != output:
+                                candidates = self._matcher.candidates(mod_output, index + 1)
                             output = mod_output
                         # has wrangler modified the severity?
                         if mod_severity is not None:
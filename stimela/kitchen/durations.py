@@ -0,0 +1,125 @@
+import json
+import logging
+import os
+import os.path
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional
+
+import stimela
+
+from . import fingerprints
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS iterations (
+    recipe TEXT,
+    value TEXT,
+    elapsed REAL,
+    PRIMARY KEY (recipe, value)
+)
+"""
+
+
+def iteration_key(value: Any) -> str:
+    """Returns key identifying a for-loop iteration value in the history"""
+    return json.dumps(value, sort_keys=True, default=str)
+
+
+def input_size(value: Any) -> int:
+    """Returns total size of the files or directories (such as MSs) that an iteration value refers to, or 0 if it
+    doesn't refer to any
+    """
+    if isinstance(value, (list, tuple)):
+        return sum(input_size(item) for item in value)
+    if type(value) is not str or not os.path.exists(value):
+        return 0
+    try:
+        return sum(st.st_size for _, st in fingerprints.walk_files(value))
+    except OSError:
+        return 0
+
+
+class DurationHistory(object):
+    """Persistent record of the durations of for-loop iterations (from previous runs), backed by an sqlite database.
+    Iterations are identified by the name of their recipe and their loop value. If the database is unusable,
+    nothing is recorded.
+    """
+
+    def __init__(self, dbpath: str):
+        self.dbpath = dbpath
+        try:
+            os.makedirs(os.path.dirname(dbpath) or ".", exist_ok=True)
+            self._db = sqlite3.connect(dbpath, timeout=60)
+            self._db.execute(_SCHEMA)
+            self._db.commit()
+        except sqlite3.Error:
+            self._db = None
+
+    def lookup(self, recipe: str, values: List[Any]) -> Dict[str, float]:
+        """Returns dict of iteration key -> duration of the last completed run, for those values that have one"""
+        durations = {}
+        if self._db is not None:
+            try:
+                for key in set(map(iteration_key, values)):
+                    row = self._db.execute(
+                        "SELECT elapsed FROM iterations WHERE recipe=? AND value=?", (recipe, key)
+                    ).fetchone()
+                    if row is not None:
+                        durations[key] = row[0]
+            except sqlite3.Error:
+                self._db = None
+        return durations
+
+    def record(self, recipe: str, value: Any, elapsed: float):
+        """Records duration of a completed iteration"""
+        if self._db is not None:
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO iterations VALUES (?, ?, ?)", (recipe, iteration_key(value), elapsed)
+                )
+                self._db.commit()
+            except sqlite3.Error:
+                self._db = None
+
+
+# history for the current thread (sqlite connections can't be shared across forked processes, or used across threads)
+_local = threading.local()
+
+
+def get_history() -> DurationHistory:
+    """Returns the iteration duration history (kept in opts.cache.dir) for the current process and thread"""
+    dbpath = os.path.join(os.path.expanduser(stimela.CONFIG.opts.cache.dir), "durations.db")
+    history = getattr(_local, "history", None)
+    if history is None or _local.pid != os.getpid() or history.dbpath != dbpath:
+        history = _local.history = DurationHistory(dbpath)
+        _local.pid = os.getpid()
+    return history
+
+
+def longest_first(recipe: str, values: List[Any], log: Optional[logging.Logger] = None) -> List[int]:
+    """Returns indices of for-loop iteration values, ordered by expected duration, longest first (i.e. LPT
+    scheduling). Expected durations are taken from the history of previous runs. Values without a history are
+    considered the longest (since nothing is known about them), and are ordered by the total size of the input
+    files they refer to, largest first. Ties are kept in their original order.
+
+    Args:
+        recipe (str): name of recipe being iterated over
+        values (List[Any]): for-loop values
+        log (logging.Logger, optional): logger for messages
+
+    Returns:
+        List[int]: indices into values
+    """
+    durations = get_history().lookup(recipe, values)
+    keys = [iteration_key(value) for value in values]
+    if log:
+        nknown = sum(key in durations for key in keys)
+        log.info(f"ordering iterations longest-first ({nknown}/{len(values)} have durations from previous runs)")
+
+    def sort_key(index):
+        duration = durations.get(keys[index])
+        if duration is None:
+            return (0, -input_size(values[index]))
+        return (1, -duration)
+
+    return sorted(range(len(values)), key=sort_key)
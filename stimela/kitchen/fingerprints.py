@@ -0,0 +1,163 @@
+import hashlib
+import os
+import os.path
+import sqlite3
+import threading
+from typing import Iterator, Optional, Tuple
+
+import stimela
+
+# read buffer size for content hashing
+_HASH_BLOCK_SIZE = 1 << 20
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    inode INTEGER,
+    size INTEGER,
+    mtime_ns INTEGER,
+    hash TEXT
+)
+"""
+
+
+def walk_files(path: str, directories: bool = False) -> Iterator[Tuple[str, os.stat_result]]:
+    """Yields (path, stat) for a file, or recursively for all files in a directory (such as an MS). If directories is
+    True, subdirectories are included as well.
+    """
+    if not os.path.isdir(path):
+        yield path, os.stat(path)
+        return
+    try:
+        entries = sorted(os.scandir(path), key=lambda entry: entry.name)
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                if directories:
+                    yield entry.path, entry.stat(follow_symlinks=False)
+                yield from walk_files(entry.path, directories)
+            else:
+                yield entry.path, entry.stat()
+        except FileNotFoundError:
+            continue
+
+
+class FingerprintIndex(object):
+    """Persistent index of file fingerprints (inode, size, mtime, content hash), backed by an sqlite database.
+
+    Content hashes are only recomputed for files whose inode, size or mtime has changed since they were last
+    hashed, so fingerprinting large directory trees is cheap after the first time. If the database is unusable
+    (e.g. on a filesystem without proper locking, or in a cache directory that can't be created), fingerprints are
+    computed from scratch every time.
+    """
+
+    def __init__(self, dbpath: str):
+        self.dbpath = dbpath
+        try:
+            os.makedirs(os.path.dirname(dbpath) or ".", exist_ok=True)
+            self._db = sqlite3.connect(dbpath, timeout=60)
+            self._db.execute(_SCHEMA)
+            self._db.commit()
+        except (sqlite3.Error, OSError):
+            # e.g. opts.cache.dir is a file, or is read-only
+            self._db = None
+
+    def _lookup_hash(self, path: str, st: os.stat_result) -> Optional[str]:
+        if self._db is not None:
+            try:
+                row = self._db.execute(
+                    "SELECT hash FROM files WHERE path=? AND inode=? AND size=? AND mtime_ns=?",
+                    (path, st.st_ino, st.st_size, st.st_mtime_ns),
+                ).fetchone()
+                return row and row[0]
+            except sqlite3.Error:
+                self._db = None
+        return None
+
+    def _record_hash(self, path: str, st: os.stat_result, digest: str):
+        if self._db is not None:
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                    (path, st.st_ino, st.st_size, st.st_mtime_ns, digest),
+                )
+            except sqlite3.Error:
+                self._db = None
+
+    def _commit(self):
+        if self._db is not None:
+            try:
+                self._db.commit()
+            except sqlite3.Error:
+                self._db = None
+
+    def content_hash(self, path: str, st: Optional[os.stat_result] = None) -> str:
+        """Returns SHA256 hash of file contents, recomputing it only if the file has changed since it was indexed.
+        Raises OSError if the file can't be read.
+        """
+        path = os.path.abspath(path)
+        st = st or os.stat(path)
+        digest = self._lookup_hash(path, st)
+        if digest is None:
+            hasher = hashlib.sha256()
+            with open(path, "rb") as fileobj:
+                for block in iter(lambda: fileobj.read(_HASH_BLOCK_SIZE), b""):
+                    hasher.update(block)
+            digest = hasher.hexdigest()
+            self._record_hash(path, st, digest)
+        return digest
+
+    def fingerprint(self, path: str, hash_contents: bool = True, hash_directories: bool = False) -> Optional[str]:
+        """Returns a fingerprint of a file or directory, or None if it doesn't exist.
+
+        Args:
+            path (str): path to file or directory
+            hash_contents (bool): fingerprint files by content hash rather than size and mtime
+            hash_directories (bool): also fingerprint files inside directories by content hash, rather than by
+                relative path, size and mtime
+
+        Returns:
+            Optional[str]: fingerprint string
+        """
+        if not os.path.exists(path):
+            return None
+        try:
+            if not os.path.isdir(path):
+                if hash_contents:
+                    return f"sha256:{self.content_hash(path)}"
+                st = os.stat(path)
+                return f"stat:{st.st_size}:{st.st_mtime_ns}"
+            digest = hashlib.sha256()
+            for filename, st in walk_files(path):
+                relpath = os.path.relpath(filename, path)
+                if hash_directories:
+                    digest.update(f"{relpath}:{self.content_hash(filename, st)}\n".encode())
+                else:
+                    digest.update(f"{relpath}:{st.st_size}:{st.st_mtime_ns}\n".encode())
+            return f"{'tree-sha256' if hash_directories else 'tree'}:{digest.hexdigest()}"
+        finally:
+            self._commit()
+
+
+def get_mtime(path: str) -> float:
+    """Returns modification time of a file, or the most recent modification time of anything in a directory (such
+    as an MS), since the mtime of the top-level directory doesn't reflect changes to the tables inside it. The mtimes
+    of subdirectories are included, so that files removed from or renamed within a table count as changes too.
+    """
+    return max([os.path.getmtime(path)] + [st.st_mtime for _, st in walk_files(path, directories=True)])
+
+
+# index for the current thread (sqlite connections can't be shared across forked processes, or used across threads)
+_local = threading.local()
+
+
+def get_index() -> FingerprintIndex:
+    """Returns the fingerprint index (kept in opts.cache.dir) for the current process and thread"""
+    dbpath = os.path.join(os.path.expanduser(stimela.CONFIG.opts.cache.dir), "fingerprints.db")
+    index = getattr(_local, "index", None)
+    if index is None or _local.pid != os.getpid() or index.dbpath != dbpath:
+        index = _local.index = FingerprintIndex(dbpath)
+        _local.pid = os.getpid()
+    return index
@@ -0,0 +1,146 @@
+import json
+import logging
+import os
+import os.path
+from typing import Any, Dict, List, Tuple
+
+from scabha.basetypes import UNSET
+from scabha.substitutions import SubstitutionNS
+from scabha.validate import evaluate_and_substitute_object
+
+# marks entries of failed iterations in accumulated lists
+_FAILED = object()
+
+
+class ElementGatherer(object):
+    """Gathers the output elements of for-loop iterations as the iterations complete.
+
+    Elements that correspond to declared outputs are accumulated into lists, in iteration order. Each for_loop.reduce
+    expression is applied to the elements of each iteration in turn, in completion order, so that reduced outputs
+    don't need the whole list. If for_loop.spill is set, the elements of each iteration are also appended to a
+    JSON-lines file. Elements that don't correspond to declared outputs are only reduced and spilled, and are not
+    kept in memory. Use as a context manager, so that the spill file is closed if the loop fails.
+    """
+
+    def __init__(self, recipe: Any, nloop: int, subst: SubstitutionNS, log: logging.Logger):
+        """
+        Args:
+            recipe (Recipe): the for-loop recipe
+            nloop (int): number of iterations
+            subst (SubstitutionNS): substitution namespace of the recipe, used to evaluate reduce expressions
+            log (logging.Logger): logger for messages
+        """
+        self.recipe = recipe
+        self.log = log
+        for_loop = recipe.for_loop
+        self.elements = {name: [None] * nloop for name in for_loop.output_elements if name in recipe.outputs}
+        self.reduce = dict(for_loop.reduce)
+        # initial values of reductions are given by the defaults of their outputs, if any
+        self.reduced = {}
+        for name in self.reduce:
+            default = recipe.outputs[name].default
+            if default is not UNSET and default is not None:
+                self.reduced[name] = default
+        self._subst = subst.copy()
+        self._failed = set()
+        self._spill = None
+        if for_loop.spill:
+            path = evaluate_and_substitute_object(
+                for_loop.spill, subst, recursion_level=-1, location=[recipe.fqname, "for_loop", "spill"], log=log
+            )
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._spill = open(path, "w")
+            log.info(f"output elements of each iteration will be written to {path}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # make sure the spill file is closed, even if the loop has failed
+        self._close_spill()
+
+    def _close_spill(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    def add(self, count: int, iter_var: Any, elements: Dict[str, Any]):
+        """Gathers the output elements of a completed iteration.
+
+        Args:
+            count (int): index of the iteration
+            iter_var (Any): loop value of the iteration
+            elements (Dict[str, Any]): output elements of the iteration
+        """
+        for name, value in elements.items():
+            if name in self.elements:
+                self.elements[name][count] = value
+        for name, expr in self.reduce.items():
+            reduce_ns = dict(index=count, elements=elements)
+            if name in self.reduced:
+                reduce_ns["value"] = self.reduced[name]
+            self._subst._add_("reduce", reduce_ns, nosubst=True)
+            self.reduced[name] = evaluate_and_substitute_object(
+                expr,
+                self._subst,
+                recursion_level=-1,
+                location=[self.recipe.fqname, "for_loop", "reduce", name],
+                log=self.log,
+            )
+        if self._spill is not None:
+            self._spill.write(json.dumps(dict(index=count, value=iter_var, elements=elements), default=str) + "\n")
+            self._spill.flush()
+
+    def mark_failed(self, failed: List[int]):
+        """Marks iterations as failed (when failures are tolerated). Their entries are dropped from the accumulated
+        lists, while reduced outputs are left as reduced over the successful iterations. Either way, a warning is logged
+        for each gathered output.
+
+        Args:
+            failed (List[int]): indices of the failed iterations
+        """
+        failed = sorted(failed)
+        self._failed.update(failed)
+        indices = ", ".join(map(str, failed))
+        for name in self.names:
+            if name in self.elements:
+                self.log.warning(f"output '{name}' is missing the elements of failed iteration(s) {indices}")
+            else:
+                self.log.warning(f"output '{name}' is reduced without the elements of failed iteration(s) {indices}")
+
+    @property
+    def names(self) -> List[str]:
+        """Names of the outputs set by the gatherer"""
+        return list(self.elements) + list(self.reduce)
+
+    def close(self) -> Dict[str, Any]:
+        """Closes the spill file, if any, and returns the gathered outputs. Accumulated elements of multi-variable
+        product loops are nested, one level per variable. Entries of failed iterations are dropped from the innermost
+        lists.
+        """
+        self._close_spill()
+        outputs = {}
+        shape = self.recipe._for_loop_shape
+        for name, values in self.elements.items():
+            # entries of failed iterations are marked, so that they can be dropped after nesting
+            values = [_FAILED if count in self._failed else value for count, value in enumerate(values)]
+            if shape is not None:
+                values = nest_elements(values, shape)
+            outputs[name] = drop_failed(values, len(shape) - 1 if shape is not None else 0)
+        outputs.update(self.reduced)
+        return outputs
+
+
+def drop_failed(values: List[Any], depth: int) -> List[Any]:
+    """Drops entries of failed iterations from a list of accumulated output elements, nested to the given depth"""
+    if depth:
+        return [drop_failed(value, depth - 1) for value in values]
+    return [value for value in values if value is not _FAILED]
+
+
+def nest_elements(values: List[Any], shape: Tuple[int, ...]) -> List[Any]:
+    """Reshapes a flat list of accumulated output elements into nested lists of the given shape (in row-major order)"""
+    for size in reversed(shape[1:]):
+        values = [values[i : i + size] for i in range(0, len(values), size)]
+    return values
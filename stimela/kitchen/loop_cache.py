@@ -0,0 +1,205 @@
+import hashlib
+import json
+import logging
+import os
+import os.path
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from . import durations, step_cache
+from .cab import Cab
+
+# bump this if the format of cache entries changes, to invalidate old entries
+CACHE_FORMAT_VERSION = 1
+
+
+def get_cache_dir() -> str:
+    """Returns the directory in which loop iteration cache entries are stored (under opts.cache.dir)"""
+    return os.path.join(step_cache.get_cache_dir(), "loops")
+
+
+def _loop_names(recipe: Any) -> Set[str]:
+    """Returns the names of the for-loop variables of a recipe, and of the inputs that provide their values"""
+    overs = [recipe.for_loop.over, *recipe.for_loop.vars.values()]
+    return set(recipe._for_loop_vars) | {over for over in overs if type(over) is str}
+
+
+def _recipe_signature(recipe: Any) -> str:
+    """Returns a string representing the definition of a recipe, including the definitions of its steps (and
+    their cabs or sub-recipes). Step parameters that are aliases of recipe parameters are left out, since their
+    values are set at runtime from the recipe's parameters.
+    """
+    aliased = {(id(alias.step), alias.param) for aliases in recipe._alias_list.values() for alias in aliases}
+    steps = []
+    for label, step in recipe.steps.items():
+        if type(step.cargo) is Cab:
+            cargo_signature = step_cache._cab_signature(step.cargo)
+        else:
+            cargo_signature = _recipe_signature(step.cargo)
+        params = {name: value for name, value in step.params.items() if (id(step), name) not in aliased}
+        steps.append(
+            (label, params, step.skip, step.skip_if_outputs, step.assign, step.assign_based_on, cargo_signature)
+        )
+    # the for-loop variables and indices are assigned by the loop itself, and parameters and for_loop settings set
+    # from the command line end up in assignments
+    excluded = set(recipe.inputs_outputs)
+    if recipe.for_loop:
+        excluded.update(_loop_names(recipe))
+        excluded.update(f"{var}@index" for var in recipe._for_loop_vars)
+    assign = {
+        name: value
+        for name, value in recipe.assign.items()
+        if name not in excluded and not name.startswith("for_loop.")
+    }
+    loop = (recipe.for_loop.var or recipe._for_loop_vars, recipe.for_loop.output_elements) if recipe.for_loop else None
+    return repr((recipe.inputs, recipe.outputs, loop, assign, recipe.assign_based_on, steps))
+
+
+def get_loop_key(recipe: Any, params: Dict[str, Any]) -> str:
+    """Returns the part of the cache key shared by all iterations of a for-loop: the recipe definition, and its
+    input parameters. The list of loop values and for_loop settings are left out, so that iterations are
+    unaffected by other values being added to or removed from the loop. This must be computed before the loop is
+    run, since running iterations modifies the parameters.
+    """
+    excluded = _loop_names(recipe)
+    params = {
+        name: value
+        for name, value in params.items()
+        if name in recipe.inputs and name not in excluded and not name.startswith("for_loop.")
+    }
+    return json.dumps([CACHE_FORMAT_VERSION, _recipe_signature(recipe), params], sort_keys=True, default=str)
+
+
+def _file_paths(value: Any) -> List[str]:
+    """Returns list of existing paths that a value (or list of values) refers to"""
+    if isinstance(value, (list, tuple)):
+        return [path for item in value for path in _file_paths(item)]
+    if isinstance(value, str) and os.path.exists(value):
+        return [value]
+    return []
+
+
+def _input_paths(recipe: Any, iter_var: Any, params: Dict[str, Any]) -> List[str]:
+    """Returns list of paths of input files of an iteration: those given by file-type inputs of the recipe (other than
+    the list of loop values), and by the loop value itself
+    """
+    excluded = _loop_names(recipe)
+    params = {name: value for name, value in params.items() if name not in excluded}
+    return step_cache._file_paths(recipe, params, inputs=True) + _file_paths(iter_var)
+
+
+def _output_paths(recipe: Any, outputs: Dict[str, Any], output_elements: Dict[str, Any]) -> List[str]:
+    """Returns list of paths given by file-type outputs of an iteration, including its output elements (other than
+    those that are only reduced or spilled, which don't correspond to declared outputs)
+    """
+    paths = step_cache._file_paths(recipe, outputs, inputs=False)
+    for name, value in output_elements.items():
+        if name in recipe.outputs and recipe.outputs[name].is_file_list_type and isinstance(value, str):
+            paths.append(value)
+    return paths
+
+
+def _cache_key(recipe: Any, loop_key: str, iter_var: Any, params: Dict[str, Any]) -> str:
+    """Returns cache key of an iteration, based on the loop key, loop value and current state of input files"""
+    input_fingerprints = {path: step_cache.file_fingerprint(path) for path in _input_paths(recipe, iter_var, params)}
+    key = json.dumps([loop_key, durations.iteration_key(iter_var), input_fingerprints], sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _entry_path(key: str) -> str:
+    return os.path.join(get_cache_dir(), f"{key}.json")
+
+
+def lookup(
+    recipe: Any, loop_key: str, iter_var: Any, params: Dict[str, Any], log: logging.Logger
+) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+    """Looks for a previous successful run of a for-loop iteration with an identical recipe, parameters, loop value
+    and inputs.
+
+    Args:
+        recipe (Recipe): the for-loop recipe
+        loop_key (str): key returned by get_loop_key()
+        iter_var (Any): loop value of the iteration
+        params (Dict[str, Any]): parameters of the recipe
+        log (logging.Logger): logger for messages
+
+    Returns:
+        Optional[Tuple[Dict[str, Any], Dict[str, Any]]]: outputs and output elements recorded by the previous run,
+        or None if there is no such run, or if its file-type outputs have since been changed or removed.
+    """
+    names = ", ".join(recipe._for_loop_vars)
+    # input files that can't be read (or disappear while being fingerprinted) make for a cache miss
+    try:
+        path = _entry_path(_cache_key(recipe, loop_key, iter_var, params))
+    except OSError as exc:
+        log.warning(f"{names}={iter_var}: can't fingerprint input files, ignoring the loop cache: {exc}")
+        return None
+    try:
+        with open(path) as fileobj:
+            entry = json.load(fileobj)
+    except FileNotFoundError:
+        return None
+    except Exception as exc:
+        log.warning(f"ignoring invalid loop cache entry {path}: {exc}")
+        return None
+    for filename, fingerprint in entry["output_fingerprints"].items():
+        try:
+            changed = step_cache.file_fingerprint(filename) != fingerprint
+        except OSError as exc:
+            log.debug(f"{names}={iter_var}: output {filename} can't be fingerprinted: {exc}")
+            return None
+        if changed:
+            log.debug(f"{names}={iter_var}: output {filename} has changed since the cached run")
+            return None
+    step_cache.touch(path, log)
+    return entry["outputs"], entry["output_elements"]
+
+
+def store(
+    recipe: Any,
+    loop_key: str,
+    iter_var: Any,
+    params: Dict[str, Any],
+    outputs: Dict[str, Any],
+    output_elements: Dict[str, Any],
+    log: logging.Logger,
+):
+    """Records the outputs and output elements of a successful run of a for-loop iteration, then evicts old entries
+    from the cache.
+
+    Args:
+        recipe (Recipe): the for-loop recipe
+        loop_key (str): key returned by get_loop_key() before the loop was run
+        iter_var (Any): loop value of the iteration
+        params (Dict[str, Any]): parameters of the recipe
+        outputs (Dict[str, Any]): outputs of the iteration
+        output_elements (Dict[str, Any]): output elements of the iteration
+        log (logging.Logger): logger for messages
+    """
+    try:
+        entry = dict(
+            fqname=recipe.fqname,
+            time=time.time(),
+            outputs=outputs,
+            output_elements=output_elements,
+            output_fingerprints={
+                path: step_cache.file_fingerprint(path) for path in _output_paths(recipe, outputs, output_elements)
+            },
+        )
+        # input files may have been modified by the run, so the key is formed from their current state
+        path = _entry_path(_cache_key(recipe, loop_key, iter_var, params))
+    except OSError as exc:
+        log.warning(f"not caching iteration outputs, as files can't be fingerprinted: {exc}")
+        return
+    try:
+        text = json.dumps(entry)
+    except TypeError as exc:
+        log.debug(f"not caching iteration outputs, as they can't be serialized: {exc}")
+        return
+    try:
+        step_cache.write_entry(path, text)
+    except OSError as exc:
+        log.warning(f"not caching iteration outputs: {exc}")
+        return
+    log.debug(f"cached iteration outputs in {path}")
+    step_cache.evict(get_cache_dir())
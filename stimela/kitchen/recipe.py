@@ -1,25 +1,35 @@
 import copy
 import fnmatch
+import heapq
+import itertools
 import logging
+import os.path
+import pickle
 import re
+import shutil
+import statistics
 import sys
+import tempfile
+import time
 from collections import OrderedDict
 from collections.abc import Mapping
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack, nullcontext
 from dataclasses import dataclass
-from io import StringIO
-from typing import Any, Dict, Optional, Tuple, Union, get_origin
+from multiprocessing.reduction import ForkingPickler
+from typing import Any, Dict, List, Optional, Set, Tuple, Union, get_origin
 
 import networkx as nx
 import rich.table
 from omegaconf import DictConfig, ListConfig, OmegaConf
-from scabha.basetypes import UNSET, Placeholder
+from scabha.basetypes import UNSET, URI, Placeholder, SkippedOutput, get_filelikes
 from scabha.cargo import Cargo, Parameter, ParameterCategory
 from scabha.substitutions import SubstitutionNS
-from scabha.validate import Unresolved, evaluate_and_substitute, evaluate_and_substitute_object
+from scabha.validate import Unresolved, evaluate_and_substitute_object
 
 import stimela
-from stimela import backends, log_exception, stimelogging, task_stats
+from stimela import backends, journal, log_exception, stimelogging, task_stats, worker_pool
 from stimela.backends import StimelaBackendSchema
 from stimela.config import EmptyDictDefault
 from stimela.display.display import display
@@ -35,8 +45,12 @@ from stimela.exceptions import (
     StimelaRuntimeError,
     StimelaStepExecutionError,
 )
+from stimela.kitchen import durations, loop_cache, speculation
+from stimela.kitchen.admission import AdmissionControl
+from stimela.kitchen.assignments import AssignmentEvaluator
+from stimela.kitchen.gather import ElementGatherer
 from stimela.kitchen.run_state import RunConstraints
-from stimela.stimelogging import log_rich_payload, rich_console
+from stimela.stimelogging import log_rich_payload
 
 from .cab import Cab
 from .step import Step, apply_backend_varieties
@@ -48,27 +62,114 @@ class DeferredAlias(Unresolved):
     pass
 
 
+@dataclass
+class ForLoopResources(object):
+    # Number of cores used by each iteration. Iterations are started only while the total declared by the running
+    # iterations fits into the node's cores.
+    cores: float = 0
+    # Peak memory (GB) used by each iteration. Iterations are started only while the total declared by the running
+    # iterations fits into the node's memory, and if at least this much memory is currently available.
+    mem: float = 0
+    # Memory (GB) to keep free, on top of the above
+    min_free_mem: float = 0
+    # Iterations are started only while the node's load (1-minute load average, as a % of its cores) is below this
+    max_load: float = 0
+    # Interval (seconds) at which resources are rechecked while iterations are held back
+    poll_interval: float = 5
+
+
 @dataclass
 class ForLoopClause(object):
     # name of list variable
-    var: str
+    var: Optional[str] = None
     # This should be the name of an input that provides a list, or a list
     over: Optional[Any] = None
+    # Alternatively, loop over several variables at once. This maps each variable name to the name of an input that
+    # provides a list, or a list.
+    vars: Dict[str, Any] = EmptyDictDefault()
+    # With multiple variables, "product" iterates over all combinations of their values, and "zip" iterates over
+    # their lists in lockstep
+    mode: str = "product"
     # If !=0 , this is a scatter not a loop -- things may be evaluated in parallel using this many workers
     # (use -1 to scatter to unlimited number of workers)
     scatter: int = 0
+    # When scattering, the number of iterations sent to a worker at a time. Iterations within a chunk are run one
+    # after the other. Use 0 to pick a chunk size automatically, based on the number of iterations and workers.
+    chunk_size: int = 1
+    # When scattering, run iterations in worker "processes" or "threads". Threads avoid the overhead of forking
+    # processes, and suit iterations that mostly wait on remote backends. "auto" picks threads if the backend is
+    # remote (kube, or the slurm wrapper), else processes. Threads (and "auto") must be opted into.
+    scatter_mode: str = "processes"
+    # When scattering, resources used by each iteration (or chunk of iterations), and thresholds on resource usage.
+    # If set, further iterations are started only while there are resources available for them.
+    resources: Optional[ForLoopResources] = None
+    # When scattering, start the iterations expected to take longest first, based on their durations in previous
+    # runs (or, failing that, on the size of their input files), rather than in list order
+    longest_first: bool = False
+    # When scattering, number of times a failed iteration is retried (as a new task, with a fresh copy of the loop
+    # state, in a fresh worker)
+    retries: int = 0
+    # Delay (seconds) before the first retry of an iteration, doubled for each subsequent retry
+    retry_backoff: float = 0
+    # When scattering, the number (if >=1) or fraction (if <1) of iterations that may still fail after their retries,
+    # without failing the loop. Output elements of failed iterations are left out of accumulated and reduced outputs.
+    allow_failures: float = 0
+    # When scattering, re-run straggling iterations speculatively: once most iterations have completed, an iteration
+    # (or chunk of iterations) running for longer than this many times the median iteration duration is started again
+    # on an idle worker, with its file outputs written to temporary paths. The first copy to finish wins, and the other
+    # is cancelled. Outputs of the speculative copy are renamed to their final paths if it wins.
+    speculate: float = 0
+    # Cache the outputs (and output elements) of each iteration, keyed by the loop value, recipe parameters and
+    # input files. Iterations that have been run before with identical ones are then restored rather than re-run.
+    cache: bool = False
     # How to indicate the status of the loop on the console.
     # Default is "i/N", where i is the current index plus 1, and N is the total number of loops.
     # A format string can be supplied instead.
     display_status: Optional[str] = None
     # Expressions to be evaluated at each iteration and accumulated into list-type outputs
     output_elements: Dict[str, Any] = EmptyDictDefault()
+    # Expressions to be evaluated in turn as each iteration completes, reducing the output elements of the iteration
+    # into an output. {reduce.value} refers to the current value of the output (initially, its default, if any),
+    # {reduce.elements.X} to output element X of the completed iteration, and {reduce.index} to its index.
+    reduce: Dict[str, Any] = EmptyDictDefault()
+    # If set, the output elements of each iteration are appended to this JSON-lines file as the iteration completes.
+    # Output elements that don't correspond to declared outputs are then only spilled (and reduced), rather than
+    # accumulated in memory.
+    spill: Optional[str] = None
+
+
+# valid settings of for_loop.scatter_mode
+SCATTER_MODES = ("auto", "threads", "processes")
+# valid settings of for_loop.mode
+LOOP_MODES = ("product", "zip")
+# with for_loop.chunk_size=0, scattered loop iterations are split into this many chunks per worker
+AUTO_CHUNKS_PER_WORKER = 4
+# with for_loop.speculate, stragglers are re-run only once this fraction of the iterations have completed
+SPECULATE_AFTER_FRACTION = 0.75
+# interval (seconds) at which running iterations are checked for stragglers
+SPECULATE_POLL_INTERVAL = 1
 
 
 def IterantPlaceholder(name: str):
     return name
 
 
+# matches {steps.X...}, {previous...} and {recipe.X...} references in substitutions and formulas
+_STEP_REFERENCE = re.compile(r"\bsteps\.([\w-]+)|\b(previous)\b|\brecipe\.([\w-]+)")
+
+# placeholder used in dependency analysis, for references to the previous step
+_PREVIOUS_STEP = ".previous"
+
+
+def _paths_overlap(paths1: Set[str], paths2: Set[str]) -> bool:
+    """Returns True if any path in paths1 is the same as, or is nested within, any path in paths2 (or vice versa)"""
+    for path1 in paths1:
+        for path2 in paths2:
+            if path1 == path2 or path1.startswith(path2 + os.path.sep) or path2.startswith(path1 + os.path.sep):
+                return True
+    return False
+
+
 @dataclass
 class Recipe(Cargo):
     """Represents a sequence of steps.
@@ -96,6 +197,10 @@ class Recipe(Cargo):
     # make recipe a for_loop-gather (i.e. parallel for loop)
     for_loop: Optional[ForLoopClause] = None
 
+    # If set, independent steps are run concurrently using up to this many worker processes (use -1 for unlimited
+    # workers, 0 to run steps sequentially). Defaults to the opts.parallel_steps setting.
+    parallel: Optional[int] = None
+
     def __post_init__(self):
         Cargo.__post_init__(self)
         # flatten aliases and assignments
@@ -132,24 +237,52 @@ class Recipe(Cargo):
                 except Exception as exc:
                     raise StepValidationError(f"recipe '{self.name}': error in definition of step '{label}'", exc)
             self.steps = steps
+        # convert assignments into standard dicts, since these are iterated over repeatedly at runtime
+        if isinstance(self.assign, DictConfig):
+            self.assign = OmegaConf.to_container(self.assign)
+        if isinstance(self.assign_based_on, DictConfig):
+            self.assign_based_on = OmegaConf.to_container(self.assign_based_on)
         # check that assignments don't clash with i/o parameters
 
         self.validate_assignments(self.assign, self.assign_based_on, self.name)
 
-        # check that for-loop variable does not clash
+        # names of for-loop variables
+        self._for_loop_vars = []
+        # check that for-loop variables do not clash
         if self.for_loop:
-            for io, io_label in [(self.inputs, "input"), (self.outputs, "output")]:
-                if self.for_loop.var in io:
+            for name in ("retries", "retry_backoff", "allow_failures", "speculate"):
+                if getattr(self.for_loop, name) < 0:
+                    raise RecipeValidationError(f"recipe '{self.name}': for_loop.{name} can't be negative")
+            if bool(self.for_loop.var) == bool(self.for_loop.vars):
+                raise RecipeValidationError(f"recipe '{self.name}': for_loop needs exactly one of var or vars")
+            if self.for_loop.vars:
+                if self.for_loop.over is not None:
                     raise RecipeValidationError(
-                        f"recipe '{self.name}': for_loop.var={self.for_loop.var} clashes with an {io_label} parameter"
+                        f"recipe '{self.name}': for_loop.over can't be combined with for_loop.vars"
                     )
+                self._for_loop_vars = list(self.for_loop.vars)
+            else:
+                self._for_loop_vars = [self.for_loop.var]
+            for var in self._for_loop_vars:
+                for io, io_label in [(self.inputs, "input"), (self.outputs, "output")]:
+                    if var in io:
+                        raise RecipeValidationError(
+                            f"recipe '{self.name}': for_loop variable {var} clashes with an {io_label} parameter"
+                        )
         # marked when finalized
         self._alias_map = None
         # set of keys protected from assignment
         self._protected_from_assign = set()
-        self._for_loop_values = self._for_loop_scatter = None
+        self._for_loop_values = self._for_loop_scatter = self._for_loop_chunk_size = None
+        self._for_loop_scatter_mode = None
+        # for multi-variable product loops, the number of values of each variable
+        self._for_loop_shape = None
+        # key of loop cache entries (see loop_cache), if the loop cache is in use
+        self._loop_cache_key = None
         # process pool used to run for-loops
         self._loop_pool = None
+        # evaluates assignments of the recipe and its steps, reusing results whose inputs haven't changed
+        self._assignment_evaluator = AssignmentEvaluator()
 
     def validate_assignments(self, assign, assign_based_on, location):
         # collect a list of all assignments
@@ -219,8 +352,8 @@ class Recipe(Cargo):
             subst.recipe._merge_(flattened)
             # perform substitutions
             try:
-                flattened = evaluate_and_substitute(
-                    flattened, subst, subst.recipe, location=[whose.fqname], ignore_subst_errors=True, log=self.log
+                flattened = self._assignment_evaluator.evaluate(
+                    whose, flattened, subst, location=[whose.fqname], ignore_subst_errors=True, log=self.log
                 )
             except Exception as exc:
                 raise AssignmentError(f"{whose.fqname}: error evaluating assignments", exc)
@@ -237,7 +370,7 @@ class Recipe(Cargo):
             if basevar in subst.recipe:
                 value = str(subst.recipe[basevar])
             # else it may be a for-loop index that hasn't been assigned yet -- ignore
-            elif self.for_loop is not None and basevar == self.for_loop.var:
+            elif basevar in self._for_loop_vars:
                 continue
             # else it might be an input with a default, check for that
             elif basevar in self.inputs_outputs and self.inputs_outputs[basevar].default is not UNSET:
@@ -285,10 +418,10 @@ class Recipe(Cargo):
 
         # do final round of substitutions
         try:
-            assign = evaluate_and_substitute(
+            assign = self._assignment_evaluator.evaluate(
+                whose,
                 assign,
                 subst,
-                subst.recipe,
                 location=[whose.fqname],
                 ignore_subst_errors=ignore_subst_errors,
                 log=self.log,
@@ -730,7 +863,20 @@ class Recipe(Cargo):
             self._inputs_outputs = None
 
             # check that for-loop is valid, if defined
-            if self.for_loop is not None:
+            if self.for_loop is not None and self.for_loop.vars:
+                # each variable's list is given by a required input, or inline
+                for var, over in self.for_loop.vars.items():
+                    if type(over) is str:
+                        if over not in self.inputs:
+                            raise RecipeValidationError(
+                                f"recipe '{self.name}': for_loop.vars.{var}={over} is not a defined input", log=log
+                            )
+                        self.inputs[over].required = True
+                    elif type(over) not in (list, tuple, ListConfig):
+                        raise RecipeValidationError(
+                            f"recipe '{self.name}': for_loop.vars.{var} is of invalid type {type(over)}", log=log
+                        )
+            elif self.for_loop is not None:
                 # if for_loop.over is a str, treat it as a required input
                 if type(self.for_loop.over) is str:
                     if self.for_loop.over not in self.inputs:
@@ -752,6 +898,18 @@ class Recipe(Cargo):
                 # if self.for_loop.var not in self.assign:
                 #     self.assign[self.for_loop.var] = ""
 
+    def validate_backends(self):
+        """Checks the backend settings of all steps that are not skipped"""
+        for label, step in self.steps.items():
+            try:
+                step.validate_backend()
+            except Exception as exc:
+                raise StepValidationError(
+                    f"error validating backend settings of step '{label}'",
+                    exc,
+                    tb=not isinstance(exc, ScabhaBaseException),
+                )
+
     def _prep_step(self, label, step, subst):
         parts = label.split("-")
         info = subst.info
@@ -827,9 +985,10 @@ class Recipe(Cargo):
             self.log, self.logopts, nesting=self.nesting, subst=subst, location=[self.fqname]
         )
 
-        # add for-loop variable to inputs, if expected there
-        if self.for_loop is not None and self.for_loop.var in self.inputs:
-            params[self.for_loop.var] = Placeholder(self.for_loop.var)
+        # add for-loop variables to inputs, if expected there
+        for var in self._for_loop_vars:
+            if var in self.inputs:
+                params[var] = Placeholder(var)
 
         # prevalidate our own parameters. This substitutes in defaults and does {}-substitutions
         # we call this twice, potentially, so define as a function
@@ -965,9 +1124,39 @@ class Recipe(Cargo):
             elif type(scatter) is not int:
                 raise ParameterValidationError(f"for_loop.scattter={scatter}: bool or int expected")
             self._for_loop_scatter = scatter
+            if not scatter:
+                for name in ("retries", "retry_backoff", "allow_failures", "speculate"):
+                    if getattr(self.for_loop, name):
+                        raise RecipeValidationError(
+                            f"recipe '{self.name}': for_loop.{name} is only supported with for_loop.scatter"
+                        )
+            # get chunk size
+            if "for_loop.chunk_size" in params:
+                chunk_size = params["for_loop.chunk_size"]
+            elif "for_loop.chunk_size" in self.assign:
+                chunk_size = self.assign["for_loop.chunk_size"]
+            else:
+                chunk_size = self.for_loop.chunk_size
+            if type(chunk_size) is not int or chunk_size < 0:
+                raise ParameterValidationError(f"for_loop.chunk_size={chunk_size}: non-negative int expected")
+            self._for_loop_chunk_size = chunk_size
+            # get scatter mode
+            if "for_loop.scatter_mode" in params:
+                scatter_mode = params["for_loop.scatter_mode"]
+            elif "for_loop.scatter_mode" in self.assign:
+                scatter_mode = self.assign["for_loop.scatter_mode"]
+            else:
+                scatter_mode = self.for_loop.scatter_mode
+            if scatter_mode not in SCATTER_MODES:
+                raise ParameterValidationError(
+                    f"for_loop.scatter_mode={scatter_mode}: one of {', '.join(SCATTER_MODES)} expected"
+                )
+            self._for_loop_scatter_mode = scatter_mode
 
+            if self.for_loop.vars:
+                values = self._get_multi_loop_values(params, strict)
             # the over list can be in the for_loop clause, or in inputs
-            if "for_loop.over" in params:
+            elif "for_loop.over" in params:
                 values = params["for_loop.over"]
             elif "for_loop.over" in self.assign:
                 values = self.assign["for_loop.over"]
@@ -997,13 +1186,17 @@ class Recipe(Cargo):
             elif not isinstance(values, (list, tuple)):
                 values = [values]
             if self._for_loop_values is None:
-                self.log.debug(f"recipe is a for-loop with '{self.for_loop.var}' iterating over {len(values)} values")
+                names = ", ".join(f"'{var}'" for var in self._for_loop_vars)
+                self.log.debug(f"recipe is a for-loop with {names} iterating over {len(values)} values")
                 self.log.debug(f"loop values: {values}")
             self._for_loop_values = values
-            # validate output_elements names against declared outputs
+            # validate output_elements names against declared outputs (elements that are only reduced or spilled
+            # need not be declared)
             if self.for_loop.output_elements:
                 for elem_name in self.for_loop.output_elements:
                     if elem_name not in self.outputs:
+                        if self.for_loop.reduce or self.for_loop.spill:
+                            continue
                         raise ParameterValidationError(
                             f"recipe '{self.name}': for_loop.output_elements.{elem_name} "
                             f"does not correspond to a declared output"
@@ -1013,10 +1206,82 @@ class Recipe(Cargo):
                             f"recipe '{self.name}': for_loop.output_elements.{elem_name} "
                             f"has dtype '{self.outputs[elem_name].dtype}', expected a List type"
                         )
+            # reductions must be declared outputs of their own
+            for name in self.for_loop.reduce:
+                if name not in self.outputs:
+                    raise ParameterValidationError(
+                        f"recipe '{self.name}': for_loop.reduce.{name} does not correspond to a declared output"
+                    )
+                if name in self.for_loop.output_elements:
+                    raise ParameterValidationError(
+                        f"recipe '{self.name}': for_loop.reduce.{name} is also given by for_loop.output_elements"
+                    )
         # else fake a single-value list
         else:
             self._for_loop_values = [None]
 
+    def _get_multi_loop_values(self, params, strict=False) -> List[Tuple]:
+        """Returns list of iteration values of a multi-variable for-loop. Each value is a tuple, with one element per
+        variable. Also sets self._for_loop_shape for product loops."""
+        if "for_loop.mode" in params:
+            mode = params["for_loop.mode"]
+        elif "for_loop.mode" in self.assign:
+            mode = self.assign["for_loop.mode"]
+        else:
+            mode = self.for_loop.mode
+        if mode not in LOOP_MODES:
+            raise ParameterValidationError(f"for_loop.mode={mode}: one of {', '.join(LOOP_MODES)} expected")
+        var_values = []
+        for var, over in self.for_loop.vars.items():
+            # the list can be in the for_loop clause, or in inputs
+            if f"for_loop.vars.{var}" in params:
+                values = params[f"for_loop.vars.{var}"]
+            elif f"for_loop.vars.{var}" in self.assign:
+                values = self.assign[f"for_loop.vars.{var}"]
+            elif type(over) is str:
+                if over in self.assign:
+                    values = self.assign[over]
+                elif over in params:
+                    values = params[over]
+                else:
+                    raise ParameterValidationError(f"recipe '{self.name}': for_loop.vars.{var}={over} is unset")
+                if strict and isinstance(values, Unresolved):
+                    raise ParameterValidationError(
+                        f"recipe '{self.name}': for_loop.vars.{var}={over} is unresolved", [values]
+                    )
+            else:
+                values = over
+            if type(values) is ListConfig:
+                values = list(values)
+            elif not isinstance(values, (list, tuple)):
+                values = [values]
+            var_values.append(values)
+        if mode == "zip":
+            lengths = [len(values) for values in var_values]
+            if strict and len(set(lengths)) > 1:
+                raise ParameterValidationError(
+                    f"recipe '{self.name}': for_loop.mode=zip requires lists of equal length, got "
+                    + ", ".join(f"{var}: {length}" for var, length in zip(self._for_loop_vars, lengths))
+                )
+            self._for_loop_shape = None
+            return list(zip(*var_values))
+        self._for_loop_shape = tuple(len(values) for values in var_values)
+        return list(itertools.product(*var_values))
+
+    def _loop_var_assignments(self, count: int, iter_var: Any) -> List[Tuple[str, Any, int]]:
+        """Returns list of (name, value, index) tuples for the variables of a for-loop iteration. For multi-variable
+        loops, the index is that of the value within the variable's own list."""
+        if not self.for_loop.vars:
+            return [(self.for_loop.var, iter_var, count)]
+        if self._for_loop_shape is None:
+            indices = [count] * len(self._for_loop_vars)
+        else:
+            indices = []
+            for size in reversed(self._for_loop_shape):
+                count, index = divmod(count, size)
+                indices.insert(0, index)
+        return list(zip(self._for_loop_vars, iter_var, indices))
+
     def validate_inputs(self, params: Dict[str, Any], subst: SubstitutionNS, loosely=False, remote_fs=False):
         params, _ = self._preprocess_parameters(params)
 
@@ -1052,9 +1317,12 @@ class Recipe(Cargo):
             loop_tree = tree.add("For loop:")
             if self._for_loop_values is not None:
                 over = f"{len(self._for_loop_values)} values"
+            elif self.for_loop.vars:
+                over = f"the {self.for_loop.mode} of their lists"
             else:
                 over = f"[bold]{self.for_loop.over}[/bold]"
-            loop_tree.add(f"iterating [bold]{self.for_loop.var}[/bold] over {over}")
+            names = ", ".join(f"[bold]{var}[/bold]" for var in self._for_loop_vars)
+            loop_tree.add(f"iterating {names} over {over}")
         if self.steps:
             have_skips = any(step._skip for step in self.steps.values())
             steps_tree = tree.add(
@@ -1083,153 +1351,496 @@ class Recipe(Cargo):
             if alias.from_recipe:
                 alias.step.update_parameter(alias.param, value)
 
-    def _iterate_loop_worker(self, params, subst, backend_settings, count, iter_var, subprocess=False, raise_exc=True):
-        """ "
-        Needed for concurrency
+    def _prepare_step(self, label: str, step: Step, params: Dict[str, Any], subst: SubstitutionNS, taskname: str):
+        """Updates the substitution namespace, assignments and file logger of a step that is about to be run"""
+        # update step info
+        self._prep_step(label, step, subst)
+        subst.info.taskname = f"{taskname}.{label}"
+        # reevaluate recipe level assignments (info.fqname etc. have changed)
+        self.update_assignments(subst, params=params)
+        # evaluate step-level assignments
+        self.update_assignments(subst, whose=step, params=params)
+        # step logger may have changed
+        stimelogging.update_file_logger(
+            step.log, step.logopts, nesting=step.nesting, subst=subst, location=[step.fqname]
+        )
+        # set our info back temporarily to update log assignments
+
+        ## OMS: note to self, I had this here but not sure why. Seems like a no-op. Something with logname
+        ## fiddling.
+        ## Leave as a puzzle to future self for a bit. Remove info from args.
+        # info_step = subst.info
+        # subst.info = info.copy()
+        # subst.info = info_step
+
+        if step.skip is True:
+            self.log.debug(f"step '{label}' will be explicitly skipped")
+        else:
+            self.log.info(f"processing step '{label}'")
+            if step.info:
+                self.log.info(f"  ({step.info})", extra=dict(color="GREEN", boldface=True))
+
+    def _run_step(self, step: Step, subst: SubstitutionNS, backend_settings: Dict) -> Dict[str, Any]:
+        """Runs a prepared step, converting any errors into a StimelaStepExecutionError, and records it in the
+        journal. If the step was completed by a previous run that is being resumed, restores it from that run's
+        journal instead.
         """
-        if subprocess:
-            task_stats.add_subprocess_id(count)
-            # When running in a processpool, gather log messages in a string
-            # which can be returned to the parent process.
-            rich_console.file = StringIO()
-        subst.info.subprocess = task_stats.get_subprocess_id()
         taskname = subst.info.taskname
-        outputs = {}
-        output_elements = {}
-        exception = tb = None
-        task_attrs, task_kwattrs = (), {}
+        record = journal.lookup(taskname)
+        if record is not None:
+            self.log.info(f"step '{step.name}' was completed by the resumed run, restoring its outputs")
+            step.validated_params.update(**record["params"])
+            journal.record(taskname, step.validated_params, elapsed=record["elapsed"], restored=True)
+            return step.validated_params.copy()
+        start_time = time.time()
         try:
-            # if for-loop, assign new value
-            if self.for_loop:
-                self.log.info(f"for loop iteration {count}: {self.for_loop.var} = {iter_var}")
-                if self.for_loop.var in self.inputs_outputs:
-                    params[self.for_loop.var] = iter_var
+            # make a copy of the subst dict since subrecipes may modify
+            step_params = step.run(backend=backend_settings, subst=subst.copy(), parent_log=self.log)
+        except ScabhaBaseException as exc:
+            newexc = StimelaStepExecutionError(f"step '{step.fqname}' has failed, aborting the recipe", exc)
+            if not exc.logged:
+                log_exception(newexc, log=step.log)
+            raise newexc
+        journal.record(taskname, step_params, elapsed=time.time() - start_time)
+        return step_params
+
+    def _complete_step(
+        self,
+        label: str,
+        step: Step,
+        step_params: Dict[str, Any],
+        params: Dict[str, Any],
+        subst: SubstitutionNS,
+        outputs: Dict[str, Any],
+    ):
+        """Propagates the parameters of a step that has been run into the substitution namespace and recipe outputs"""
+        # put step parameters into previous and steps[label] again, as they may have changed based on
+        # outputs)
+        subst._add_("previous", step_params, nosubst=True)
+        subst.steps._add_(label, subst.previous, nosubst=True)
+        # revert to recipe level assignments
+
+        # now check for output aliases that need to be propagated down from steps
+        self.update_assignments(subst, whose=self, params=params)
+        for name, aliases in self._alias_list.items():
+            for alias in aliases:
+                if alias.from_step and alias.step is step:
+                    # if step was skipped, mark output as not required
+                    if alias.step._skip:
+                        self.outputs[name].required = False
+                    # if step output is validated, add it to our output
+                    # if alias.param in alias.step.validated_params:
+                    #     outputs[name] = alias.step.validated_params[alias.param]
+                    if alias.param in step_params:
+                        outputs[name] = step_params[alias.param]
+
+    def _get_parallel_jobs(self) -> int:
+        """Returns the number of steps that may be run concurrently, or 0 if steps are to be run sequentially"""
+        njobs = self.parallel if self.parallel is not None else self.config.opts.parallel_steps
+        if njobs < 0:
+            njobs = len(self.steps)
+        njobs = min(njobs, len(self.steps))
+        return njobs if njobs > 1 else 0
+
+    @staticmethod
+    def _get_step_paths(step: Step) -> Optional[Tuple[Set[str], Set[str]]]:
+        """Returns a tuple of sets of local paths read and written by a step, based on its file-type parameters.
+        Returns None if these can't be determined in advance (i.e. some of the file-type parameters are unresolved).
+        """
+        reads, writes = set(), set()
+        # explicitly skipped steps never touch their files
+        if step._skip is True:
+            return reads, writes
+        params = step.validated_params if step.validated_params is not None else step.params
+        for name, schema in step.inputs_outputs.items():
+            if not (schema.is_file_type or schema.is_file_list_type) or name not in params:
+                continue
+            value = params[name]
+            if isinstance(value, Unresolved) or (
+                isinstance(value, (list, tuple)) and any(isinstance(x, Unresolved) for x in value)
+            ):
+                return None
+            for path in get_filelikes(schema._dtype, value):
+                uri = URI(path)
+                if uri.remote:
+                    continue
+                path = os.path.abspath(uri.path)
+                if schema.is_input and not schema.writable:
+                    reads.add(path)
                 else:
-                    self.assign[self.for_loop.var] = iter_var
-                # update variable index
-                self.assign[f"{self.for_loop.var}@index"] = count
-                # update alias
-                self._update_aliases(self.for_loop.var, iter_var)
-                # update status display
-                status = None
-                status_dict = dict(
-                    index0=count,
-                    index1=count + 1,
-                    total=len(self._for_loop_values),
-                    var=self.for_loop.var,
-                    value=iter_var,
-                )
-                if self.for_loop.display_status:
-                    try:
-                        status = self.for_loop.display_status.format(**status_dict)
-                    except Exception as exc:
-                        self.log.warning(
-                            f"error formatting for-loop status: {exc}, falling back on default status display"
-                        )
-                if status is None:
-                    status = "{index1}/{total}".format(**status_dict)
-                task_stats.declare_subtask_status(status)
-                taskname = f"{taskname}.{count}"
-                subst.info.taskname = taskname
-                # task_stats.declare_subtask_attributes(count)
-                # task_attrs = (count,)
-                # NOTE(JSKenyon): This uses the default dummy_reporter i.e. won't update stats.
-                context = task_stats.declare_subtask(f"({count})")
+                    writes.add(path)
+        return reads, writes
+
+    def _get_step_dependencies(self) -> Dict[str, Set[str]]:
+        """Infers the set of (earlier) steps that each step depends on, for the purposes of running independent steps
+        concurrently.
+
+        A step depends on an earlier step if it refers to it via a {steps.X} or {previous} substitution (directly,
+        or via a recipe-level assignment or output alias), or if their file-type parameters overlap (i.e. one step
+        writes a path that the other reads or writes). Steps with their own assignments, and steps with file-type
+        parameters that can't be resolved in advance, are treated as barriers. The analysis is deliberately
+        conservative: anything it can't reason about is serialized.
+        """
+        labels = list(self.steps.keys())
+
+        def find_references(obj, refs: Set[str]):
+            """Adds labels of steps referred to by any string within obj to refs"""
+            if isinstance(obj, str):
+                for match in _STEP_REFERENCE.finditer(obj):
+                    steplabel, previous, varname = match.groups()
+                    if previous:
+                        refs.add(_PREVIOUS_STEP)
+                    elif steplabel in self.steps:
+                        refs.add(steplabel)
+                    elif varname in self.steps:
+                        refs.add(varname)
+                    elif varname in var_refs:
+                        refs.update(var_refs[varname])
+            elif isinstance(obj, Mapping):
+                for value in obj.values():
+                    find_references(value, refs)
+            elif isinstance(obj, (list, tuple, ListConfig)):
+                for value in obj:
+                    find_references(value, refs)
+            elif isinstance(obj, Step):
+                for section in (
+                    obj.params,
+                    obj.skip,
+                    obj.assign,
+                    obj.assign_based_on,
+                    obj.backend,
+                    obj.preamble,
+                    obj.epilogue,
+                ):
+                    find_references(section, refs)
+                if isinstance(obj.cargo, Recipe):
+                    for section in (obj.cargo.assign, obj.cargo.assign_based_on, obj.cargo.steps):
+                        find_references(section, refs)
+                    if obj.cargo.for_loop is not None:
+                        find_references(obj.cargo.for_loop.output_elements, refs)
+
+        # map recipe-level variables to the steps they refer to. Output aliases refer to their source step.
+        var_refs = {}
+        for name, aliases in self._alias_list.items():
+            for alias in aliases:
+                if alias.io is self.outputs:
+                    var_refs.setdefault(name, set()).add(alias.label)
+        assignments = [self.assign] + list(self.assign_based_on.values())
+        for _ in range(2):  # second pass picks up variables that refer to other variables
+            for assignment in assignments:
+                for name, value in assignment.items():
+                    refs = var_refs.setdefault(name.split(".", 1)[0], set())
+                    find_references(value, refs)
+
+        dependencies = OrderedDict()
+        paths = OrderedDict()
+        barrier = None
+        for num, (label, step) in enumerate(self.steps.items()):
+            refs = set()
+            find_references(step, refs)
+            if _PREVIOUS_STEP in refs:
+                refs.discard(_PREVIOUS_STEP)
+                if num:
+                    refs.add(labels[num - 1])
+            deps = dependencies[label] = set(ref for ref in refs if ref in self.steps and ref != label)
+            paths[label] = self._get_step_paths(step)
+            is_barrier = bool(step.assign or step.assign_based_on) or paths[label] is None
+            if is_barrier:
+                deps.update(labels[:num])
+            elif barrier is not None:
+                deps.add(barrier)
+            if not is_barrier:
+                reads, writes = paths[label]
+                for other in labels[:num]:
+                    if paths[other] is None:
+                        continue
+                    other_reads, other_writes = paths[other]
+                    if _paths_overlap(other_writes, reads | writes) or _paths_overlap(other_reads, writes):
+                        deps.add(other)
             else:
-                from contextlib import nullcontext
-
-                context = nullcontext()
-            with context:
-                for label, step in self.steps.items():
-                    # update step info
-                    self._prep_step(label, step, subst)
-                    subst.info.taskname = f"{taskname}.{label}"
-                    # reevaluate recipe level assignments (info.fqname etc. have changed)
-                    self.update_assignments(subst, params=params)
-                    # evaluate step-level assignments
-                    self.update_assignments(subst, whose=step, params=params)
-                    # step logger may have changed
-                    stimelogging.update_file_logger(
-                        step.log, step.logopts, nesting=step.nesting, subst=subst, location=[step.fqname]
+                barrier = label
+            self.log.debug(f"step '{label}' depends on {', '.join(sorted(deps)) or 'no other steps'}")
+        return dependencies
+
+    @staticmethod
+    def _snapshot_subst(subst: SubstitutionNS) -> SubstitutionNS:
+        """Returns a copy of the substitution namespace that is insulated from subsequent in-place changes to its
+        info, steps and recipe sub-namespaces (which are updated as further steps are dispatched)
+        """
+        snapshot = subst.copy()
+        snapshot._add_("info", OrderedDict(subst.info), nosubst=True)
+        snapshot.self = snapshot.info
+        snapshot._add_("steps", OrderedDict(subst.steps), nosubst=True)
+        recipe = SubstitutionNS(_name_=subst.recipe._name_, **subst.recipe)
+        recipe._add_("steps", snapshot.steps, nosubst=True)
+        snapshot._add_("recipe", recipe)
+        return snapshot
+
+    @staticmethod
+    def _run_step_worker(step: Step, subst: SubstitutionNS, backend_settings: Dict, parent_log: logging.Logger):
+        """
+        Runs a single step in a worker process. Needed for concurrency
+        """
+        step_params = exception = tb = None
+        # stream log messages to the parent process as they happen
+        with worker_pool.stream_console(f"[{step.fqname}]"):
+            try:
+                # file loggers are not inherited in a useful state, so set them up again
+                stimelogging.update_file_logger(
+                    step.log, step.logopts, nesting=step.nesting, subst=subst, location=[step.fqname]
+                )
+                start_time = time.time()
+                step_params = step.run(backend=backend_settings, subst=subst, parent_log=parent_log)
+                journal.record(subst.info.taskname, step_params, elapsed=time.time() - start_time)
+            except ScabhaBaseException as exc:
+                exception = StimelaStepExecutionError(f"step '{step.fqname}' has failed, aborting the recipe", exc)
+                if not exc.logged:
+                    log_exception(exception, log=step.log)
+            except Exception as exc:
+                exception = exc
+                tb = FormattedTraceback(sys.exc_info()[2])
+
+        return step_params, task_stats.collect_stats(), exception, tb
+
+    def _run_steps_concurrently(
+        self,
+        params: Dict[str, Any],
+        subst: SubstitutionNS,
+        backend_settings: Dict,
+        taskname: str,
+        outputs: Dict[str, Any],
+        njobs: int,
+    ):
+        """Runs the recipe's steps using a pool of up to njobs worker processes. A step is dispatched to the pool
+        as soon as all the steps it depends on have completed.
+        """
+        dependencies = self._get_step_dependencies()
+        labels = list(self.steps.keys())
+        pending = list(labels)
+        results = OrderedDict()  # step label -> step params, for completed steps
+        running = {}  # future -> step label
+        errors = []
+        nfail = 0
+        # the session-wide worker pool is shared with scattered loops
+        with worker_pool.pool_session(njobs) as (pool, njobs), worker_pool.worker_tokens() as tokens:
+            while running or (pending and not errors):
+                # dispatch steps whose dependencies have completed, in recipe order
+                held_back = False
+                for label in list(pending):
+                    if errors or len(running) >= njobs:
+                        break
+                    if not dependencies[label].issubset(results):
+                        continue
+                    # steps that are skipped or restored below don't need a token, but that isn't known yet
+                    if not tokens.acquire(len(running)):
+                        held_back = True
+                        break
+                    pending.remove(label)
+                    step = self.steps[label]
+                    # "previous" always refers to the preceding step, regardless of completion order
+                    num = labels.index(label)
+                    if num and labels[num - 1] in results:
+                        subst._add_("previous", results[labels[num - 1]], nosubst=True)
+                    self._prepare_step(label, step, params, subst, taskname)
+                    # explicitly skipped steps are trivial, and steps completed by a resumed run are restored from
+                    # its journal, so run them directly
+                    if step.skip is True or journal.lookup(subst.info.taskname) is not None:
+                        tokens.release(len(running))
+                        results[label] = self._run_step(step, subst, backend_settings)
+                        self._complete_step(label, step, results[label], params, subst, outputs)
+                        continue
+                    future = worker_pool.submit(
+                        pool, Recipe._run_step_worker, step, self._snapshot_subst(subst), backend_settings, self.log
                     )
-                    # set our info back temporarily to update log assignments
+                    running[future] = label
+                    task_stats.declare_subtask_status(f"{len(running)} steps running")
 
-                    ## OMS: note to self, I had this here but not sure why. Seems like a no-op. Something with logname
-                    ## fiddling.
-                    ## Leave as a puzzle to future self for a bit. Remove info from args.
-                    # info_step = subst.info
-                    # subst.info = info.copy()
-                    # subst.info = info_step
+                if not running:
+                    continue
 
-                    if step.skip is True:
-                        self.log.debug(f"step '{label}' will be explicitly skipped")
+                # while held back by the worker budget, recheck it periodically, as tokens may be freed elsewhere
+                timeout = worker_pool.BUDGET_POLL_INTERVAL if held_back else None
+                done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    label = running.pop(future)
+                    tokens.release(len(running))
+                    step = self.steps[label]
+                    step_params, stats, exc, tb = future.result()
+                    task_stats.add_missing_stats(stats)
+                    if exc is not None:
+                        errors.append(exc)
+                        if tb is not None:
+                            errors.append(tb)
+                        nfail += 1
                     else:
-                        self.log.info(f"processing step '{label}'")
-                        if step.info:
-                            self.log.info(f"  ({step.info})", extra=dict(color="GREEN", boldface=True))
-                    try:
-                        # make a copy of the subst dict since subrecipes may modify
-                        step_params = step.run(backend=backend_settings, subst=subst.copy(), parent_log=self.log)
-                    except ScabhaBaseException as exc:
-                        newexc = StimelaStepExecutionError(f"step '{step.fqname}' has failed, aborting the recipe", exc)
-                        if not exc.logged:
-                            log_exception(newexc, log=step.log)
-                        raise newexc
-
-                    # put step parameters into previous and steps[label] again, as they may have changed based on
-                    # outputs)
-                    subst._add_("previous", step_params, nosubst=True)
-                    subst.steps._add_(label, subst.previous, nosubst=True)
-                    # revert to recipe level assignments
-
-                    # now check for output aliases that need to be propagated down from steps
-                    self.update_assignments(subst, whose=self, params=params)
-                    for name, aliases in self._alias_list.items():
-                        for alias in aliases:
-                            if alias.from_step and alias.step is step:
-                                # if step was skipped, mark output as not required
-                                if alias.step._skip:
-                                    self.outputs[name].required = False
-                                # if step output is validated, add it to our output
-                                # if alias.param in alias.step.validated_params:
-                                #     outputs[name] = alias.step.validated_params[alias.param]
-                                if alias.param in step_params:
-                                    outputs[name] = step_params[alias.param]
-
-                # evaluate output_elements expressions for this iteration
-                output_elements = {}
-                if self.for_loop and self.for_loop.output_elements:
-                    for elem_name, expr in self.for_loop.output_elements.items():
-                        value = evaluate_and_substitute_object(
-                            expr,
-                            subst,
-                            recursion_level=-1,
-                            location=[self.fqname, "for_loop", "output_elements", elem_name],
-                            log=self.log,
-                        )
-                        output_elements[elem_name] = value
+                        step.validated_params.update(**step_params)
+                        results[label] = step_params
+                        self._complete_step(label, step, step_params, params, subst, outputs)
 
-        except Exception as exc:
-            # raise exception up if asked to
-            if raise_exc:
-                raise
-            # else will be returned
-            exception = exc
-            tb = FormattedTraceback(sys.exc_info()[2])
-        finally:
-            if subprocess:
-                subprocess_logs = rich_console.file.getvalue()
-            else:
-                subprocess_logs = None
+        if errors:
+            if len(errors) == 1:
+                raise errors[0]
+            raise StimelaRuntimeError(f"{nfail} concurrently running step(s) have failed", errors)
+
+    @staticmethod
+    def _iteration_subst(subst: SubstitutionNS) -> SubstitutionNS:
+        """Returns the substitution namespace for a loop iteration. This is a shallow copy of subst that shares its
+        sub-namespaces, except for info (and self), which the iteration updates in place. Iterations only replace
+        top-level entries of their namespace, so these copies are made lazily, one iteration at a time, rather than
+        for the whole loop up front.
+        """
+        iter_subst = subst.copy()
+        iter_subst.info = subst.info.copy()
+        iter_subst.self = iter_subst.info
+        return iter_subst
+
+    @staticmethod
+    def _scatter_loop_worker(
+        shared_state: bytes, chunk: List[Tuple[int, Any]], isolation_tag: Optional[str] = None
+    ) -> Tuple[List[Tuple], List[Dict[str, str]], Dict]:
+        """Runs a chunk of scattered loop iterations in a worker process or thread. The shared state is the serialized
+        recipe, parameters, substitution namespace and backend settings, as pickled once for all iterations by _run().
+        Iterations within a chunk are run one after the other, as in a non-scattered loop. If the task is cancelled,
+        the remaining iterations are not run.
+
+        If isolation_tag is set, this is a speculative copy of the chunk, and file outputs are written to temporary
+        paths (see speculation.isolate_outputs()).
+
+        Returns:
+            Tuple[List[Tuple], List[Dict[str, str]], Dict]: list of _iterate_loop_worker() results, list of
+            temporary paths of outputs of each iteration, and task stats of the whole chunk
+        """
+        recipe, params, subst, backend_settings = pickle.loads(shared_state)
+        subprocess_id = task_stats.get_subprocess_id()
+        results = []
+        redirects = []
+        for count, iter_var in chunk:
+            if worker_pool.task_cancelled():
+                break
+            with speculation.isolate_outputs(isolation_tag) as iter_redirects:
+                results.append(
+                    recipe._iterate_loop_worker(
+                        params,
+                        Recipe._iteration_subst(subst),
+                        backend_settings,
+                        count,
+                        iter_var,
+                        subprocess=True,
+                        raise_exc=False,
+                    )
+                )
+            redirects.append(iter_redirects)
+            # each iteration appends its count to the subprocess ID, so reset it for the next one
+            task_stats.set_subprocess_id(subprocess_id)
+        return results, redirects, task_stats.collect_stats()
+
+    def _iterate_loop_worker(self, params, subst, backend_settings, count, iter_var, subprocess=False, raise_exc=True):
+        """ "
+        Needed for concurrency
+        """
+        if subprocess:
+            task_stats.add_subprocess_id(count)
+            # When running in a processpool, stream log messages to the parent process.
+            stream = worker_pool.stream_console(f"[{self.fqname}.{count}]")
+        else:
+            stream = nullcontext()
+        with stream:
+            subst.info.subprocess = task_stats.get_subprocess_id()
+            taskname = subst.info.taskname
+            outputs = {}
+            output_elements = {}
+            exception = tb = None
+            task_attrs, task_kwattrs = (), {}
+            start_time = time.time()
+            try:
+                # if for-loop, assign new value
+                if self.for_loop:
+                    assignments = self._loop_var_assignments(count, iter_var)
+                    values = ", ".join(f"{var} = {value}" for var, value, _ in assignments)
+                    self.log.info(f"for loop iteration {count}: {values}")
+                    for var, value, index in assignments:
+                        if var in self.inputs_outputs:
+                            params[var] = value
+                        else:
+                            self.assign[var] = value
+                        # update variable index
+                        self.assign[f"{var}@index"] = index
+                        # update alias
+                        self._update_aliases(var, value)
+                    # update status display
+                    status = None
+                    status_dict = {var: value for var, value, _ in assignments}
+                    status_dict.update(
+                        index0=count,
+                        index1=count + 1,
+                        total=len(self._for_loop_values),
+                        var=", ".join(self._for_loop_vars),
+                        value=iter_var,
+                    )
+                    if self.for_loop.display_status:
+                        try:
+                            status = self.for_loop.display_status.format(**status_dict)
+                        except Exception as exc:
+                            self.log.warning(
+                                f"error formatting for-loop status: {exc}, falling back on default status display"
+                            )
+                    if status is None:
+                        status = "{index1}/{total}".format(**status_dict)
+                    task_stats.declare_subtask_status(status)
+                    taskname = f"{taskname}.{count}"
+                    subst.info.taskname = taskname
+                    # task_stats.declare_subtask_attributes(count)
+                    # task_attrs = (count,)
+                    # NOTE(JSKenyon): This uses the default dummy_reporter i.e. won't update stats.
+                    context = task_stats.declare_subtask(f"({count})")
+                else:
+                    context = nullcontext()
+                with context:
+                    njobs = self._get_parallel_jobs()
+                    if njobs:
+                        self._run_steps_concurrently(params, subst, backend_settings, taskname, outputs, njobs)
+                    else:
+                        for label, step in self.steps.items():
+                            if worker_pool.task_cancelled():
+                                raise StimelaRuntimeError("iteration cancelled")
+                            self._prepare_step(label, step, params, subst, taskname)
+                            step_params = self._run_step(step, subst, backend_settings)
+                            self._complete_step(label, step, step_params, params, subst, outputs)
+
+                    # evaluate output_elements expressions for this iteration
+                    output_elements = {}
+                    if self.for_loop and self.for_loop.output_elements:
+                        for elem_name, expr in self.for_loop.output_elements.items():
+                            value = evaluate_and_substitute_object(
+                                expr,
+                                subst,
+                                recursion_level=-1,
+                                location=[self.fqname, "for_loop", "output_elements", elem_name],
+                                log=self.log,
+                            )
+                            output_elements[elem_name] = value
+
+                # keep track of iteration durations, if they're needed to order subsequent runs
+                if self.for_loop and self.for_loop.longest_first:
+                    durations.get_history().record(self.fqname, iter_var, time.time() - start_time)
+                # outputs of speculative copies are cached once they're committed, under their final names
+                if self._loop_cache_key is not None and not speculation.is_isolating():
+                    loop_cache.store(self, self._loop_cache_key, iter_var, params, outputs, output_elements, self.log)
+
+            except Exception as exc:
+                # raise exception up if asked to
+                if raise_exc:
+                    raise
+                # else will be returned
+                exception = exc
+                tb = FormattedTraceback(sys.exc_info()[2])
 
         return (
             task_attrs,
             task_kwattrs,
-            task_stats.collect_stats(),
             outputs,
             exception,
             tb,
-            subprocess_logs,
             count,
             output_elements,
         )
@@ -1254,6 +1865,16 @@ class Recipe(Cargo):
         Returns:
             Dict[str, Any]: Dictionary of outputs
         """
+        # the loop's element gatherer (and its spill file) is released even if the recipe fails
+        with ExitStack() as stack:
+            return self._run_recipe(params, subst, backend, stack)
+
+    def _run_recipe(
+        self, params: Dict[str, Any], subst: SubstitutionNS, backend: Dict, stack: ExitStack
+    ) -> Dict[str, Any]:
+        """Runs the recipe on behalf of _run(). Resources that need releasing once the recipe is done, successfully
+        or not, are entered into the given exit stack.
+        """
         # set up backend
         backend = OmegaConf.merge(backend, self.backend or {})
 
@@ -1289,41 +1910,49 @@ class Recipe(Cargo):
                 if isinstance(value, Unresolved) and not isinstance(value, Placeholder):
                     raise RecipeValidationError(f"recipe '{self.name}' has unresolved input '{name}'", log=self.log)
                 self._update_aliases(name, value)
-            elif schema.required and (self.for_loop is None or name != self.for_loop.var):
+            elif schema.required and name not in self._for_loop_vars:
                 raise RecipeValidationError(f"recipe '{self.name}' is missing required input '{name}'", log=self.log)
 
-        # form list of arguments for each invocation of the loop worker
-        loop_worker_args = []
-        for count, iter_var in enumerate(self._for_loop_values):
-            # pass in a copy of subst and subst.info+self, since they mutate in the iteration
-            subst_copy = subst.copy()
-            subst_copy.info = subst.info.copy()
-            subst_copy.self = subst_copy.info
-            loop_worker_args.append((params, subst_copy, backend, count, iter_var))
-
         final_iter_outputs = {}
-        nloop = len(loop_worker_args)
+        nloop = len(self._for_loop_values)
+        gatherer = None
+
+        # restore outputs of iterations that have been run before with identical parameters and inputs
+        cached_iters = {}
+        self._loop_cache_key = None
+        if nloop and self.for_loop and self.for_loop.cache:
+            if stimela.CONFIG.opts.disable_skips.cached:
+                self.log.info("ignoring for_loop.cache because it has been force-disabled")
+            else:
+                self._loop_cache_key = loop_cache.get_loop_key(self, params)
+                for count, iter_var in enumerate(self._for_loop_values):
+                    cached = loop_cache.lookup(self, self._loop_cache_key, iter_var, params, self.log)
+                    if cached is not None:
+                        self.log.debug(f"for loop iteration {count}: restored from the loop cache")
+                        cached_iters[count] = cached
+                self.log.info(f"{len(cached_iters)}/{nloop} iterations restored from the loop cache")
 
         # skip the trivial case
         if not nloop:
             self.log.info("this recipe is an empty for-loop: time for masterful inactivity")
-        # if scatter is enabled, use a process pool
-        elif self._for_loop_scatter:
+        # if scatter is enabled, use a process pool (unless all iterations were restored from the cache)
+        elif self._for_loop_scatter and len(cached_iters) < nloop:
             self.log.info(
                 f"[yellow]Scattering recipe {self.fqname} - terminal logs "
-                f"will appear on the completion of a scattered step. Log "
-                f"files will be updated in real time.[/yellow]"
+                f"of each iteration will appear prefixed by the iteration name.[/yellow]"
             )
 
-            accumulated_elements = (
-                {name: [None] * nloop for name in self.for_loop.output_elements}
-                if self.for_loop and self.for_loop.output_elements
-                else {}
-            )
+            gatherer = stack.enter_context(ElementGatherer(self, nloop, subst, self.log))
+            for count, (outputs, iter_elements) in cached_iters.items():
+                if count == nloop - 1:
+                    final_iter_outputs = outputs
+                gatherer.add(count, self._for_loop_values[count], iter_elements)
+            # iterations that need to be run
+            todo = [count for count in range(nloop) if count not in cached_iters]
             if self._for_loop_scatter < 0:
-                num_workers = nloop
+                num_workers = len(todo)
             else:
-                num_workers = min(self._for_loop_scatter, nloop)
+                num_workers = min(self._for_loop_scatter, len(todo))
 
             # NOTE(JSKenyon): We don't actually have the runner at this point so dynamically
             # changing the display based on the backend is problematic. The loop being run may
@@ -1343,87 +1972,364 @@ class Recipe(Cargo):
             # As noted above, use simpler slurm display when scattering with kube backend.
             display_style = "slurm" if display_style == "kube" else display_style
 
-            # If the display is disabled at this point, it implies that we
-            # should leave it that way (may be in a child process).
-            pause_display = display.is_enabled
-            # Disable display during pool creation so that it isn't
-            # enabled in the resulting processes.
-            if pause_display:
-                display.disable(reset_cursor=True)
-            with ProcessPoolExecutor(num_workers) as pool:
-                # submit each iterant to pool
-                futures = []
-                for args in loop_worker_args:
-                    future = pool.submit(self._iterate_loop_worker, *args, subprocess=True, raise_exc=False)
-                    futures.append(future)
-
-                # Re-enable display after pool creation.
-                if pause_display:
+            # Iterations under a remote backend mostly wait on it, so they can be run in threads. The same caveat
+            # applies: this is decided by the backend config at the recipe level.
+            scatter_mode = self._for_loop_scatter_mode
+            if scatter_mode == "auto":
+                backend_module = backends.get_backend(
+                    backend_opts.current_backend, getattr(backend_opts, backend_opts.current_backend, None)
+                )
+                is_remote = backend_opts.current_wrapper is not None or (
+                    backend_module is not None and backend_module.is_remote()
+                )
+                scatter_mode = "threads" if is_remote else "processes"
+            if scatter_mode == "threads":
+                self.log.info("scattering over worker threads")
+                session = worker_pool.thread_pool_session(num_workers)
+            else:
+                # the session-wide worker pool is shared by all scattered loops
+                session = worker_pool.pool_session(num_workers)
+
+            # the worker budget is shared by all scattered loops, including nested ones
+            with session as (pool, num_workers), worker_pool.worker_tokens() as tokens:
+                # The recipe, parameters and namespace are the same for every iteration, so serialize them once,
+                # rather than once per submitted iteration. Each worker (process or thread) unpickles a private copy
+                # to iterate on.
+                shared_state = bytes(ForkingPickler.dumps((self, params, self._iteration_subst(subst), backend)))
+                # iterations are sent to workers in chunks, by default one iteration at a time
+                chunk_size = self._for_loop_chunk_size or -(-len(todo) // (num_workers * AUTO_CHUNKS_PER_WORKER))
+                if chunk_size > 1:
+                    self.log.info(f"scattering in chunks of up to {chunk_size} iterations")
+                if self.for_loop.longest_first:
+                    values = [self._for_loop_values[count] for count in todo]
+                    todo = [todo[index] for index in durations.longest_first(self.fqname, values, log=self.log)]
+                pending_iters = ((count, self._for_loop_values[count]) for count in todo)
+                pending_chunk = None
+                # set if pending_chunk is a retry
+                pending_retry = False
+                # set once all iterations have been taken from pending_iters
+                all_submitted = False
+                futures = set()
+                # if resources are declared, start iterations only while resources are available
+                if self.for_loop.resources:
+                    admission = AdmissionControl(self.for_loop.resources, self.log)
+                else:
+                    admission = None
+                # heap of (time due, count, value) of iterations waiting to be retried
+                retry_queue = []
+                # number of failed attempts per iteration
+                attempts = {}
+                # set while iterations are held back by the worker budget
+                budget_held = False
+                # speculative re-execution of stragglers needs outputs of iterations to be isolated
+                speculate = self.for_loop.speculate
+                if speculate:
+                    reason = speculation.check_isolation(self)
+                    if reason:
+                        self.log.warning(
+                            f"outputs of iterations can't be isolated ({reason}), disabling speculative re-execution"
+                        )
+                        speculate = 0
+                if speculate:
+                    # tasks are cancelled by creating files in this directory
+                    cancel_dir = tempfile.mkdtemp(prefix="stimela-cancel-")
+                    task_ids = itertools.count()
+                # chunk, start time and cancellation path of each future in flight
+                running = {}
+                # per-iteration durations of completed chunks, used to spot stragglers
+                chunk_durations = []
+                # original and speculative futures of straggling chunks -> shared record of their state
+                twins = {}
+
+                # one-off executors running retries, by future
+                fresh_executors = {}
+
+                def shutdown_fresh_executors():
+                    for executor in fresh_executors.values():
+                        executor.shutdown(cancel_futures=True)
+
+                stack.callback(shutdown_fresh_executors)
+
+                def submit_chunk(chunk, isolation_tag=None, fresh=False):
+                    cancel_path = os.path.join(cancel_dir, str(next(task_ids))) if speculate else None
+                    # retries go to a fresh worker, since the failed attempt may have left its worker in a bad state
+                    executor = worker_pool.fresh_executor(pool) if fresh else pool
+                    try:
+                        future = worker_pool.submit_cancellable(
+                            executor, cancel_path, Recipe._scatter_loop_worker, shared_state, chunk, isolation_tag
+                        )
+                    except BrokenProcessPool as exc:
+                        # once a worker has died, the pool fails the remaining chunks as it did the running ones
+                        future = Future()
+                        future.set_exception(exc)
+                    if fresh:
+                        fresh_executors[future] = executor
+                    futures.add(future)
+                    running[future] = chunk, time.time(), cancel_path
+                    return future
+
+                # submit chunks of iterants to the pool, keeping at most num_workers in flight
+                def submit_more():
+                    nonlocal pending_chunk, pending_retry, all_submitted, budget_held
+                    budget_held = False
+                    while len(futures) < num_workers:
+                        if pending_chunk is None:
+                            # retries that are due go first, one iteration at a time
+                            pending_retry = bool(retry_queue) and retry_queue[0][0] <= time.time()
+                            if pending_retry:
+                                _, count, iter_var = heapq.heappop(retry_queue)
+                                pending_chunk = [(count, iter_var)]
+                            else:
+                                pending_chunk = list(itertools.islice(pending_iters, chunk_size))
+                                all_submitted = not pending_chunk
+                        if not pending_chunk:
+                            pending_chunk = None
+                            break
+                        if admission and not admission.admit(len(futures)):
+                            break
+                        if not tokens.acquire(len(futures)):
+                            budget_held = True
+                            break
+                        submit_chunk(pending_chunk, fresh=pending_retry)
+                        pending_chunk = None
+
+                # once there's nothing else left to submit, start speculative copies of stragglers on idle workers
+                def speculate_more():
+                    if not speculate or not all_submitted or pending_chunk or retry_queue or not chunk_durations:
+                        return
+                    if ncomplete < SPECULATE_AFTER_FRACTION * nloop:
+                        return
+                    median = statistics.median(chunk_durations)
+                    now = time.time()
+                    stragglers = [
+                        future
+                        for future, (chunk, start_time, _) in running.items()
+                        if future not in twins and now - start_time > speculate * median * len(chunk)
+                    ]
+                    # longest-running first
+                    stragglers.sort(key=lambda future: running[future][1])
+                    for future in stragglers:
+                        if len(futures) >= num_workers or (admission and not admission.admit(len(futures))):
+                            break
+                        if not tokens.acquire(len(futures)):
+                            break
+                        chunk, start_time, _ = running[future]
+                        self.log.info(
+                            f"iteration(s) {', '.join(str(count) for count, _ in chunk)} running for "
+                            f"{now - start_time:.0f}s, over {speculate:g}x the median of {median * len(chunk):.1f}s, "
+                            f"starting a speculative copy"
+                        )
+                        duplicate = submit_chunk(chunk, isolation_tag=f"stimela-speculative{next(task_ids)}")
+                        twins[future] = twins[duplicate] = dict(
+                            original=future, duplicate=duplicate, results={}, decided=False, processed=False
+                        )
+
+                submit_more()
+
+                # If the display is disabled at this point, it implies that we
+                # should leave it that way (may be in a child process).
+                if display.is_enabled:
                     display.set_display_style(display_style)
-                    display.enable()
                 # Set status on scatter subtask once display is re-enabled.
                 task_stats.declare_subtask_status(f"0/{nloop} complete, {num_workers} workers")
 
                 # Start a thread to monitor resource usage.
                 monitor = task_stats.MonitorThread()
                 monitor.start()
+                # the thread must be stopped even if the loop fails, else it keeps the process from exiting
+                stack.callback(monitor.stop)
 
                 # update task stats, since they're recorded independently
                 # within each step, as well as get any exceptions from the
                 # nested steps/recipes.
                 errors = []
-                nfail = ncomplete = 0
-                for f in as_completed(futures):
-                    attrs, kwattrs, stats, outputs, exc, tb, subprocess_logs, iter_count, iter_elements = f.result()
-                    # save outputs from final iteration
-                    if iter_count == nloop - 1:
-                        final_iter_outputs = outputs
-                    # Print the logs associated with the completed future.
-                    # These are already timestamped by the child process.
-                    rich_console.print(subprocess_logs, soft_wrap=True)
-                    task_stats.declare_subtask_attributes(*attrs, **kwattrs)
-                    task_stats.add_missing_stats(stats)
-                    if exc is not None:
-                        errors.append(exc)
-                        if not isinstance(exc, ScabhaBaseException):
-                            errors.append(tb)
-                        nfail += 1
-                    else:
-                        ncomplete += 1
-                        for name, value in iter_elements.items():
-                            accumulated_elements[name][iter_count] = value
-                    if ncomplete:
-                        status = f"[green]{ncomplete}[/green]/{nloop} complete"
+                failed = []
+                nfail = 0
+                ncomplete = len(cached_iters)
+
+                def process_results(chunk_results):
+                    nonlocal final_iter_outputs, nfail, ncomplete
+                    for attrs, kwattrs, outputs, exc, tb, iter_count, iter_elements in chunk_results:
+                        # save outputs from final iteration
+                        if iter_count == nloop - 1:
+                            final_iter_outputs = outputs
+                        task_stats.declare_subtask_attributes(*attrs, **kwattrs)
+                        if exc is not None:
+                            nattempts = attempts[iter_count] = attempts.get(iter_count, 0) + 1
+                            if nattempts <= self.for_loop.retries:
+                                delay = self.for_loop.retry_backoff * 2 ** (nattempts - 1)
+                                self.log.warning(
+                                    f"iteration {iter_count} has failed, retrying in {delay:g}s "
+                                    f"(retry {nattempts}/{self.for_loop.retries})"
+                                )
+                                iter_var = self._for_loop_values[iter_count]
+                                heapq.heappush(retry_queue, (time.time() + delay, iter_count, iter_var))
+                                continue
+                            errors.append(exc)
+                            if not isinstance(exc, ScabhaBaseException):
+                                errors.append(tb)
+                            failed.append(iter_count)
+                            nfail += 1
+                        else:
+                            ncomplete += 1
+                            gatherer.add(iter_count, self._for_loop_values[iter_count], iter_elements)
+
+                # Called as each copy of a straggling chunk completes. The first copy to succeed wins, and the other
+                # is cancelled. If the original wins, its results are used straight away. Otherwise, results are
+                # merged once both are done (so that the original can't overwrite any outputs after they're
+                # committed): each iteration uses the original's result if it succeeded, else the speculative one's.
+                def complete_twin(future, chunk, chunk_results, redirects, succeeded):
+                    twin = twins[future]
+                    twin["results"][future] = chunk_results, redirects
+                    original, duplicate = twin["original"], twin["duplicate"]
+                    other = duplicate if future is original else original
+                    if other not in twin["results"]:
+                        if succeeded and not twin["decided"]:
+                            twin["decided"] = True
+                            winner = "original" if future is original else "speculative"
+                            self.log.info(
+                                f"iteration(s) {', '.join(str(count) for count, _ in chunk)} completed by the "
+                                f"{winner} copy, cancelling the other one"
+                            )
+                            worker_pool.cancel_task(running[other][2])
+                            if future is original:
+                                twin["processed"] = True
+                                process_results(chunk_results)
+                        return
+                    del twins[original], twins[duplicate]
+                    original_results, _ = twin["results"][original]
+                    duplicate_results, duplicate_redirects = twin["results"][duplicate]
+                    if twin["processed"]:
+                        for iter_redirects in duplicate_redirects:
+                            speculation.discard(iter_redirects)
+                        return
+                    original_results = {result[5]: result for result in original_results}
+                    duplicate_results = {
+                        result[5]: (result, iter_redirects)
+                        for result, iter_redirects in zip(duplicate_results, duplicate_redirects)
+                    }
+                    merged = []
+                    for count, _ in chunk:
+                        result = original_results.get(count)
+                        duplicate_result, iter_redirects = duplicate_results.get(count, (None, {}))
+                        original_ok = result is not None and result[3] is None
+                        duplicate_ok = duplicate_result is not None and duplicate_result[3] is None
+                        if duplicate_ok and not original_ok:
+                            speculation.commit(iter_redirects)
+                            attrs, kwattrs, outputs, exc, tb, _, iter_elements = duplicate_result
+                            outputs = speculation.restore_values(outputs, iter_redirects)
+                            iter_elements = speculation.restore_values(iter_elements, iter_redirects)
+                            if self._loop_cache_key is not None:
+                                iter_var = self._for_loop_values[count]
+                                loop_cache.store(
+                                    self, self._loop_cache_key, iter_var, params, outputs, iter_elements, self.log
+                                )
+                            result = attrs, kwattrs, outputs, exc, tb, count, iter_elements
+                        else:
+                            speculation.discard(iter_redirects)
+                            result = result or duplicate_result
+                        if result is not None:
+                            merged.append(result)
+                    process_results(merged)
+
+                while futures or retry_queue:
+                    # if iterations are being held back, recheck resources periodically
+                    timeout = admission.poll_interval if admission and pending_chunk else None
+                    # likewise, if they're held back by the worker budget, recheck it periodically
+                    if budget_held:
+                        poll = worker_pool.BUDGET_POLL_INTERVAL
+                        timeout = poll if timeout is None else min(timeout, poll)
+                    # if retries are waiting, wake up when the next one is due
+                    if retry_queue:
+                        retry_wait = max(retry_queue[0][0] - time.time(), 0)
+                        timeout = retry_wait if timeout is None else min(timeout, retry_wait)
+                    # if workers are idle, check for stragglers periodically
+                    if speculate and all_submitted and len(futures) < num_workers:
+                        timeout = SPECULATE_POLL_INTERVAL if timeout is None else min(timeout, SPECULATE_POLL_INTERVAL)
+                    if futures:
+                        done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+                        futures.difference_update(done)
+                        tokens.release(len(futures))
                     else:
-                        status = f"0/{nloop} complete"
-                    if nfail:
-                        status = f"{status}, [red]{nfail}[/red] failed"
-                    status = f"{status}, {num_workers} workers"
-                    task_stats.declare_subtask_status(status)
+                        done = ()
+                        time.sleep(timeout)
+                    # keep the pool busy
+                    submit_more()
+                    for f in done:
+                        chunk, start_time, _ = running.pop(f)
+                        if f in fresh_executors:
+                            fresh_executors.pop(f).shutdown()
+                        try:
+                            chunk_results, redirects, stats = f.result()
+                        except BrokenProcessPool as exc:
+                            # the worker process running the chunk (or another one) has died, e.g. killed by the OOM
+                            # killer, which fails the chunk's iterations (and breaks the pool for the rest of the loop)
+                            died = StimelaRuntimeError("worker process has died", exc)
+                            chunk_results = [((), {}, {}, died, None, count, {}) for count, _ in chunk]
+                            redirects, stats = [{}] * len(chunk), {}
+                        task_stats.add_missing_stats(stats)
+                        succeeded = len(chunk_results) == len(chunk) and all(
+                            result[3] is None for result in chunk_results
+                        )
+                        if f in twins:
+                            complete_twin(f, chunk, chunk_results, redirects, succeeded)
+                            continue
+                        if succeeded:
+                            chunk_durations.append((time.time() - start_time) / len(chunk))
+                        process_results(chunk_results)
+                    if done:
+                        if ncomplete:
+                            status = f"[green]{ncomplete}[/green]/{nloop} complete"
+                        else:
+                            status = f"0/{nloop} complete"
+                        if nfail:
+                            status = f"{status}, [red]{nfail}[/red] failed"
+                        status = f"{status}, {num_workers} workers"
+                        task_stats.declare_subtask_status(status)
+                    speculate_more()
 
                 monitor.stop()  # Stop monitoring resource usage.
+                if speculate:
+                    shutil.rmtree(cancel_dir, ignore_errors=True)
 
                 if errors:
-                    pool.shutdown()
-                    raise StimelaRuntimeError(f"{nfail}/{nloop} jobs have failed", errors)
+                    allow_failures = self.for_loop.allow_failures
+                    if allow_failures < 1:
+                        allow_failures *= nloop
+                    if nfail > allow_failures:
+                        raise StimelaRuntimeError(f"{nfail}/{nloop} jobs have failed", errors)
+                    log_exception(
+                        StimelaRuntimeError(
+                            f"{nfail}/{nloop} jobs have failed, but up to {allow_failures:g} failures are allowed",
+                            errors,
+                        ),
+                        severity="warning",
+                        log=self.log,
+                    )
+                    # gathered outputs leave out the failed iterations, while outputs that would have come from
+                    # the last iteration are marked as skipped (as for outputs of skipped steps)
+                    gatherer.mark_failed(failed)
+                    if nloop - 1 in failed:
+                        final_iter_outputs = {
+                            name: SkippedOutput(name) for name in self.outputs if name not in gatherer.names
+                        }
         # else just iterate directly
         else:
-            accumulated_elements = (
-                {name: [] for name in self.for_loop.output_elements}
-                if self.for_loop and self.for_loop.output_elements
-                else {}
-            )
-            for args in loop_worker_args:
-                _, _, _, final_iter_outputs, _, _, _, _count, iter_elements = self._iterate_loop_worker(
-                    *args, raise_exc=True
-                )
-                for name, value in iter_elements.items():
-                    accumulated_elements[name].append(value)
+            gatherer = stack.enter_context(ElementGatherer(self, nloop, subst, self.log)) if self.for_loop else None
+            for count, iter_var in enumerate(self._for_loop_values):
+                if count in cached_iters:
+                    final_iter_outputs, iter_elements = cached_iters[count]
+                else:
+                    _, _, final_iter_outputs, _, _, _count, iter_elements = self._iterate_loop_worker(
+                        params, self._iteration_subst(subst), backend, count, iter_var, raise_exc=True
+                    )
+                if gatherer is not None:
+                    gatherer.add(count, iter_var, iter_elements)
 
         # either way, outputs contains output aliases from the last iteration
         params.update(**final_iter_outputs)
-        if accumulated_elements:
-            params.update(**accumulated_elements)
+        if gatherer is not None:
+            params.update(**gatherer.close())
 
         # current namespace becomes recipe again
         subst.current = subst.recipe
@@ -0,0 +1,125 @@
+import hashlib
+import logging
+import os
+import os.path
+import pickle
+import sys
+from typing import Optional
+
+import scabha
+from omegaconf import OmegaConf
+
+import stimela
+
+from . import step_cache
+from .recipe import Recipe, RecipeSchema
+
+# bump this if the format of compiled recipes changes, to invalidate old artifacts
+COMPILED_FORMAT_VERSION = 1
+
+# modules whose classes make up a compiled recipe: a compiled recipe is invalidated if any of them change
+_KEY_MODULES = ("stimela.kitchen.recipe", "stimela.kitchen.step", "stimela.kitchen.cab", "scabha.cargo")
+
+
+def get_compiled_dir() -> str:
+    """Returns the directory in which compiled recipes are stored: opts.cache.recipes_dir, or a per-user cache
+    directory by default
+    """
+    if stimela.CONFIG.opts.cache.recipes_dir:
+        return os.path.expanduser(stimela.CONFIG.opts.cache.recipes_dir)
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "stimela", "recipes")
+
+
+def _cache_key(name: str) -> str:
+    """Returns key for a compiled recipe, based on the content of the config's recipe library, and on the versions
+    of the code that defines the recipe objects
+    """
+    code_versions = [stimela.__version__, scabha.__version__]
+    for modname in _KEY_MODULES:
+        modfile = getattr(sys.modules.get(modname), "__file__", None)
+        code_versions.append(modfile and os.stat(modfile).st_mtime_ns)
+    key = repr(
+        (COMPILED_FORMAT_VERSION, code_versions, name, OmegaConf.to_yaml(stimela.CONFIG.lib.recipes, sort_keys=True))
+    )
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _resolve_nested_recipes(recipe: Recipe):
+    """Recursively instantiates nested recipes referred to by library name (or defined inline) in a recipe's steps"""
+    for step in recipe.steps.values():
+        if step.recipe:
+            step.resolve_recipe(stimela.CONFIG, dotted=False)
+            if isinstance(step.recipe, Recipe):
+                _resolve_nested_recipes(step.recipe)
+
+
+def compile_recipe(name: str) -> Recipe:
+    """Instantiates a recipe from lib.recipes, along with any nested recipes it refers to. This is the expensive
+    part of loading a recipe (in terms of OmegaConf merges), and its result only depends on the recipe library.
+    The recipe is not finalized, since that depends on the rest of the config and the runtime environment.
+    """
+    conf = OmegaConf.unsafe_merge(RecipeSchema.copy(), stimela.CONFIG.lib.recipes[name])
+    conf.name = conf.name or name
+    recipe = Recipe(**conf)
+    _resolve_nested_recipes(recipe)
+    return recipe
+
+
+def load_recipe(name: str, log: logging.Logger) -> Recipe:
+    """Returns compiled recipe from the cache, if the recipe library hasn't changed since it was compiled, else
+    compiles the recipe and stores it in the cache. If opts.cache.recipes is disabled, always compiles the recipe.
+    Problems with the cache directory are warned about, and the recipe is then simply compiled.
+
+    Args:
+        name (str): recipe name in lib.recipes
+        log (logging.Logger): logger for messages
+
+    Returns:
+        Recipe: recipe object (not yet finalized)
+    """
+    if not stimela.CONFIG.opts.cache.recipes:
+        return compile_recipe(name)
+    path = os.path.join(get_compiled_dir(), f"{_cache_key(name)}.pkl")
+    recipe = _load(path, log)
+    if recipe is not None:
+        log.info(f"loaded compiled recipe '{name}' from {path}")
+        step_cache.touch(path, log)
+        return recipe
+    recipe = compile_recipe(name)
+    if _store(path, recipe, log):
+        step_cache.evict(get_compiled_dir(), suffix=".pkl")
+    return recipe
+
+
+def _load(path: str, log: logging.Logger) -> Optional[Recipe]:
+    try:
+        with open(path, "rb") as fileobj:
+            recipe = pickle.load(fileobj)
+        if not isinstance(recipe, Recipe):
+            raise TypeError(f"compiled object is of type {type(recipe)}, expecting Recipe")
+    except FileNotFoundError:
+        return None
+    except OSError as exc:
+        log.warning(f"can't read compiled recipe {path}: {exc}")
+        return None
+    except Exception as exc:
+        log.warning(f"ignoring invalid compiled recipe {path}: {exc}")
+        return None
+    return recipe
+
+
+def _store(path: str, recipe: Recipe, log: logging.Logger) -> bool:
+    """Stores compiled recipe in the cache, returns True on success"""
+    try:
+        data = pickle.dumps(recipe, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as exc:
+        log.debug(f"not caching compiled recipe, as it can't be serialized: {exc}")
+        return False
+    try:
+        step_cache.write_entry(path, data)
+    except OSError as exc:
+        log.warning(f"not caching compiled recipe: {exc}")
+        return False
+    log.debug(f"cached compiled recipe in {path}")
+    return True
@@ -0,0 +1,159 @@
+import contextlib
+import os
+import os.path
+import shutil
+import threading
+from typing import Any, Dict, Iterator, List, Optional
+
+from scabha.basetypes import MS, URI, Directory
+
+from stimela.exceptions import StimelaRuntimeError
+
+from .cab import Cab
+
+# (speculative copies of for-loop iterations only) tag of temporary output names, and dict of final -> temporary
+# paths of file outputs written so far by the current iteration. These are per-thread, since iterations may be
+# scattered over threads.
+_state = threading.local()
+
+
+def _is_directory_type(dtype: Any) -> bool:
+    """True if dtype is a directory type (or a list of them)"""
+    return any(dtype in (t, Optional[t], List[t], Optional[List[t]]) for t in (Directory, MS))
+
+
+def _check_schema(name: str, schema: Any) -> Optional[str]:
+    """Returns reason why a cab parameter prevents isolation of outputs, or None if it doesn't"""
+    if not (schema.is_file_type or schema.is_file_list_type):
+        return None
+    if schema.is_input:
+        if schema.writable:
+            return f"input '{name}' is modified in place"
+    elif schema.implicit is not None:
+        return f"output '{name}' has an implicit name"
+    elif _is_directory_type(schema._dtype) and not schema.path_policies.remove_if_exists:
+        return f"output '{name}' is a directory that may be shared (set path_policies.remove_if_exists to allow)"
+    return None
+
+
+def check_isolation(recipe: Any) -> Optional[str]:
+    """Checks if the file outputs of a recipe's steps can be isolated, i.e. redirected to temporary names. This is not
+    possible for cabs that modify their inputs in place, or write outputs with implicit names, or write into output
+    directories that may hold other files.
+
+    Returns:
+        Optional[str]: None if outputs can be isolated, else the reason why not
+    """
+    for label, step in recipe.steps.items():
+        cargo = step.cargo
+        if type(cargo) is Cab:
+            for name, schema in cargo.inputs_outputs.items():
+                reason = _check_schema(name, schema)
+                if reason:
+                    return f"step '{label}': {reason}"
+        elif cargo is not None:
+            reason = check_isolation(cargo)
+            if reason:
+                return f"step '{label}': {reason}"
+    return None
+
+
+@contextlib.contextmanager
+def isolate_outputs(tag: Optional[str]) -> Iterator[Dict[str, str]]:
+    """Context manager under which file outputs of cabs are written to temporary paths, formed by prefixing their
+    names with the given tag. Inputs referring to outputs written previously are redirected accordingly. Does
+    nothing if tag is None.
+
+    Yields:
+        Dict[str, str]: dict of final -> temporary paths of outputs written so far, to be passed to commit() or
+        discard() once done
+    """
+    redirects = {}
+    if tag is None:
+        yield redirects
+        return
+    saved = getattr(_state, "tag", None), getattr(_state, "redirects", None)
+    _state.tag, _state.redirects = tag, redirects
+    try:
+        yield redirects
+    finally:
+        _state.tag, _state.redirects = saved
+
+
+def is_isolating() -> bool:
+    """True if outputs are currently being isolated"""
+    return getattr(_state, "redirects", None) is not None
+
+
+def redirect_params(cab: Cab, params: Dict[str, Any]):
+    """If outputs are being isolated, redirects file-type parameters of a cab about to be run, in place: outputs to
+    temporary paths, and inputs to the temporary paths of previously redirected outputs.
+    """
+    _tag, _redirects = getattr(_state, "tag", None), getattr(_state, "redirects", None)
+    if _redirects is None:
+        return
+
+    def redirect(path, output):
+        if not isinstance(path, str):
+            return path
+        if not output:
+            return type(path)(_redirects[path]) if path in _redirects else path
+        if URI(path).remote:
+            raise StimelaRuntimeError(f"can't isolate output '{name}': {path} is remote")
+        temp = _redirects.get(path)
+        if temp is None:
+            dirname, basename = os.path.split(path.rstrip("/"))
+            temp = _redirects[path] = os.path.join(dirname, f"{_tag}-{basename}")
+            # clear out leftovers of an earlier speculative run
+            discard({path: temp})
+        return type(path)(temp)
+
+    for name, schema in cab.inputs_outputs.items():
+        if name in params and (schema.is_file_type or schema.is_file_list_type):
+            reason = _check_schema(name, schema)
+            if reason:
+                raise StimelaRuntimeError(f"can't isolate outputs of cab '{cab.name}': {reason}")
+            value = params[name]
+            if schema.is_file_list_type and isinstance(value, (list, tuple)):
+                params[name] = [redirect(path, schema.is_output) for path in value]
+            else:
+                params[name] = redirect(value, schema.is_output)
+
+
+def restore_values(value: Any, redirects: Dict[str, str]) -> Any:
+    """Returns value (or nested lists/dicts of values) with any temporary paths replaced by final paths"""
+    final_paths = {temp: path for path, temp in redirects.items()}
+    if not final_paths:
+        return value
+
+    def restore(value):
+        if isinstance(value, str):
+            return type(value)(final_paths[value]) if value in final_paths else value
+        if isinstance(value, (list, tuple)):
+            return type(value)(restore(x) for x in value)
+        if isinstance(value, dict):
+            return type(value)((key, restore(x)) for key, x in value.items())
+        return value
+
+    return restore(value)
+
+
+def _remove(path: str):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def commit(redirects: Dict[str, str]):
+    """Renames temporary outputs to their final paths, replacing whatever is there"""
+    for path, temp in redirects.items():
+        if os.path.lexists(temp):
+            _remove(path)
+            os.replace(temp, path)
+
+
+def discard(redirects: Dict[str, str]):
+    """Removes temporary outputs"""
+    for temp in redirects.values():
+        _remove(temp)
@@ -32,6 +32,7 @@ from stimela.exceptions import (
 )
 from stimela.stimelogging import log_rich_payload
 
+from . import fingerprints, speculation, step_cache
 from .cab import Cab, get_cab_schema
 
 Conditional = Optional[str]
@@ -77,6 +78,7 @@ def apply_backend_varieties(backend_opts: DictConfig):
 
 OUTPUTS_EXISTS = "exist"
 OUTPUTS_FRESH = "fresh"
+OUTPUTS_CACHED = "cached"
 
 
 @dataclass
@@ -88,7 +90,7 @@ class Step:
     params: Dict[str, Any] = EmptyDictDefault()  # assigns parameter values
     info: Optional[str] = None  # comment or info string
     skip: Optional[str] = None  # if this evaluates to True, step is skipped.
-    skip_if_outputs: Optional[str] = None  # skip if outputs "exist' or "fresh"
+    skip_if_outputs: Optional[str] = None  # skip if outputs "exist', "fresh" or "cached"
     tags: List[str] = EmptyListDefault()
 
     name: str = ""  # step's internal name
@@ -112,6 +114,8 @@ class Step:
         if bool(self.cab) == bool(self.recipe):
             raise StepValidationError(f"step '{self.name}': step can't specify both a cab and a nested recipe")
         self.cargo = self.config = None
+        # backend settings inherited from the parent recipe, set up in finalize()
+        self._parent_backend = None
         self.tags = set(self.tags)
         # check backend setting
         if self.backend:
@@ -122,11 +126,16 @@ class Step:
         # convert params into standard dict, else lousy stuff happens when we insert non-standard objects
         if isinstance(self.params, DictConfig):
             self.params = OmegaConf.to_container(self.params)
+        # likewise for assignments, which are iterated over repeatedly at runtime
+        if isinstance(self.assign, DictConfig):
+            self.assign = OmegaConf.to_container(self.assign)
+        if isinstance(self.assign_based_on, DictConfig):
+            self.assign_based_on = OmegaConf.to_container(self.assign_based_on)
         # after (pre)validation, this contains parameter values
         self.validated_params = None
         # parameters protected from assignment (because they've been set on the command line, presumably)
         self._assignment_overrides = set()
-        if self.skip_if_outputs and self.skip_if_outputs not in (OUTPUTS_EXISTS, OUTPUTS_FRESH):
+        if self.skip_if_outputs and self.skip_if_outputs not in (OUTPUTS_EXISTS, OUTPUTS_FRESH, OUTPUTS_CACHED):
             raise StepValidationError(f"step '{self.name}': invalid 'skip_if_outputs={self.skip_if_outputs}' setting")
         # the "skip" attribute is reevaluated at runtime since it may contain substitutions, but if it's set to a bool
         # constant, self._skip will be preset already
@@ -229,9 +238,45 @@ class Step:
 
     _instantiated_cabs = {}
 
-    def finalize(self, config=None, log=None, fqname=None, backend=None, nesting=0):
+    def resolve_recipe(self, config, dotted=True):
+        """Resolves a nested recipe step's recipe field (a name, or a DictConfig) into a Recipe object.
+
+        Args:
+            config: config namespace in which recipe names are looked up
+            dotted (bool): if False, dotted recipe names (which refer to arbitrary config sections) are left unresolved
+        """
         from .recipe import Recipe, RecipeSchema
 
+        # first, if it is a string, look it up in library
+        recipe_name = f"{self.fqname}:recipe"
+        if type(self.recipe) is str:
+            recipe_name = f"nested recipe '{self.recipe}'"
+            # undotted name -- look in lib.recipes
+            if "." not in self.recipe:
+                if self.recipe not in config.lib.recipes:
+                    raise StepValidationError(f"recipe '{self.recipe}' not found in lib.recipes")
+                self.recipe = config.lib.recipes[self.recipe]
+            # dotted name -- look in config
+            elif dotted:
+                section, var = resolve_dotted_reference(
+                    self.recipe, config, current=None, context=f"step '{self.name}'"
+                )
+                if var not in section:
+                    raise StepValidationError(f"recipe '{self.recipe}' not found")
+                self.recipe = section[var]
+            else:
+                return
+            # self.recipe is now hopefully a DictConfig or a Recipe object, so fall through below to validate it
+        # instantiate from omegaconf object, if needed
+        if type(self.recipe) is DictConfig:
+            try:
+                self.recipe = Recipe(**OmegaConf.unsafe_merge(RecipeSchema.copy(), self.recipe))
+            except OmegaConfBaseException as exc:
+                raise StepValidationError(f"error in recipe '{recipe_name}", exc)
+        elif not isinstance(self.recipe, Recipe):
+            raise StepValidationError(f"recipe field must be a string or a nested recipe, got {type(self.recipe)}")
+
+    def finalize(self, config=None, log=None, fqname=None, backend=None, nesting=0):
         if not self.finalized:
             if fqname is not None:
                 self.fqname = fqname
@@ -239,34 +284,7 @@ class Step:
 
             # if recipe, validate the recipe with our parameters
             if self.recipe:
-                # first, if it is a string, look it up in library
-                recipe_name = f"{self.fqname}:recipe"
-                if type(self.recipe) is str:
-                    recipe_name = f"nested recipe '{self.recipe}'"
-                    # undotted name -- look in lib.recipes
-                    if "." not in self.recipe:
-                        if self.recipe not in self.config.lib.recipes:
-                            raise StepValidationError(f"recipe '{self.recipe}' not found in lib.recipes")
-                        self.recipe = self.config.lib.recipes[self.recipe]
-                    # dotted name -- look in config
-                    else:
-                        section, var = resolve_dotted_reference(
-                            self.recipe, config, current=None, context=f"step '{self.name}'"
-                        )
-                        if var not in section:
-                            raise StepValidationError(f"recipe '{self.recipe}' not found")
-                        self.recipe = section[var]
-                    # self.recipe is now hopefully a DictConfig or a Recipe object, so fall through below to validate it
-                # instantiate from omegaconf object, if needed
-                if type(self.recipe) is DictConfig:
-                    try:
-                        self.recipe = Recipe(**OmegaConf.unsafe_merge(RecipeSchema.copy(), self.recipe))
-                    except OmegaConfBaseException as exc:
-                        raise StepValidationError(f"error in recipe '{recipe_name}", exc)
-                elif not isinstance(self.recipe, Recipe):
-                    raise StepValidationError(
-                        f"recipe field must be a string or a nested recipe, got {type(self.recipe)}"
-                    )
+                self.resolve_recipe(config)
                 self.cargo = self.recipe
             else:
                 if type(self.cab) is str:
@@ -317,12 +335,26 @@ class Step:
                 if name not in self.params:
                     self.params[name] = value
 
-            # check for valid backend
+            # backend settings are checked later by validate_backend(), once we know if the step is selected to run
+            self._parent_backend = backend
+
+    def validate_backend(self):
+        """Checks that the effective backend settings of the step (or of the steps of a nested recipe) refer to a valid
+        backend. This is done after step selection rather than in finalize(), since merging and validating backend
+        settings is relatively expensive, and needn't be done for steps that are skipped.
+        """
+        from .recipe import Recipe
+
+        if self._skip is True:
+            return
+        if isinstance(self.cargo, Recipe):
+            self.cargo.validate_backends()
+        else:
             backend_opts = apply_backend_varieties(
-                OmegaConf.merge(backend or {}, self.cargo.backend or {}, self.backend or {})
+                OmegaConf.merge(self._parent_backend or {}, self.cargo.backend or {}, self.backend or {})
             )
             backend_opts = OmegaConf.to_object(OmegaConf.merge(StimelaBackendSchema, backend_opts))
-            runner.validate_backend_settings(backend_opts, log, cab=self.cargo if isinstance(self.cargo, Cab) else None)
+            runner.validate_backend_settings(backend_opts, self.log, cab=self.cargo)
 
     def prevalidate(self, subst: SubstitutionNS, root=False, backend=None):
         self.finalize(backend=backend)
@@ -619,14 +651,31 @@ class Step:
                 parent_log_info(f"ignoring skip_if_outputs: {skip_if_outputs} because backend has remote filesystem")
                 skip_if_outputs = None
             # don't check if force-disabled
-            elif (skip_if_outputs == OUTPUTS_EXISTS and stimela.CONFIG.opts.disable_skips.exist) or (
-                skip_if_outputs == OUTPUTS_FRESH and stimela.CONFIG.opts.disable_skips.fresh
+            elif (
+                (skip_if_outputs == OUTPUTS_EXISTS and stimela.CONFIG.opts.disable_skips.exist)
+                or (skip_if_outputs == OUTPUTS_FRESH and stimela.CONFIG.opts.disable_skips.fresh)
+                or (skip_if_outputs == OUTPUTS_CACHED and stimela.CONFIG.opts.disable_skips.cached)
             ):
                 parent_log_info(f"ignoring skip_if_outputs: {skip_if_outputs} because it has been force-disabled")
                 skip_if_outputs = None
+            # caching only applies to cabs, since nested recipes can cache their own steps
+            elif skip_if_outputs == OUTPUTS_CACHED and type(self.cargo) is not Cab:
+                parent_log_info(f"ignoring skip_if_outputs: {skip_if_outputs} because this step is not a cab")
+                skip_if_outputs = None
+
+            ## if skip on cached outputs is in effect, look for a previous run with identical parameters and inputs
+            cache_key_params = None
+            if skip_if_outputs == OUTPUTS_CACHED:
+                parent_log_info("checking for cached results of step")
+                cache_key_params = step_cache.get_key_params(params)
+                cached_outputs = step_cache.lookup(self.cargo, cache_key_params, params, log=parent_log)
+                if cached_outputs is not None:
+                    parent_log_info("restoring outputs of previous run, skipping this step")
+                    params.update(**cached_outputs)
+                    skip = True
 
             ## if skip on fresh outputs is in effect, find mtime of most recent input
-            if skip_if_outputs:
+            elif skip_if_outputs:
                 # max_mtime will remain 0 if we're not echecking for freshness, or if there are no file-type inputs
                 max_mtime, max_mtime_path = 0, None
                 if skip_if_outputs == OUTPUTS_FRESH:
@@ -642,7 +691,8 @@ class Step:
                                 continue
                             for filename in values:
                                 if isinstance(filename, str) and os.path.exists(filename):
-                                    mtime = os.path.getmtime(filename)
+                                    # for directories (e.g. MSs), this is the mtime of the most recent file inside
+                                    mtime = fingerprints.get_mtime(filename)
                                     if mtime > max_mtime:
                                         max_mtime = mtime
                                         max_mtime_path = filename
@@ -689,7 +739,7 @@ class Step:
                                     if schema.skip_freshness_checks:
                                         messages.append(f"{label} = {value} marked as skipped from freshness checks")
                                     else:
-                                        mtime = os.path.getmtime(value)
+                                        mtime = fingerprints.get_mtime(value)
                                         if mtime < max_mtime:
                                             parent_log_info(f"{label} = {value} is not fresh")
                                             all_exist = False
@@ -720,6 +770,10 @@ class Step:
                 if self.evaluate_section("preamble", subst):
                     raise StepValidationError("aborting due to above", log=self.log)
 
+                # in speculative copies of loop iterations, write outputs to temporary paths
+                if type(self.cargo) is Cab and not backend_runner.is_remote_fs:
+                    speculation.redirect_params(self.cargo, params)
+
                 # check for outputs that need removal
                 if not backend_runner.is_remote_fs:
                     for name, schema in self.outputs.items():
@@ -866,4 +920,8 @@ class Step:
                         "errors downstream"
                     )
 
+            # record successful run in step cache
+            if cache_key_params is not None and not skip and not speculation.is_isolating():
+                step_cache.store(self.cargo, cache_key_params, params, fqname=self.fqname, log=self.log)
+
         return params
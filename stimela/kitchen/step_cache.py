@@ -0,0 +1,233 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import os.path
+import threading
+import time
+from typing import Any, Dict, List, Optional, Union
+
+import stimela
+
+from . import fingerprints
+from .cab import Cab
+
+# bump this if the format of cache entries changes, to invalidate old entries
+CACHE_FORMAT_VERSION = 1
+
+
+def get_cache_dir() -> str:
+    """Returns the directory in which step cache entries are stored (opts.cache.dir)"""
+    return os.path.expanduser(stimela.CONFIG.opts.cache.dir)
+
+
+def _cab_signature(cab: Cab) -> str:
+    """Returns a string representing the definition of a cab. Any change to the cab's command, image, flavour,
+    parameter schemas etc. will change the signature.
+    """
+    return repr(
+        (
+            cab.command,
+            cab.image,
+            cab.args,
+            cab.flavour,
+            cab.parameter_passing,
+            cab.management,
+            cab.policies,
+            cab.backend,
+            cab.inputs,
+            cab.outputs,
+        )
+    )
+
+
+def _file_paths(cab: Cab, params: Dict[str, Any], inputs: bool) -> List[str]:
+    """Returns list of paths given by file-type input (or output) parameters"""
+    paths = []
+    schemas = cab.inputs if inputs else cab.outputs
+    for name, schema in schemas.items():
+        if name not in params or schema.skip_freshness_checks:
+            continue
+        if schema.is_file_type:
+            values = [params[name]]
+        elif schema.is_file_list_type:
+            values = params[name]
+        else:
+            continue
+        paths += [value for value in values if isinstance(value, str)]
+    return paths
+
+
+def file_fingerprint(path: str) -> Optional[str]:
+    """Returns a fingerprint of a file or directory, or None if it doesn't exist.
+
+    Files are fingerprinted by content hash (or by size and mtime, if opts.cache.hash_contents is disabled).
+    Directories (e.g. MSs) are fingerprinted by the relative paths, sizes and mtimes of everything in them, or
+    by content hashes of everything in them if opts.cache.hash_directories is enabled. Content hashes are kept
+    in the fingerprint index, and only recomputed for files that have changed.
+    """
+    opts = stimela.CONFIG.opts.cache
+    return fingerprints.get_index().fingerprint(
+        path, hash_contents=opts.hash_contents, hash_directories=opts.hash_directories
+    )
+
+
+def get_key_params(params: Dict[str, Any]) -> str:
+    """Returns the canonical representation of a step's (validated) parameters, for use in cache keys. This must be
+    computed before the step is run, since running the step adds outputs to the parameters.
+    """
+    return json.dumps(params, sort_keys=True, default=str)
+
+
+def _cache_key(cab: Cab, key_params: str, params: Dict[str, Any]) -> str:
+    """Returns cache key based on cab definition, parameters and current state of input files"""
+    input_fingerprints = {path: file_fingerprint(path) for path in _file_paths(cab, params, inputs=True)}
+    key = json.dumps([CACHE_FORMAT_VERSION, _cab_signature(cab), key_params, input_fingerprints], sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _entry_path(key: str) -> str:
+    return os.path.join(get_cache_dir(), f"{key}.json")
+
+
+def lookup(cab: Cab, key_params: str, params: Dict[str, Any], log: logging.Logger) -> Optional[Dict[str, Any]]:
+    """Looks for a previous successful run of the cab with identical parameters and inputs.
+
+    Args:
+        cab (Cab): the step's cab
+        key_params (str): parameters, as returned by get_key_params()
+        params (Dict[str, Any]): validated parameters of the step
+        log (logging.Logger): logger for messages
+
+    Returns:
+        Optional[Dict[str, Any]]: outputs recorded by the previous run, or None if there is no such run, or if its
+        file-type outputs have since been changed or removed.
+    """
+    # input files that can't be read (or disappear while being fingerprinted) make for a cache miss
+    try:
+        path = _entry_path(_cache_key(cab, key_params, params))
+    except OSError as exc:
+        log.warning(f"  can't fingerprint input files, ignoring the step cache: {exc}")
+        return None
+    try:
+        with open(path) as fileobj:
+            entry = json.load(fileobj)
+    except FileNotFoundError:
+        return None
+    except Exception as exc:
+        log.warning(f"ignoring invalid step cache entry {path}: {exc}")
+        return None
+    for filename, fingerprint in entry["output_fingerprints"].items():
+        try:
+            changed = file_fingerprint(filename) != fingerprint
+        except OSError as exc:
+            log.info(f"  output {filename} can't be fingerprinted: {exc}")
+            return None
+        if changed:
+            log.info(f"  output {filename} has changed since the cached run")
+            return None
+    touch(path, log)
+    log.info(f"  found cached results of a previous run at {time.ctime(entry['time'])}")
+    return entry["outputs"]
+
+
+def store(cab: Cab, key_params: str, params: Dict[str, Any], fqname: str, log: logging.Logger):
+    """Records the outputs of a successful run of the cab, then evicts old entries from the cache.
+
+    Args:
+        cab (Cab): the step's cab
+        key_params (str): parameters of the step, as returned by get_key_params() before the step was run
+        params (Dict[str, Any]): validated parameters (including outputs) of the step after the run
+        fqname (str): name of step, recorded for information
+        log (logging.Logger): logger for messages
+    """
+    outputs = {name: value for name, value in params.items() if name in cab.outputs}
+    try:
+        entry = dict(
+            fqname=fqname,
+            time=time.time(),
+            outputs=outputs,
+            output_fingerprints={path: file_fingerprint(path) for path in _file_paths(cab, params, inputs=False)},
+        )
+        # input files may have been modified by the run, so the key is formed from their current state
+        path = _entry_path(_cache_key(cab, key_params, params))
+    except OSError as exc:
+        log.warning(f"not caching step outputs, as files can't be fingerprinted: {exc}")
+        return
+    try:
+        text = json.dumps(entry)
+    except TypeError as exc:
+        log.debug(f"not caching step outputs, as they can't be serialized: {exc}")
+        return
+    try:
+        write_entry(path, text)
+    except OSError as exc:
+        log.warning(f"not caching step outputs: {exc}")
+        return
+    log.debug(f"cached step outputs in {path}")
+    evict()
+
+
+def write_entry(path: str, data: Union[str, bytes]):
+    """Writes a cache entry atomically, since concurrent runs (or threads) may be using the cache. Raises OSError if
+    the entry can't be written, leaving no partial file behind.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmppath = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmppath, "wb" if isinstance(data, bytes) else "w") as fileobj:
+            fileobj.write(data)
+        os.replace(tmppath, path)
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.unlink(tmppath)
+        raise
+
+
+def touch(path: str, log: logging.Logger):
+    """Marks a cache entry as recently used. This can fail in a read-only or shared cache, which is only warned
+    about.
+    """
+    try:
+        os.utime(path)
+    except OSError as exc:
+        log.warning(f"can't mark cache entry {path} as used: {exc}")
+
+
+def evict(cache_dir: Optional[str] = None, suffix: str = ".json"):
+    """Removes cache entries older than opts.cache.max_age days, then the least recently used entries in excess of
+    opts.cache.max_entries. This is done on a best-effort basis: entries that can't be removed (e.g. in a read-only
+    or shared cache) are left alone.
+
+    Args:
+        cache_dir (str, optional): directory of cache entries. Defaults to the step cache directory.
+        suffix (str): filename suffix of cache entries
+    """
+    opts = stimela.CONFIG.opts.cache
+    cache_dir = cache_dir or get_cache_dir()
+    entries = []
+    try:
+        filenames = os.listdir(cache_dir)
+    except OSError:
+        return
+    for filename in filenames:
+        if filename.endswith(suffix):
+            path = os.path.join(cache_dir, filename)
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                continue
+    entries.sort(reverse=True)
+    expired = []
+    if opts.max_age > 0:
+        cutoff = time.time() - opts.max_age * 86400
+        while entries and entries[-1][0] < cutoff:
+            expired.append(entries.pop())
+    if opts.max_entries > 0:
+        expired += entries[opts.max_entries :]
+    for _, path in expired:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
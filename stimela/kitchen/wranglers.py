@@ -1,7 +1,8 @@
+import functools
 import json
 import logging
 import re
-from typing import Optional, Union
+from typing import Iterable, List, Optional, Set, Tuple, Union
 
 import yaml
 from omegaconf import ListConfig
@@ -10,6 +11,11 @@ from scabha.cargo import ListOrString
 from stimela.exceptions import CabValidationError, StimelaCabOutputError, StimelaCabRuntimeError
 from stimela.stimelogging import FunkyMessage
 
+try:
+    from re import _parser as sre_parse
+except ImportError:  # python < 3.11
+    import sre_parse
+
 # wranglers specified as a single string, or a list
 WranglerSpecList = ListOrString
 
@@ -314,3 +320,99 @@ all_wranglers = {
     for _, cls in vars().items()
     if isinstance(cls, type) and issubclass(cls, _BaseWrangler) and cls.specifier is not None
 }
+
+
+# repeat opcodes of parsed regexes
+_REPEATS = {sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, "POSSESSIVE_REPEAT", None)}
+
+
+def _sequence_literals(items: Iterable) -> Optional[Set[str]]:
+    """Returns a set of literal strings such that any match of a parsed regex sequence contains at least one of them,
+    or None if there is no such set. Where there is a choice, picks the set whose shortest literal is longest.
+    """
+    candidates = []
+    run = []
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            run.append(chr(av))
+            continue
+        if run:
+            candidates.append({"".join(run)})
+            run = []
+        # a group is required, unless it changes flags (such as case-sensitivity)
+        if op is sre_parse.SUBPATTERN:
+            _, add_flags, del_flags, pattern = av
+            if not add_flags and not del_flags:
+                candidates.append(_sequence_literals(pattern))
+        # a branch requires one of the literals of each alternative
+        elif op is sre_parse.BRANCH:
+            alternatives = [_sequence_literals(alternative) for alternative in av[1]]
+            if all(alternatives):
+                candidates.append(set().union(*alternatives))
+        elif op in _REPEATS and av[0] >= 1:
+            candidates.append(_sequence_literals(av[2]))
+    if run:
+        candidates.append({"".join(run)})
+    candidates = [literals for literals in candidates if literals]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda literals: min(map(len, literals)))
+
+
+@functools.lru_cache(maxsize=None)
+def required_literals(regex: re.Pattern) -> Optional[Tuple[str, ...]]:
+    """Returns literal strings such that any string matched by a wrangler pattern contains at least one of them, or
+    None if this can't be determined (e.g. for case-insensitive patterns). Lines containing none of the literals can
+    then be skipped without running the regex.
+    """
+    if regex.flags & re.IGNORECASE:
+        return None
+    try:
+        literals = _sequence_literals(sre_parse.parse(regex.pattern, regex.flags))
+    except Exception:
+        return None
+    return tuple(sorted(literals)) if literals else None
+
+
+class WranglerMatcher(object):
+    """Combines the wrangler patterns of a cab, to quickly find which of them may match a line of output.
+
+    Each pattern is indexed by the literals required by its matches (see required_literals()), so that only patterns
+    whose literals occur in a line need to be run. If all patterns have required literals, these are also combined
+    into a single prefilter regex, so that the (typically vast majority of) lines that can't match any pattern are
+    rejected in a single scan.
+    """
+
+    def __init__(self, wranglers: List[Tuple[re.Pattern, List[_BaseWrangler]]]):
+        """
+        Args:
+            wranglers (List[Tuple[re.Pattern, List[_BaseWrangler]]]): list of patterns and their wrangler actions, in
+                the order in which they're to be applied
+        """
+        # indices of patterns that have no required literals, and must be run on every line
+        self._unfiltered = []
+        # maps each required literal to the indices of the patterns requiring it
+        literal_entries = {}
+        for index, (regex, _) in enumerate(wranglers):
+            literals = required_literals(regex)
+            if literals is None:
+                self._unfiltered.append(index)
+            else:
+                for literal in literals:
+                    literal_entries.setdefault(literal, []).append(index)
+        self._literal_entries = list(literal_entries.items())
+        self.prefilter = None
+        if literal_entries and not self._unfiltered:
+            # longest first, so that literals sharing a prefix are tried in full
+            alternatives = sorted(literal_entries, key=len, reverse=True)
+            self.prefilter = re.compile("|".join(map(re.escape, alternatives)))
+
+    def candidates(self, output: str, start: int = 0) -> List[int]:
+        """Returns the sorted indices (from start onwards) of the patterns that may match a line of output"""
+        if self.prefilter is not None and self.prefilter.search(output) is None:
+            return []
+        indices = set(self._unfiltered)
+        for literal, entries in self._literal_entries:
+            if literal in output:
+                indices.update(entries)
+        return sorted(index for index in indices if index >= start)
@@ -22,6 +22,26 @@ def update_children():
         del _child_processes[pid]
 
 
+@dataclass
+class NodeResources:
+    n_cpu: int
+    mem_total: float  # GB
+    mem_available: float  # GB
+    load: float  # 1-minute load average, as a % of n_cpu
+
+
+def get_node_resources() -> NodeResources:
+    """Returns current resource capacity and usage of the node"""
+    n_cpu = psutil.cpu_count()
+    mem = psutil.virtual_memory()
+    return NodeResources(
+        n_cpu=n_cpu,
+        mem_total=mem.total / 2**30,
+        mem_available=mem.available / 2**30,
+        load=psutil.getloadavg()[0] / n_cpu * 100,
+    )
+
+
 @dataclass
 class LocalReport:
     cpu: float = 0
@@ -1,16 +1,18 @@
+import contextlib
 import copy
 import logging
 import os.path
 import re
 import sys
+import threading
 import traceback
 from types import TracebackType
-from typing import Any, Optional, OrderedDict, Union
+from typing import Any, Iterator, Optional, OrderedDict, Tuple, Union
 
 import rich.logging
 import rich.progress
 from omegaconf import DictConfig
-from rich.console import Console
+from rich.console import Console, Group
 from rich.errors import MarkupError
 from rich.markup import escape
 from rich.padding import Padding
@@ -39,6 +41,86 @@ CONSOLE_PRINT_OPTIONS = [
 
 rich_console = Console(file=sys.stdout, highlight=False, emoji=False)
 
+# (worker threads only) console of the current thread, see thread_console()
+_thread_console = threading.local()
+
+
+def get_console() -> Console:
+    """Returns the console that output of the current thread goes to: rich_console, unless the thread has a console
+    of its own (see thread_console())
+    """
+    return getattr(_thread_console, "console", None) or rich_console
+
+
+@contextlib.contextmanager
+def thread_console(file: Any) -> Iterator[Console]:
+    """Context manager under which console output of the current thread (i.e. logged messages, and anything printed
+    via get_console()) goes to a console of its own, writing to the given file. This console renders output in the
+    same way as rich_console. Worker threads use this to stream their output, since rich_console is shared by all
+    threads.
+    """
+    saved = getattr(_thread_console, "console", None)
+    console = _thread_console.console = Console(
+        file=file, highlight=False, emoji=False, color_system=rich_console.color_system, width=rich_console.width
+    )
+    try:
+        yield console
+    finally:
+        _thread_console.console = saved
+
+
+# (threads logging a batch of output only) consoles and file handlers with output pending, see batched_output()
+_batch = threading.local()
+
+
+class _BatchedConsole(object):
+    """Stands in for a console while output is batched: collects whatever is printed, to be printed in one go by
+    flush(). Everything else is passed through to the console.
+    """
+
+    def __init__(self, console: Console):
+        self._console = console
+        self._prints = []
+
+    def __getattr__(self, name):
+        return getattr(self._console, name)
+
+    def print(self, *objects, **kwargs):
+        self._prints.append((objects, kwargs))
+
+    def flush(self):
+        # consecutive single renderables printed with default options are printed as one group, so that the console
+        # (and any live display on it) is refreshed once
+        group = []
+        for objects, kwargs in self._prints:
+            if len(objects) == 1 and not kwargs:
+                group.append(objects[0])
+                continue
+            if group:
+                self._console.print(Group(*group))
+                group = []
+            self._console.print(*objects, **kwargs)
+        if group:
+            self._console.print(Group(*group))
+        self._prints = []
+
+
+@contextlib.contextmanager
+def batched_output() -> Iterator[None]:
+    """Context manager under which console output and log file flushes of the current thread are held back, and done
+    in one go on exit. Used to log a batch of lines of output at a time.
+    """
+    _batch.consoles, _batch.handlers = {}, set()
+    try:
+        yield
+    finally:
+        consoles, handlers = _batch.consoles, _batch.handlers
+        del _batch.consoles, _batch.handlers
+        for console in consoles.values():
+            console.flush()
+        for handler in handlers:
+            handler.flush()
+
 
 class FunkyMessage(object):
     """Class representing a message with two versions: funky (with markup), and boring (no markup)"""
@@ -78,11 +160,30 @@ class StimelaConsoleHander(rich.logging.RichHandler):
         )
         self._console = console
 
+    @property
+    def console(self):
+        # worker threads may have a console of their own
+        console = getattr(_thread_console, "console", None) or self._console
+        # and threads logging a batch of output collect it
+        batch = getattr(_batch, "consoles", None)
+        if batch is None:
+            return console
+        if console not in batch:
+            batch[console] = _BatchedConsole(console)
+        return batch[console]
+
+    @console.setter
+    def console(self, console):
+        self._console = console
+
     def emit(self, record):
+        # records may be meant for log files only (see xrun_asyncio.LogDispatcher)
+        if getattr(record, "skip_console", False):
+            return
         # NOTE(JSKenyon): If a message requires a custom console print,
         # forward all known arguments to the _console.print method.
         if getattr(record, "custom_console_print", False):
-            self._console.print(
+            self.console.print(
                 record.msg, **{k: getattr(record, k) for k in CONSOLE_PRINT_OPTIONS if hasattr(record, k)}
             )
             return
@@ -91,19 +192,19 @@ class StimelaConsoleHander(rich.logging.RichHandler):
         # backstop -- message should have been properly markup-escaped
         except MarkupError:
             record.msg = escape(record.msg)
-            self._console.print(f"Malformed markup in log message: {record.msg}", markup=False, style="red")
-            self._console.print("This is a (probably harmless) bug -- but please report", markup=False, style="red")
+            self.console.print(f"Malformed markup in log message: {record.msg}", markup=False, style="red")
+            self.console.print("This is a (probably harmless) bug -- but please report", markup=False, style="red")
             try:
                 rich.logging.RichHandler.emit(self, record)
             except MarkupError:
-                self._console.print(
+                self.console.print(
                     "Malformed markup after escaping -- this is surely a bug -- please report",
                     markup=False,
                     style="red",
                 )
 
         if hasattr(record, "console_payload"):
-            self._console.print(record.console_payload, highlight=getattr(record, "console_highlight", None))
+            self.console.print(record.console_payload, highlight=getattr(record, "console_highlight", None))
 
 
 class StimelaLogFormatter(logging.Formatter):
@@ -174,7 +275,7 @@ def is_logger_initialized():
 
 def declare_chapter(title: str, **kw):
     if not _boring:
-        rich_console.rule(title, **kw)
+        get_console().rule(title, **kw)
 
 
 def apply_style(text: str, style: str):
@@ -223,23 +324,89 @@ def logger(name="STIMELA", propagate=False, boring=False, loglevel="INFO"):
     return _logger
 
 
+# (log context, logger name) -> (logfile, file handler)
 _logger_file_handlers = {}
 _logger_console_handlers = {}
 
 # keep track of all log files opened
 _previous_logfiles = set()
 
+# (threads running scattered loop iterations only) the thread's log context, see thread_log_context()
+_thread_log = threading.local()
+
+
+def _get_log_context() -> Optional[int]:
+    return getattr(_thread_log, "context", None)
+
+
+class _LogContextFilter(logging.Filter):
+    """Filter of a file handler set up in the given log context: passes records logged from within that context.
+    The handlers of the process (i.e. those set up outside of any log context) also pass records from threads that
+    have no file handler of their own for the logger.
+    """
+
+    def __init__(self, context: Optional[int], name: str):
+        super().__init__()
+        self.context, self.logger_name = context, name
+
+    def filter(self, record):
+        context = _get_log_context()
+        if context == self.context:
+            return True
+        return self.context is None and (context, self.logger_name) not in _logger_file_handlers
+
+
+@contextlib.contextmanager
+def thread_log_context() -> Iterator[None]:
+    """Context manager under which file loggers set up by the current thread are private to it.
+
+    Loggers are shared by all threads, so threads running loop iterations concurrently would otherwise switch each
+    other's log files. Each file handler only passes records logged from the context that set it up (see
+    _LogContextFilter). The thread's file handlers are closed on exit.
+    """
+    context = _thread_log.context = threading.get_ident()
+    try:
+        yield
+    finally:
+        for key, (_, fh) in list(_logger_file_handlers.items()):
+            if key[0] == context:
+                fh.close()
+                logging.getLogger(key[1]).removeHandler(fh)
+                del _logger_file_handlers[key]
+        del _thread_log.context
+
+
+def get_output_context() -> Tuple[Optional[int], Optional[Console]]:
+    """Returns the log context and console of the current thread (see thread_log_context() and thread_console()), so
+    that another thread can log on its behalf (see output_context())
+    """
+    return _get_log_context(), getattr(_thread_console, "console", None)
+
+
+@contextlib.contextmanager
+def output_context(context: Tuple[Optional[int], Optional[Console]]) -> Iterator[None]:
+    """Context manager under which log output of the current thread goes wherever that of the thread that returned
+    the given context (see get_output_context()) would
+    """
+    saved = get_output_context()
+    _thread_log.context, _thread_console.console = context
+    try:
+        yield
+    finally:
+        _thread_log.context, _thread_console.console = saved
+
 
 def has_file_logger(log: logging.Logger):
-    return log.name in _logger_file_handlers
+    return (_get_log_context(), log.name) in _logger_file_handlers
 
 
 def disable_file_logger(log: logging.Logger):
-    current_logfile, fh = _logger_file_handlers.get(log.name, (None, None))
+    key = _get_log_context(), log.name
+    current_logfile, fh = _logger_file_handlers.get(key, (None, None))
     if fh is not None:
         fh.close()
         log.removeHandler(fh)
-        del _logger_file_handlers[log.name]
+        del _logger_file_handlers[key]
 
 
 class DelayedFileHandler(logging.FileHandler):
@@ -268,9 +435,20 @@ class DelayedFileHandler(logging.FileHandler):
         return os.path.dirname(self.logfile)
 
     def emit(self, record):
+        # records may be meant for the console only (see xrun_asyncio.LogDispatcher)
+        if getattr(record, "skip_logfile", False):
+            return
         self.get_logfile_dir()
         return super().emit(record)
 
+    def flush(self):
+        # threads logging a batch of output flush once, at the end of the batch
+        batch = getattr(_batch, "handlers", None)
+        if batch is not None:
+            batch.add(self)
+        else:
+            super().flush()
+
 
 def setup_file_logger(
     log: logging.Logger, logfile: str, level: Optional[Union[int, str]] = logging.INFO, symlink: Optional[str] = None
@@ -288,7 +466,8 @@ def setup_file_logger(
     Returns:
         [logging.Logger]: logger object
     """
-    current_logfile, fh = _logger_file_handlers.get(log.name, (None, None))
+    key = _get_log_context(), log.name
+    current_logfile, fh = _logger_file_handlers.get(key, (None, None))
 
     # does the logger need a new FileHandler created
     if current_logfile != logfile:
@@ -306,9 +485,10 @@ def setup_file_logger(
         # create new FH
         fh = DelayedFileHandler(logfile, symlink, mode)
         fh.setFormatter(_log_file_formatter)
+        fh.addFilter(_LogContextFilter(*key))
         log.addHandler(fh)
 
-        _logger_file_handlers[log.name] = logfile, fh
+        _logger_file_handlers[key] = logfile, fh
 
         # if logging to console, disable propagation from this sub-logger, and add a console handler
         # This ensures that parent loggers that log to files to not get repeated messages
@@ -368,7 +548,7 @@ def update_file_logger(
 
 def get_logfile_dir(log: logging.Logger):
     """Returns filename associated with the logger, or None if not logging to file"""
-    logfile, fh = _logger_file_handlers.get(log.name, (None, None))
+    logfile, fh = _logger_file_handlers.get((_get_log_context(), log.name), (None, None))
     if logfile is None:
         return None
     return fh.get_logfile_dir()
@@ -458,7 +638,7 @@ def log_exception(*errors, severity="error", log=None):
     if has_nesting:
         declare_chapter("detailed error report follows", style="red")
         for tree in trees:
-            rich_console.print(Padding(tree, pad=(0, 0, 0, 8)))
+            get_console().print(Padding(tree, pad=(0, 0, 0, 8)))
 
 
 def log_rich_payload(
@@ -16,17 +16,39 @@ from stimela import stimelogging
 from stimela.display.display import display, rich_console
 from stimela.monitoring import REPORTERS
 
-# this is "" for the main process, ".0", ".1", for subprocesses, ".0.0" for nested subprocesses
-_subprocess_identifier = ""
+
+class _TaskContext(object):
+    """Task context of a process, or of a thread running scattered loop iterations (see thread_task_context())"""
+
+    def __init__(self):
+        # stack of task information -- most recent subtask is at the end
+        self.task_stack = []
+        # this is "" for the main process, ".0", ".1", for subprocesses, ".0.0" for nested subprocesses
+        self.subprocess_id = ""
+        # per-task stats, and start times of tasks
+        self.taskstats = OrderedDict()
+        self.task_start_time = OrderedDict()
+
+
+# task context of the process. This is used by all threads, except those that establish their own.
+_process_context = _TaskContext()
+_thread_local = threading.local()
+
+
+def _context() -> _TaskContext:
+    return getattr(_thread_local, "context", _process_context)
 
 
 def get_subprocess_id():
-    return _subprocess_identifier
+    return _context().subprocess_id
 
 
 def add_subprocess_id(num: int):
-    global _subprocess_identifier
-    _subprocess_identifier += f".{num}"
+    _context().subprocess_id += f".{num}"
+
+
+def set_subprocess_id(subprocess_id: str):
+    _context().subprocess_id = subprocess_id
 
 
 @dataclass
@@ -51,15 +73,12 @@ class TaskInformation(object):
         return name
 
 
-# stack of task information -- most recent subtask is at the end
-_task_stack = []
-
-
 @contextlib.contextmanager
 def declare_subtask(subtask_name: str, status_reporter: Union[str, Callable] = "dummy"):
+    task_stack = _context().task_stack
     task_names = []
-    if _task_stack:
-        task_names = _task_stack[-1].names + (_task_stack[-1].task_attrs or [])
+    if task_stack:
+        task_names = task_stack[-1].names + (task_stack[-1].task_attrs or [])
     task_names.append(subtask_name)
     if isinstance(status_reporter, str):
         status_reporter = REPORTERS[status_reporter]
@@ -67,47 +86,89 @@ def declare_subtask(subtask_name: str, status_reporter: Union[str, Callable] = "
         status_reporter = status_reporter
     else:
         raise TypeError(f"Expected string or callable; got {type(status_reporter)}.")
-    _task_stack.append(TaskInformation(task_names, status_reporter=status_reporter))
+    task_stack.append(TaskInformation(task_names, status_reporter=status_reporter))
     update_process_status()
     try:
         yield subtask_name
     finally:
-        _task_stack.pop(-1)
+        task_stack.pop(-1)
         update_process_status()
 
 
+def get_task_context():
+    """Returns a picklable snapshot of the current task context (name of the current task, and subprocess
+    identifier), which can be passed to a worker process and re-established there via init_task_context().
+    """
+    context = _context()
+    task_stack = context.task_stack
+    names = task_stack[-1].names + (task_stack[-1].task_attrs or []) if task_stack else []
+    return names, context.subprocess_id
+
+
+def _set_task_context(context: _TaskContext, names: List[str], subprocess_id: str):
+    context.subprocess_id = subprocess_id
+    context.task_stack[:] = [TaskInformation(names, status_reporter=REPORTERS["dummy"])] if names else []
+    context.taskstats.clear()
+    context.task_start_time.clear()
+
+
+def init_task_context(names: List[str], subprocess_id: str):
+    """Re-establishes a task context (as returned by get_task_context()) in a worker process, and clears any stats
+    accumulated by previous tasks. This is needed since worker processes are reused across tasks.
+    """
+    _set_task_context(_process_context, names, subprocess_id)
+
+
+@contextlib.contextmanager
+def thread_task_context(names: List[str], subprocess_id: str):
+    """Context manager establishing a task context (as returned by get_task_context()) private to the current thread.
+    Tasks run in worker threads use this in place of init_task_context(), so that their task stacks and stats are
+    kept apart from those of the process and of other threads. Display updates from the thread are ignored.
+    """
+    context = _TaskContext()
+    _set_task_context(context, names, subprocess_id)
+    _thread_local.context = context
+    try:
+        with display.muted():
+            yield
+    finally:
+        del _thread_local.context
+
+
 def declare_subtask_status(status):
-    _task_stack[-1].status = status
+    _context().task_stack[-1].status = status
     update_process_status()
 
 
 def declare_subtask_attributes(*args, **kw):
-    _task_stack[-1].task_attrs = [str(x) for x in args] + [f"{key} {value}" for key, value in kw.items()]
+    _context().task_stack[-1].task_attrs = [str(x) for x in args] + [f"{key} {value}" for key, value in kw.items()]
     update_process_status()
 
 
 class _CommandContext(object):
     def __init__(self, command):
         self.command = command
-        _task_stack[-1].command = command
+        self.task_info = _context().task_stack[-1]
+        self.task_info.command = command
         update_process_status()
 
     def ctrl_c(self):
-        _task_stack[-1].command = f"{self.command}(^C)"
+        self.task_info.command = f"{self.command}(^C)"
         update_process_status()
 
     def update_status(self, status):
-        _task_stack[-1].command = f"{self.command} ({status})"
+        self.task_info.command = f"{self.command} ({status})"
         update_process_status()
 
 
 @contextlib.contextmanager
 def declare_subcommand(command):
     display.reset_current_task()
+    context = _CommandContext(command)
     try:
-        yield _CommandContext(command)
+        yield context
     finally:
-        _task_stack[-1].command = None
+        context.task_info.command = None
         update_process_status()
 
 
@@ -147,28 +208,27 @@ class TaskStatsDatum(object):
 
 _taskstats_sample_names = [f.name for f in fields(TaskStatsDatum)]
 
-_taskstats = OrderedDict()
-_task_start_time = OrderedDict()
-
 
 def collect_stats():
     """Returns dictionary of per-task stats (elapsed time, sums, peaks)"""
+    taskstats = _context().taskstats
     # cumulative add -- substeps contribute to parent steps
-    for key in list(_taskstats.keys())[::-1]:
-        _, sum, peak = _taskstats[key]
+    for key in list(taskstats.keys())[::-1]:
+        _, sum, peak = taskstats[key]
         key1 = tuple(key[:-1])
-        if key1 in _taskstats:
-            _, sum1, peak1 = _taskstats[key1]
+        if key1 in taskstats:
+            _, sum1, peak1 = taskstats[key1]
             sum1.add(sum)
             peak1.peak(peak)
-    return _taskstats
+    return taskstats
 
 
 def add_missing_stats(stats):
     """Adds stats that weren't recorded into dictionary"""
+    taskstats = _context().taskstats
     for key, value in stats.items():
-        if key not in _taskstats:
-            _taskstats[key] = value
+        if key not in taskstats:
+            taskstats[key] = value
 
 
 def stats_field_names():
@@ -176,8 +236,10 @@ def stats_field_names():
 
 
 def update_stats(now: datetime, sample: TaskStatsDatum):
-    if _task_stack:
-        ti = _task_stack[-1]
+    context = _context()
+    task_stack, taskstats, task_start_time = context.task_stack, context.taskstats, context.task_start_time
+    if task_stack:
+        ti = task_stack[-1]
         keys = [tuple(ti.names)]
         if ti.task_attrs:
             keys.append(tuple(ti.names + ti.task_attrs))
@@ -185,16 +247,17 @@ def update_stats(now: datetime, sample: TaskStatsDatum):
         keys = [()]
 
     for key in keys:
-        _, sum, peak = _taskstats.setdefault(key, [0, TaskStatsDatum(), TaskStatsDatum()])
+        _, sum, peak = taskstats.setdefault(key, [0, TaskStatsDatum(), TaskStatsDatum()])
         sum.add(sample)
         peak.peak(sample)
-        start = _task_start_time.setdefault(key, now)
-        _taskstats[key][0] = (now - start).total_seconds()
+        start = task_start_time.setdefault(key, now)
+        taskstats[key][0] = (now - start).total_seconds()
 
 
 def update_process_status():
     # current subtask info
-    task_info = _task_stack[-1] if _task_stack else None
+    task_stack = _context().task_stack
+    task_info = task_stack[-1] if task_stack else None
 
     # elapsed time since start
     now = datetime.now()
@@ -1,18 +1,38 @@
 import asyncio
+import contextlib
 import datetime
+import inspect
 import logging
 import os
+import queue
 import re
 import signal
+import threading
+import time
 import traceback
 
 from rich.markup import escape
 
-from stimela import stimelogging, task_stats
+from stimela import stimelogging, task_stats, worker_pool
 from stimela.exceptions import StimelaCabRuntimeError
 
 DEBUG = 0
 
+# interval (seconds) at which running commands check if their task has been cancelled
+CANCEL_POLL_INTERVAL = 1
+# once an interrupted process has exited, max time (seconds) to wait for the rest of its output
+DRAIN_TIMEOUT = 5
+# max number of lines of output waiting to be logged, see LogDispatcher
+DISPATCH_QUEUE_SIZE = 10000
+# max number of lines of output logged in one batch
+DISPATCH_BATCH_SIZE = 1000
+# what to do with output once the queue is full: wait for it to be logged, or drop it
+OUTPUT_OVERFLOW_POLICIES = ("block", "drop")
+# size (bytes) of the chunks in which output is read
+READ_CHUNK_SIZE = 65536
+# max length (bytes) of a line of output. Longer lines are truncated
+MAX_LINE_LENGTH = 65536
+
 log = None
 
 
@@ -26,8 +46,10 @@ def get_stimela_logger():
         return None
 
 
-def dispatch_to_log(log, line, command_name, stream_name, output_wrangler, style=None, prefix=None):
-    # dispatch output to log
+def wrangle_output(line, stream_name, output_wrangler, style=None, prefix=None):
+    """Feeds a line of output through the wrangler. Returns severity, message and extra attributes to log it with, or
+    None if the line is suppressed.
+    """
     extra = dict()
     # severity = logging.WARNING if fobj is proc.stderr else logging.INFO
     severity = logging.INFO
@@ -46,16 +68,194 @@ def dispatch_to_log(log, line, command_name, stream_name, output_wrangler, style
     # escaping is aleady done for us
     if type(line) is str:
         line = re.sub(r":(\w+):", r":[bold][/bold]\1:", line)
-    # dispatch to log
-    if line is not None:
-        if severity >= logging.ERROR:
-            extra["prefix"] = stimelogging.FunkyMessage("[red]:error:[/red]", "!")
-        if isinstance(line, stimelogging.FunkyMessage) and line.prefix:
-            extra["prefix"] = line.prefix
+    if line is None:
+        return None
+    if severity >= logging.ERROR:
+        extra["prefix"] = stimelogging.FunkyMessage("[red]:error:[/red]", "!")
+    if isinstance(line, stimelogging.FunkyMessage) and line.prefix:
+        extra["prefix"] = line.prefix
+    return severity, line, extra
+
+
+def dispatch_to_log(log, line, command_name, stream_name, output_wrangler, style=None, prefix=None):
+    # dispatch output to log
+    record = wrangle_output(line, stream_name, output_wrangler, style=style, prefix=prefix)
+    if record is not None:
+        severity, line, extra = record
         log.log(severity, line, extra=extra)
 
 
-def xrun(
+class LineSplitter(object):
+    """Splits chunks of output into lines as they are read, so that a line needn't be read in full before it's
+    logged. Lines longer than max_length bytes are truncated, with a marker giving the number of bytes dropped, so
+    memory use is bounded even if a command dumps binary data. Invalid UTF-8 is replaced rather than raising an error.
+    """
+
+    def __init__(self, max_length=MAX_LINE_LENGTH):
+        self.max_length = max_length
+        self._buffer = bytearray()
+        # number of bytes dropped from the current line
+        self._truncated = 0
+
+    def feed(self, chunk):
+        """Adds a chunk of output, returns list of lines completed by it"""
+        lines = []
+        start = 0
+        while True:
+            end = chunk.find(b"\n", start)
+            if end < 0:
+                self._append(chunk[start:])
+                return lines
+            self._append(chunk[start:end])
+            lines.append(self._pop())
+            start = end + 1
+
+    def close(self):
+        """Returns list containing the last line, if output didn't end with a newline"""
+        return [self._pop()] if self._buffer or self._truncated else []
+
+    def _append(self, data):
+        room = self.max_length - len(self._buffer)
+        if len(data) > room:
+            self._buffer += data[:room]
+            self._truncated += len(data) - room
+        else:
+            self._buffer += data
+
+    def _pop(self):
+        line = self._buffer.decode("utf-8", errors="replace")
+        if self._truncated:
+            line += f" … [{self._truncated:,} bytes truncated]"
+        self._buffer = bytearray()
+        self._truncated = 0
+        return line
+
+
+class LogDispatcher(object):
+    """Logs the output of a command from a thread of its own, so that a slow console or log file doesn't hold up the
+    reading of the output (and, in turn, the command itself).
+
+    Lines are wrangled as they are read, and queued up. The dispatcher thread logs them in batches, with console
+    output and log file flushes done once per batch (see stimelogging.batched_output()). If the queue fills up,
+    the reading of output waits for it to be logged. With overflow="drop", lines below WARNING severity are dropped
+    instead, and the number dropped is logged.
+
+    If rate_limit is set, at most that many lines per second are shown on the console. The rest go to log files only
+    (or nowhere, if rate_limit_logfile is set), and a count of them is shown by the dispatcher thread at the end of
+    each second, whether or not more lines come in. Lines of WARNING severity and above are always shown.
+    """
+
+    def __init__(self, log, command_name, overflow="block", rate_limit=None, rate_limit_logfile=False):
+        self.log = log
+        self.command_name = command_name
+        self.overflow = overflow
+        self.rate_limit = rate_limit
+        self.rate_limit_logfile = rate_limit_logfile
+        # (dispatcher thread only) start time of the current one-second window, lines shown in it, and lines
+        # suppressed in it
+        self._window_start = time.monotonic()
+        self._window_count = self._suppressed = 0
+        self._prefix = task_stats.get_subprocess_id() + "#"
+        self._queue = queue.Queue(DISPATCH_QUEUE_SIZE)
+        # incremented by the reading thread, so the dispatcher thread keeps its own count of what it has reported
+        self._dropped = self._reported = 0
+        self._context = stimelogging.get_output_context()
+        self._thread = threading.Thread(target=self._run, name=f"{command_name} log dispatcher", daemon=True)
+        self._thread.start()
+
+    async def put(self, severity, line, extra):
+        """Queues up a line of output to be logged. If the queue is full, waits for room without holding up the event
+        loop, or drops the line, as per the overflow policy.
+        """
+        try:
+            self._queue.put_nowait((severity, line, extra))
+        except queue.Full:
+            if self.overflow != "drop" or severity >= logging.WARNING:
+                await asyncio.to_thread(self._queue.put, (severity, line, extra))
+            else:
+                self._dropped += 1
+
+    def _log_line(self, severity, line, extra):
+        """Logs a line of output (from the dispatcher thread), subject to the rate limit"""
+        if self.rate_limit and severity < logging.WARNING:
+            now = time.monotonic()
+            if now - self._window_start >= 1:
+                self._end_window(now)
+            if self._window_count >= self.rate_limit:
+                self._suppressed += 1
+                if self.rate_limit_logfile:
+                    return
+                extra = dict(extra, skip_console=True)
+            else:
+                self._window_count += 1
+        self.log.log(severity, line, extra=extra)
+
+    def _end_window(self, now):
+        """Starts a new one-second window, logging a summary of the lines suppressed in the last one, if any"""
+        if self._suppressed:
+            extra = dict(style="dim", prefix=self._prefix)
+            if self.rate_limit_logfile:
+                message = f"… {self._suppressed:,} lines suppressed"
+            else:
+                # log files have the suppressed lines, so they don't need the summary
+                message = f"… {self._suppressed:,} lines suppressed (see log file)"
+                extra["skip_logfile"] = True
+            self.log.info(message, extra=extra)
+            self._suppressed = 0
+        self._window_start, self._window_count = now, 0
+
+    def close(self):
+        """Waits for all queued lines to be logged"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    async def aclose(self):
+        """Waits for all queued lines to be logged, without holding up the event loop"""
+        await asyncio.to_thread(self.close)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    def _run(self):
+        with stimelogging.output_context(self._context):
+            done = False
+            while not done:
+                # with lines suppressed, wait no longer than the end of the window, so that their summary is shown
+                # on time even if no more lines come in
+                timeout = max(self._window_start + 1 - time.monotonic(), 0) if self._suppressed else None
+                try:
+                    batch = [self._queue.get(timeout=timeout)]
+                except queue.Empty:
+                    batch = []
+                while batch and len(batch) < DISPATCH_BATCH_SIZE:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                with stimelogging.batched_output():
+                    for item in batch:
+                        if item is None:
+                            done = True
+                            break
+                        self._log_line(*item)
+                    now = time.monotonic()
+                    if done or now - self._window_start >= 1:
+                        self._end_window(now)
+                    dropped = self._dropped - self._reported
+                    if dropped:
+                        self._reported += dropped
+                        self.log.warning(
+                            f"{self.command_name}: {dropped} lines of output dropped, as they came in faster than "
+                            "they could be logged"
+                        )
+
+
+async def axrun(
     command,
     options,
     log=None,
@@ -70,8 +270,25 @@ def xrun(
     gentle_ctrl_c=False,
     log_command=True,
     log_result=True,
+    output_overflow="block",
+    output_rate_limit=None,
+    output_rate_limit_logfile=False,
+    cabstat=None,
 ):
+    """Runs a command as a coroutine, logging its output. Several commands can be run at once from one thread this
+    way, since nothing blocks the event loop. Note that the task context (see task_stats) is per thread, so such
+    commands are reported as part of the same task.
+
+    The output of the command is fed through output_wrangler, or through the wranglers of cabstat if that is given.
+    Cancelling the coroutine interrupts the command in the same way as a Ctrl+C: kill_callback is called if given
+    (awaiting its result, if that is awaitable), otherwise the process is sent a SIGINT, and terminated or killed
+    if it doesn't exit. StimelaCabRuntimeError is then raised. See xrun() for a blocking version.
+
+    Returns tuple of exit status, cabstat.
+    """
     command_name = command_name or command
+    if cabstat is not None and output_wrangler is None:
+        output_wrangler = cabstat.apply_wranglers
 
     # this part could be inside the container
     command_line = " ".join([command] + list(map(str, options)))
@@ -87,7 +304,7 @@ def xrun(
     if log is None:
         from .xrun_poll import xrun_nolog
 
-        return xrun_nolog(command, name=command_name, shell=shell)
+        return await asyncio.to_thread(xrun_nolog, command, name=command_name, shell=shell), cabstat
 
     # this part is never inside the container
     import stimela
@@ -106,61 +323,83 @@ def xrun(
             log.info(f"{log_command}\n", extra=extras)
             log.debug(f"full command line is {command_line}", extra=extras)
 
-    with task_stats.declare_subcommand(os.path.basename(command_name)) as command_context:
+    async with contextlib.AsyncExitStack() as stack:
+        command_context = stack.enter_context(task_stats.declare_subcommand(os.path.basename(command_name)))
+        dispatcher = await stack.enter_async_context(
+            LogDispatcher(log, command_name, output_overflow, output_rate_limit, output_rate_limit_logfile)
+        )
         start_time = datetime.datetime.now()
 
         def elapsed():
             """Returns string representing elapsed time"""
             return str(datetime.datetime.now() - start_time).split(".", 1)[0]
 
-        loop = asyncio.get_event_loop()
-
-        proc = loop.run_until_complete(
-            asyncio.create_subprocess_exec(
-                *command, limit=1024**3, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
-            )
+        proc = await asyncio.create_subprocess_exec(
+            *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
         )
 
         async def stream_reader(stream, stream_name):
-            while not stream.at_eof():
-                line = await stream.readline()
-                line = (line.decode("utf-8") if type(line) is bytes else line).rstrip()
-                if line or not stream.at_eof():
-                    dispatch_to_log(log, line, command_name, stream_name, output_wrangler=output_wrangler)
+            splitter = LineSplitter()
+            while True:
+                chunk = await stream.read(READ_CHUNK_SIZE)
+                for line in splitter.feed(chunk) if chunk else splitter.close():
+                    record = wrangle_output(line.rstrip(), stream_name, output_wrangler=output_wrangler)
+                    if record is not None:
+                        await dispatcher.put(*record)
+                if not chunk:
+                    break
 
         async def proc_awaiter(proc, *cancellables):
             await proc.wait()
             for task in cancellables:
                 task.cancel()
 
+        async def cancel_watcher():
+            """Interrupts the run if the task has been cancelled (i.e. by a scattered loop, see worker_pool)"""
+            try:
+                while not worker_pool.task_cancelled():
+                    await asyncio.sleep(CANCEL_POLL_INTERVAL)
+            except asyncio.CancelledError:
+                return
+            # handled like a Ctrl+C, see below
+            raise asyncio.CancelledError
+
         reporter = asyncio.Task(task_stats.run_process_status_update())
+        cancellables = [reporter]
+        if worker_pool.task_cancellable():
+            cancellables.append(asyncio.Task(cancel_watcher()))
         ctrl_c_caught = job_interrupted = False  # noqa: F841 - Keep for now.
+        tasks = [
+            asyncio.ensure_future(proc_awaiter(proc, *cancellables)),
+            asyncio.ensure_future(stream_reader(proc.stdout, "stdout")),
+            asyncio.ensure_future(stream_reader(proc.stderr, "stderr")),
+        ]
+        job = asyncio.gather(*tasks, *cancellables)
         try:
-            job = asyncio.gather(
-                proc_awaiter(proc, reporter),
-                stream_reader(proc.stdout, "stdout"),
-                stream_reader(proc.stderr, "stderr"),
-                reporter,
-            )
-            results = loop.run_until_complete(job)  # noqa: F841 - Keep for now.
+            # shielded, so that if we're cancelled, the process and its output are still there to be dealt with below
+            results = await asyncio.shield(job)  # noqa: F841 - Keep for now.
+            await dispatcher.aclose()
             status = proc.returncode
             if log_result:
                 log.info(f"{command_name} exited with code {status} after {elapsed()}")
         except SystemExit:
-            loop.run_until_complete(proc.wait())
-        except KeyboardInterrupt:
+            await proc.wait()
+            raise
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            interrupt = "task cancelled" if worker_pool.task_cancelled() else "Ctrl+C caught"
             if callable(kill_callback):
                 command_context.ctrl_c()
                 log.warning(
-                    f"Ctrl+C caught after {elapsed()}, shutting down {command_name} process, please give it a few "
-                    f"moments"
+                    f"{interrupt} after {elapsed()}, shutting down {command_name} process, please give it a few moments"
                 )
-                kill_callback()
+                result = kill_callback()
+                if inspect.isawaitable(result):
+                    await result
                 log.info(
                     f"the {command_name} process was shut down successfully",
                     extra=dict(stimela_subprocess_output=(command_name, "status")),
                 )
-                loop.run_until_complete(proc.wait())
+                await proc.wait()
             else:
                 try:
                     raise KeyboardInterrupt
@@ -174,9 +413,9 @@ def xrun(
                     #     f"completes"
                     # )
                     # log.warning("Use Ctrl+C again to interrupt the job")
-                    # results = loop.run_until_complete(job)
+                    # results = await job
                 except KeyboardInterrupt:
-                    log.warning(f"Ctrl+C caught after {elapsed()}, interrupting {command_name} process {proc.pid}")
+                    log.warning(f"{interrupt} after {elapsed()}, interrupting {command_name} process {proc.pid}")
                     job_interrupted = True
                     proc.send_signal(signal.SIGINT)
 
@@ -199,18 +438,88 @@ def xrun(
                             log.warning(f"Killing process {proc.pid}")
                             proc.kill()
 
-                    loop.run_until_complete(wait_on_process(proc))
+                    await wait_on_process(proc)
+            # Let the job wind down, now that the process is gone: this reads the rest of its output, and closes its
+            # pipes. Otherwise, they're left to be cleaned up once the event loop is gone (and if this is a worker
+            # thread, its loop goes away with it).
+            _, pending = await asyncio.wait(tasks, timeout=DRAIN_TIMEOUT)
+            if pending:
+                # the pipes are held open by orphaned children of the process, so give up on them: once the readers
+                # are cancelled, the pipes are closed along with the process object (asyncio has no public means to
+                # close them any sooner)
+                pending.update(cancellables)
+                for task in pending:
+                    task.cancel()
+                await asyncio.wait(pending)
+            # retrieve the job's exception, else asyncio complains about it
+            if job.done() and not job.cancelled():
+                job.exception()
+            if worker_pool.task_cancelled():
+                raise StimelaCabRuntimeError(f"{command_name} interrupted, since its task was cancelled")
             if job_interrupted:
                 raise StimelaCabRuntimeError(f"{command_name} interrupted with Ctrl+C")
             else:
                 raise StimelaCabRuntimeError(f"{command_name} complete, but received a Ctrl+C during the run")
 
         except Exception as exc:
-            loop.run_until_complete(proc.wait())
+            await proc.wait()
             traceback.print_exc()
             raise StimelaCabRuntimeError(f"{command_name} threw exception: {exc} after {elapsed()}'", log=log)
 
         if status and not return_errcode:
             raise StimelaCabRuntimeError(f"{command_name} returns error code {status} after {elapsed()}")
 
+    return status, cabstat
+
+
+def xrun(
+    command,
+    options,
+    log=None,
+    env=None,
+    timeout=-1,
+    kill_callback=None,
+    output_wrangler=None,
+    shell=True,
+    return_errcode=False,
+    command_name=None,
+    progress_bar=False,
+    gentle_ctrl_c=False,
+    log_command=True,
+    log_result=True,
+    output_overflow="block",
+    output_rate_limit=None,
+    output_rate_limit_logfile=False,
+):
+    """Runs a command, blocking until it completes (see axrun()). Returns its exit status."""
+    loop = asyncio.get_event_loop()
+    task = loop.create_task(
+        axrun(
+            command,
+            options,
+            log=log,
+            env=env,
+            timeout=timeout,
+            kill_callback=kill_callback,
+            output_wrangler=output_wrangler,
+            shell=shell,
+            return_errcode=return_errcode,
+            command_name=command_name,
+            progress_bar=progress_bar,
+            gentle_ctrl_c=gentle_ctrl_c,
+            log_command=log_command,
+            log_result=log_result,
+            output_overflow=output_overflow,
+            output_rate_limit=output_rate_limit,
+            output_rate_limit_logfile=output_rate_limit_logfile,
+        )
+    )
+    try:
+        status, _ = loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        # a Ctrl+C has interrupted the event loop: cancelling the task has it shut down the command (see axrun())
+        if task.done():
+            raise
+        task.cancel()
+        status, _ = loop.run_until_complete(task)
     return status
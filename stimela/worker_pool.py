@@ -0,0 +1,450 @@
+import asyncio
+import contextlib
+import io
+import multiprocessing
+import multiprocessing.util
+import os
+import queue
+import threading
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Iterator, Optional, Tuple, Union
+
+from rich.text import Text
+
+import stimela
+from stimela import journal, stimelogging, task_stats
+from stimela.display.display import display
+
+# session-wide pool of worker processes, shared by scattered for-loops and concurrently running steps
+_pool = None
+# number of workers in the pool
+_pool_size = 0
+# PID of the process that created the pool. A pool inherited by a forked worker process cannot be used there.
+_pool_pid = None
+# number of active users of the pool (a pool can only be resized when it is idle)
+_pool_users = 0
+# PID of the process for which an exit-time shutdown of the pool has been registered
+_finalizer_pid = None
+# queue over which workers stream their console output to the process that owns the pool, and the thread
+# rendering it there
+_log_queue = None
+_log_listener = None
+# (worker processes only) queue for streaming console output to the parent process
+_worker_log_queue = None
+# State of the task run by the current thread: path of file whose creation signals that the task has been cancelled,
+# and (worker threads only) queue for streaming console output to the thread that owns the pool
+_task_state = threading.local()
+# queues for streaming console output of the worker threads of each thread pool in use (see thread_pool_session())
+_thread_log_queues = {}
+# Session-wide semaphore of worker tokens, shared by the processes at all levels of nesting (see WorkerTokens). It is
+# created by the top-level process if opts.max_workers is set, and handed down to worker processes on creation.
+_budget_semaphore = None
+
+# max number of console messages in flight from workers. Workers block when the queue is full, so this bounds
+# the memory used by chatty workers.
+LOG_QUEUE_SIZE = 1000
+# partial lines are sent once they exceed this size
+LOG_CHUNK_SIZE = 65536
+# interval (seconds) at which tasks held back by the worker budget recheck for available tokens
+BUDGET_POLL_INTERVAL = 1
+
+
+def get_worker_budget() -> int:
+    """Returns the global worker budget (opts.max_workers), or 0 if unlimited"""
+    config = stimela.CONFIG
+    budget = config.opts.max_workers if config is not None else 0
+    return max(budget, 0)
+
+
+def _init_budget() -> int:
+    """Returns the global worker budget (see get_worker_budget()), creating the semaphore of worker tokens on first
+    use. Every pool user runs one task on the token of the process or thread it's in (see WorkerTokens), so the
+    top-level process holds one token from the start.
+    """
+    global _budget_semaphore
+    budget = get_worker_budget()
+    if budget and _budget_semaphore is None:
+        _budget_semaphore = multiprocessing.BoundedSemaphore(budget - 1)
+    return budget
+
+
+def _free_tokens(limit: int) -> int:
+    """Returns the number of worker tokens currently free (up to limit), by taking them and handing them back"""
+    count = 0
+    try:
+        while count < limit and _budget_semaphore.acquire(block=False):
+            count += 1
+    finally:
+        for _ in range(count):
+            _budget_semaphore.release()
+    return count
+
+
+def _pool_is_broken() -> bool:
+    """Checks if the session pool is broken, by running a trivial task on it. A pool breaks for good once one of its
+    workers dies (e.g. is killed by the OOM killer), and fails every task submitted to it from then on.
+    """
+    try:
+        _pool.submit(os.getpid).result()
+    except BrokenProcessPool:
+        return True
+    return False
+
+
+def _get_pool(num_workers: int) -> Tuple[ProcessPoolExecutor, int]:
+    """Returns the session pool, (re)creating it if needed. See pool_session() for details."""
+    global _pool, _pool_size, _pool_pid, _pool_users, _finalizer_pid, _log_queue, _log_listener
+    budget = _init_budget()
+    if budget:
+        # Worker processes are all started when the pool is created, so size it by the tokens that can be had now
+        # (plus the one lent by the caller), rather than by the whole budget. Otherwise, each worker running a nested
+        # scatter would start a pool of its own as large as the budget, even though its parent holds most tokens.
+        num_workers = min(num_workers, budget, 1 + _free_tokens(num_workers - 1))
+    num_workers = max(num_workers, 1)
+    # a pool inherited from a parent process is not usable, so start afresh (but leave it to the parent to close it)
+    if _pool is not None and _pool_pid != os.getpid():
+        _pool, _pool_size, _pool_pid, _pool_users = None, 0, None, 0
+        _log_queue = _log_listener = None
+    # (re)create pool if it doesn't exist, is broken, or is too small and can be resized
+    if _pool is None or (not _pool_users and (num_workers > _pool_size or _pool_is_broken())):
+        shutdown_pool()
+        # Disable display during pool creation so that it isn't
+        # enabled in the resulting processes.
+        pause_display = display.is_enabled
+        if pause_display:
+            display.disable(reset_cursor=True)
+        try:
+            _log_queue = multiprocessing.Queue(LOG_QUEUE_SIZE)
+            _pool = ProcessPoolExecutor(num_workers, initializer=_init_worker, initargs=(_log_queue, _budget_semaphore))
+            _pool_size, _pool_pid = num_workers, os.getpid()
+            # worker processes are started on first submission, so do a trivial one now, while the display is paused
+            _pool.submit(os.getpid).result()
+            # start the listener once the workers exist, so that they don't inherit it in some locked state
+            _start_log_listener()
+        finally:
+            # Re-enable display after pool creation.
+            if pause_display:
+                display.enable()
+        # Worker processes don't run atexit handlers, so a pool created within a worker (i.e. by a nested scatter)
+        # would never be shut down, and the worker would hang on exit waiting for its children. Multiprocessing
+        # finalizers are run on exit in both cases, so use one of those. Its priority must be higher than that of the
+        # finalizers closing the pool's queues (10), else the shutdown sentinels never reach the workers.
+        if _finalizer_pid != os.getpid():
+            multiprocessing.util.Finalize(None, shutdown_pool, exitpriority=20)
+            _finalizer_pid = os.getpid()
+    return _pool, min(num_workers, _pool_size)
+
+
+@contextlib.contextmanager
+def pool_session(num_workers: int) -> Iterator[Tuple[ProcessPoolExecutor, int]]:
+    """Context manager providing access to the session-wide worker pool.
+
+    The pool is created on first use, and grown on subsequent use if more workers are requested (and the pool is
+    not in use elsewhere), subject to the global worker budget (opts.max_workers). With a budget, the pool is sized
+    by the worker tokens free at the time, so that nested scatters don't start more processes than they can use.
+    The pool persists between uses, and is shut down by shutdown_pool(), which is called from close_backends().
+
+    Args:
+        num_workers (int): number of workers requested
+
+    Yields:
+        Tuple[ProcessPoolExecutor, int]: the pool, and the number of tasks the caller may run concurrently. Callers
+        should keep no more than this many tasks in flight at any time, since the pool may be larger.
+    """
+    global _pool_users
+    pool, num_workers = _get_pool(num_workers)
+    _pool_users += 1
+    try:
+        yield pool, num_workers
+    finally:
+        _pool_users -= 1
+
+
+@contextlib.contextmanager
+def thread_pool_session(num_workers: int) -> Iterator[Tuple[ThreadPoolExecutor, int]]:
+    """Context manager providing a pool of worker threads, as an alternative to the session-wide pool of worker
+    processes (see pool_session()). This suits tasks that mostly wait on remote backends (kube, slurm), for which
+    forking full processes is pure overhead. Threads are cheap to start, so the pool is created afresh for each use.
+    Tasks submitted to the pool run with their own task context, log files and event loop, and their console output
+    is relayed as for worker processes (see stream_console()).
+
+    Args:
+        num_workers (int): number of workers requested (subject to the global worker budget, opts.max_workers)
+
+    Yields:
+        Tuple[ThreadPoolExecutor, int]: the pool, and the number of tasks the caller may run concurrently
+    """
+    budget = _init_budget()
+    if budget:
+        num_workers = min(num_workers, budget)
+    num_workers = max(num_workers, 1)
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    listener = threading.Thread(target=_render_logs, args=(log_queue,), daemon=True)
+    listener.start()
+    pool = ThreadPoolExecutor(
+        num_workers, thread_name_prefix="stimela-worker", initializer=_init_worker_thread, initargs=(log_queue,)
+    )
+    _thread_log_queues[pool] = log_queue
+    try:
+        yield pool, num_workers
+    finally:
+        del _thread_log_queues[pool]
+        pool.shutdown(cancel_futures=True)
+        # threads have exited and flushed their output, so the listener can now be stopped
+        log_queue.put(None)
+        listener.join()
+
+
+def fresh_executor(pool: Executor) -> Executor:
+    """Returns a one-off executor with a single fresh worker of the same kind as the given pool (one of those
+    provided by pool_session() or thread_pool_session()). This is for tasks that shouldn't land on a worker that a
+    failed task may have left in a bad state (or that has died, breaking the pool), such as retries. Console output
+    is relayed as for the pool. The caller should shut the executor down once its task is done.
+    """
+    if isinstance(pool, ThreadPoolExecutor):
+        return ThreadPoolExecutor(
+            1,
+            thread_name_prefix="stimela-worker",
+            initializer=_init_worker_thread,
+            initargs=(_thread_log_queues[pool],),
+        )
+    # as in _get_pool(), start the worker process while the display is paused, so that it isn't enabled there
+    pause_display = display.is_enabled
+    if pause_display:
+        display.disable(reset_cursor=True)
+    try:
+        executor = ProcessPoolExecutor(1, initializer=_init_worker, initargs=(_log_queue, _budget_semaphore))
+        executor.submit(os.getpid).result()
+    finally:
+        if pause_display:
+            display.enable()
+    return executor
+
+
+def _init_worker_thread(log_queue: queue.Queue):
+    """Worker thread initializer: saves the queue for streaming console output. Commands are run via asyncio (see
+    xrun()), so the thread also needs an event loop of its own. As in worker processes, this persists for the
+    lifetime of the thread.
+    """
+    _task_state.log_queue = log_queue
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+
+def _init_worker(log_queue: multiprocessing.Queue, budget_semaphore: Optional[multiprocessing.BoundedSemaphore]):
+    """Worker process initializer: saves the queue for streaming console output, and the worker budget semaphore"""
+    global _worker_log_queue, _budget_semaphore
+    _worker_log_queue = log_queue
+    _budget_semaphore = budget_semaphore
+
+
+class WorkerTokens(object):
+    """Tokens drawn from the session-wide worker budget (opts.max_workers) by a user of the pool, such as a
+    scattered loop. The budget bounds the number of tasks running at any one time across all levels of nesting:
+    a scattered loop within a scattered loop draws on the same budget as the outer loop.
+
+    Each task in flight holds a token, except for one: a process waiting on its tasks is idle, so it lends its own
+    token to one of them. This means a pool user can always run at least one task, so nested loops can't
+    deadlock waiting for tokens held by their parents.
+    """
+
+    def __init__(self):
+        # number of tokens currently held
+        self.held = 0
+
+    def acquire(self, num_running: int) -> bool:
+        """Takes a token for one more task, if needed and available.
+
+        Args:
+            num_running (int): number of tasks currently in flight
+
+        Returns:
+            bool: True if one more task may be started, False if the budget is exhausted
+        """
+        if _budget_semaphore is None or not num_running:
+            return True
+        if not _budget_semaphore.acquire(block=False):
+            return False
+        self.held += 1
+        return True
+
+    def release(self, num_running: int):
+        """Returns tokens that are no longer needed, once tasks have completed.
+
+        Args:
+            num_running (int): number of tasks still in flight
+        """
+        while self.held > max(num_running - 1, 0):
+            _budget_semaphore.release()
+            self.held -= 1
+
+
+@contextlib.contextmanager
+def worker_tokens() -> Iterator[WorkerTokens]:
+    """Context manager providing a WorkerTokens object, and returning its tokens to the budget on exit"""
+    tokens = WorkerTokens()
+    try:
+        yield tokens
+    finally:
+        tokens.release(0)
+
+
+def _render_logs(log_queue: Union[multiprocessing.Queue, queue.Queue]):
+    """Log listener thread body: renders console output received from workers, until a None is received"""
+    console = stimelogging.rich_console
+    while True:
+        message = log_queue.get()
+        if message is None:
+            break
+        prefix, text = message
+        # output is already formatted and timestamped by the worker
+        try:
+            for line in text.splitlines():
+                console.print(Text(f"{prefix} ", style="dim") + Text.from_ansi(line), soft_wrap=True)
+        except Exception:
+            # keep draining the queue regardless (e.g. if stdout is gone), else workers block on a full queue
+            pass
+
+
+def _start_log_listener():
+    """Starts the log listener thread for the current log queue"""
+    global _log_listener
+    _log_listener = threading.Thread(target=_render_logs, args=(_log_queue,), daemon=True)
+    _log_listener.start()
+
+
+def _stop_log_listener():
+    """Stops the log listener thread once all pending output has been rendered"""
+    global _log_queue, _log_listener
+    if _log_listener is not None:
+        _log_queue.put(None)
+        _log_listener.join()
+    if _log_queue is not None:
+        _log_queue.close()
+    _log_queue = _log_listener = None
+
+
+class _LogStreamWriter(io.TextIOBase):
+    """File-like object that sends console output to the parent process a line at a time"""
+
+    def __init__(self, prefix: str, log_queue: Union[multiprocessing.Queue, queue.Queue]):
+        self.prefix = prefix
+        self.log_queue = log_queue
+        self._buffer = ""
+
+    def writable(self):
+        return True
+
+    def isatty(self):
+        return False
+
+    def write(self, text: str) -> int:
+        self._buffer += text
+        # send complete lines, or the whole buffer if it is getting too big
+        if len(self._buffer) >= LOG_CHUNK_SIZE:
+            self.flush()
+        else:
+            eol = self._buffer.rfind("\n")
+            if eol >= 0:
+                self.log_queue.put((self.prefix, self._buffer[:eol]))
+                self._buffer = self._buffer[eol + 1 :]
+        return len(text)
+
+    def flush(self):
+        if self._buffer:
+            self.log_queue.put((self.prefix, self._buffer))
+            self._buffer = ""
+
+
+@contextlib.contextmanager
+def stream_console(prefix: str) -> Iterator[Optional[_LogStreamWriter]]:
+    """Context manager redirecting console output of a worker process (or thread) to the parent process, where it is
+    rendered in real time, prefixed by the given string. Does nothing outside of a worker process or thread.
+    """
+    thread_log_queue = getattr(_task_state, "log_queue", None)
+    if thread_log_queue is not None:
+        # the console is shared with other threads, so give this one a console of its own
+        writer = _LogStreamWriter(prefix, thread_log_queue)
+        try:
+            with stimelogging.thread_console(writer):
+                yield writer
+        finally:
+            writer.flush()
+        return
+    if _worker_log_queue is None:
+        yield None
+        return
+    console = stimelogging.rich_console
+    saved_file = console.file
+    console.file = writer = _LogStreamWriter(prefix, _worker_log_queue)
+    try:
+        yield writer
+    finally:
+        writer.flush()
+        console.file = saved_file
+
+
+def _run_task(
+    task_context: Tuple, journal_state: Tuple, cancel_path: Optional[str], func: Callable, args: Tuple, kwargs: dict
+) -> Any:
+    """Runs a task in a worker process, after re-establishing the task context, journal and cancellation state of
+    the submitting process
+    """
+    task_stats.init_task_context(*task_context)
+    journal.set_state(journal_state)
+    _task_state.cancel_path = cancel_path
+    return func(*args, **kwargs)
+
+
+def _run_thread_task(task_context: Tuple, cancel_path: Optional[str], func: Callable, args: Tuple, kwargs: dict) -> Any:
+    """Runs a task in a worker thread, with a task context, log files and cancellation state of its own"""
+    _task_state.cancel_path = cancel_path
+    try:
+        with task_stats.thread_task_context(*task_context), stimelogging.thread_log_context():
+            return func(*args, **kwargs)
+    finally:
+        _task_state.cancel_path = None
+
+
+def submit(pool: Executor, func: Callable, *args, **kwargs) -> Future:
+    """Submits func(*args, **kwargs) to the pool, propagating the current task context and journal to the worker.
+    Tasks submitted from within a cancellable task are cancelled along with it.
+    """
+    return submit_cancellable(pool, getattr(_task_state, "cancel_path", None), func, *args, **kwargs)
+
+
+def submit_cancellable(pool: Executor, cancel_path: Optional[str], func: Callable, *args, **kwargs) -> Future:
+    """Submits func(*args, **kwargs) to the pool (of processes or threads), as for submit(). The task may be
+    cancelled while it runs by calling cancel_task(cancel_path).
+    """
+    if isinstance(pool, ThreadPoolExecutor):
+        return pool.submit(_run_thread_task, task_stats.get_task_context(), cancel_path, func, args, kwargs)
+    return pool.submit(_run_task, task_stats.get_task_context(), journal.get_state(), cancel_path, func, args, kwargs)
+
+
+def cancel_task(cancel_path: str):
+    """Cancels a task submitted with submit_cancellable(). The task is interrupted at the next check of
+    task_cancelled(): running commands are then killed by xrun(), as for a Ctrl+C.
+    """
+    open(cancel_path, "w").close()
+
+
+def task_cancelled() -> bool:
+    """Returns True if the current task has been cancelled"""
+    cancel_path = getattr(_task_state, "cancel_path", None)
+    return cancel_path is not None and os.path.exists(cancel_path)
+
+
+def task_cancellable() -> bool:
+    """Returns True if the current task can be cancelled"""
+    return getattr(_task_state, "cancel_path", None) is not None
+
+
+def shutdown_pool():
+    """Shuts down the session-wide worker pool, if it was created by this process"""
+    global _pool, _pool_size, _pool_pid, _pool_users
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.shutdown()
+        # workers have exited and flushed their output, so the listener can now be stopped
+        _stop_log_listener()
+    _pool, _pool_size, _pool_pid, _pool_users = None, 0, None, 0
@@ -0,0 +1,130 @@
+"""Micro-benchmark of cab output wrangling.
+
+Feeds the lines of a log through the wranglers of a cab, using the current Cab.RuntimeStatus.apply_wranglers(), and
+using a reference implementation that escapes each line and runs every wrangler's regex on it in turn. Checks that
+both give the same results, and reports lines/sec for each.
+
+Usage:
+    python -m tests.bench_wranglers [LOGFILE]
+
+If no log file is given, a synthetic log in the style of WSClean is used.
+"""
+
+import logging
+import random
+import sys
+import time
+
+import rich.markup
+from omegaconf import OmegaConf
+
+from stimela.kitchen.cab import Cab, get_cab_schema
+
+# a typical set of wranglers for an imager cab, plus the output parser added by python flavours
+WRANGLERS = {
+    r"^ *== (.*) ==$": "HIGHLIGHT:bold",
+    r"Iteration (\d+), scale (\d+) px : (.*) at": "SEVERITY:DEBUG",
+    r"ERROR: (.*)": "ERROR",
+    r"Aborted|Segmentation fault": "ERROR",
+    r"(Exception|Traceback)": "SEVERITY:ERROR",
+    r"WARNING: (.*)": "SEVERITY:WARNING",
+    r"Writing (.*\.fits)": "HIGHLIGHT:green",
+    r"Stopping criterion reached": "HIGHLIGHT:bold green",
+    r"Estimated standard deviation of background noise: (?P<noise>[\d.e+-]+) Jy": "PARSE_OUTPUT:noise:float",
+    r"Total flux: (?P<flux>[\d.e+-]+) Jy": "PARSE_OUTPUT:flux:float",
+    r"Inversion: [\d:.]+, prediction: [\d:.]+, deconvolution: [\d:.]+": "SEVERITY:INFO",
+    r"Cleaning up temporary files": "SUPPRESS",
+    r"### STIMELA OUTPUT: (.*)": "PARSE_JSON_OUTPUT_DICT",
+}
+
+
+def synthetic_log(nlines: int):
+    """Returns list of lines of a synthetic WSClean-style log"""
+    rng = random.Random(42)
+    templates = [
+        "Iteration {i}, scale {s} px : {f:.3f} mJy at {x},{y}",
+        "Gridding {n} rows...",
+        " == Constructing PSF ==",
+        "Precalculating weights for Briggs'(0) weighting...",
+        "Opening reordered part 0 spw 0 for {ms}",
+        "Detecting {n} sources...",
+        "Estimated standard deviation of background noise: {f:.3e} Jy",
+        "Writing {ms}-image.fits...",
+        "Fitting beam... major=17.7'', minor=13.23'', PA=-3.06 deg, theta=15.2''.",
+        "Inversion: 00:01:{s}.3, prediction: 00:00:{s}.1, deconvolution: 00:02:{s}.7",
+        "Loading data in memory... [{i}/{n}]",
+        "WARNING: some antennas were flagged",
+    ]
+    weights = [60, 10, 2, 2, 5, 5, 2, 2, 2, 2, 7, 1]
+    lines = []
+    for template in rng.choices(templates, weights=weights, k=nlines):
+        values = dict(
+            i=rng.randint(0, 100000),
+            s=rng.randint(10, 59),
+            f=rng.random() * 100,
+            x=rng.randint(0, 8192),
+            y=rng.randint(0, 8192),
+            n=rng.randint(1000, 10000000),
+            ms="obs-1234567890",
+        )
+        lines.append(template.format(**values))
+    return lines
+
+
+def reference_apply_wranglers(cabstat, output, severity):
+    """Reference implementation: escapes the line, then searches for every wrangler pattern in turn"""
+    output = rich.markup.escape(output)
+    suppress = False
+    for regex, wranglers in cabstat.wranglers:
+        match = regex.search(output)
+        if match:
+            for wrangler in wranglers:
+                mod_output, mod_severity = wrangler.apply(cabstat, output, match)
+                if mod_output is None:
+                    suppress = True
+                else:
+                    output = mod_output
+                if mod_severity is not None:
+                    severity = max(severity, mod_severity)
+    return (None, 0) if suppress else (output, severity)
+
+
+def bench(apply, lines, repeats=3):
+    """Runs apply over all lines, returns results and best lines/sec over several repeats"""
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        results = [apply(line, logging.INFO) for line in lines]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return results, len(lines) / best
+
+
+def main(argv):
+    if len(argv) > 1:
+        with open(argv[1], errors="replace") as fileobj:
+            lines = fileobj.read().splitlines()
+        source = argv[1]
+    else:
+        lines = synthetic_log(200000)
+        source = "synthetic WSClean-style log"
+    conf = OmegaConf.merge(
+        get_cab_schema(), dict(name="bench", command="wsclean", management=dict(wranglers=WRANGLERS))
+    )
+    cab = Cab(**conf)
+    cabstat = cab.reset_status()
+    print(f"{len(lines)} lines from {source}, {len(cabstat.wranglers)} wranglers")
+
+    ref_results, ref_rate = bench(lambda line, severity: reference_apply_wranglers(cabstat, line, severity), lines)
+    results, rate = bench(cabstat.apply_wranglers, lines)
+    if results != ref_results:
+        mismatches = sum(result != ref for result, ref in zip(results, ref_results))
+        print(f"ERROR: results differ from the reference implementation for {mismatches} lines")
+        return 1
+    print(f"reference: {ref_rate:12,.0f} lines/sec")
+    print(f"current:   {rate:12,.0f} lines/sec ({rate / ref_rate:.1f}x)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
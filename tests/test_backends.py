@@ -20,6 +20,18 @@ def test_backend_varieties():
     assert retcode != 0
     assert verify_output(output, "unable to select a backend")
 
+    print("===== expecting an error (broken backend selected) =====")
+    retcode, output = run("stimela -v -b native run test_backends.yml test_recipe5")
+    print(output)
+    assert retcode != 0
+    assert verify_output(output, "unable to select a backend")
+
+    print("===== expecting no errors (backend settings only checked for selected steps) =====")
+    retcode, output = run("stimela -v -b native run test_backends.yml test_recipe5 -s a --dry-run")
+    print(output)
+    assert retcode == 0
+    assert verify_output(output, "dry run was requested")
+
     print("===== expecting an error (bad singularity image) =====")
     retcode, output = run("stimela -v -b native run test_backends.yml test_recipe4")
     print(output)
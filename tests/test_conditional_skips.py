@@ -57,3 +57,100 @@ def test_conditional_skips():
 
     print("===== cleaning up =====")
     os.system("rm -fr test_conditional_skips[1234].tmp")
+
+
+def test_cached_skips():
+    os.system("rm -fr test_cached_skips*.tmp")
+    os.system("echo 1 > test_cached_skips_in.tmp")
+    print("===== first run, step runs =====")
+    retcode, output = run("stimela -b native run test_cached_skips.yml")
+    assert retcode == 0
+    print(output)
+    assert verify_output(output, "---INVOKING---", "touch test_cached_skips_out.tmp")
+
+    print("===== identical run, step skipped =====")
+    retcode, output = run("stimela -b native run test_cached_skips.yml")
+    assert retcode == 0
+    print(output)
+    assert not verify_output(output, "---INVOKING---", "touch test_cached_skips_out.tmp")
+    assert verify_output(output, "restoring outputs of previous run")
+
+    print("===== input touched but not changed, step skipped =====")
+    os.system("touch test_cached_skips_in.tmp")
+    retcode, output = run("stimela -b native run test_cached_skips.yml")
+    assert retcode == 0
+    print(output)
+    assert not verify_output(output, "---INVOKING---", "touch test_cached_skips_out.tmp")
+
+    print("===== parameter changed, step runs =====")
+    retcode, output = run("stimela -b native run test_cached_skips.yml label=b")
+    assert retcode == 0
+    print(output)
+    assert verify_output(output, "---INVOKING---", "touch test_cached_skips_out.tmp")
+
+    print("===== input changed, step runs =====")
+    os.system("echo 2 > test_cached_skips_in.tmp")
+    retcode, output = run("stimela -b native run test_cached_skips.yml")
+    assert retcode == 0
+    print(output)
+    assert verify_output(output, "---INVOKING---", "touch test_cached_skips_out.tmp")
+
+    print("===== output removed, step runs =====")
+    os.system("rm test_cached_skips_out.tmp")
+    retcode, output = run("stimela -b native run test_cached_skips.yml")
+    assert retcode == 0
+    print(output)
+    assert verify_output(output, "---INVOKING---", "touch test_cached_skips_out.tmp")
+
+    print("===== cached skips disabled, step runs =====")
+    retcode, output = run("stimela -b native run test_cached_skips.yml --disable-cached-skips")
+    assert retcode == 0
+    print(output)
+    assert verify_output(output, "---INVOKING---", "touch test_cached_skips_out.tmp")
+
+    print("===== unusable cache directory, step runs =====")
+    os.system("touch test_cached_skips.notadir.tmp")
+    retcode, output = run("stimela -b native run -C opts.cache.dir test_cached_skips.notadir.tmp test_cached_skips.yml")
+    assert retcode == 0
+    print(output)
+    assert verify_output(output, "---INVOKING---", "touch test_cached_skips_out.tmp")
+    assert verify_output(output, "not caching step outputs")
+    # the fingerprint index falls back to computing fingerprints from scratch
+    assert not verify_output(output, "can't be fingerprinted|can't fingerprint")
+
+    print("===== cleaning up =====")
+    os.system("rm -fr test_cached_skips*.tmp")
+
+
+def test_fresh_directories():
+    os.system("rm -fr test_fresh_directories*.tmp")
+    os.system("mkdir -p test_fresh_directories.ms.tmp/ANTENNA")
+    os.system("touch test_fresh_directories.ms.tmp/ANTENNA/table.f0 test_fresh_directories.ms.tmp/ANTENNA/table.f1")
+    print("===== first run, step runs =====")
+    retcode, output = run("stimela -b native run test_fresh_directories.yml")
+    assert retcode == 0
+    print(output)
+    assert verify_output(output, "---INVOKING---", "touch test_fresh_directories_out.tmp")
+
+    print("===== outputs fresh, step skipped =====")
+    retcode, output = run("stimela -b native run test_fresh_directories.yml")
+    assert retcode == 0
+    print(output)
+    assert not verify_output(output, "---INVOKING---", "touch test_fresh_directories_out.tmp")
+
+    print("===== table inside MS modified, step runs =====")
+    os.system("sleep 0.1; touch test_fresh_directories.ms.tmp/ANTENNA/table.f0")
+    retcode, output = run("stimela -b native run test_fresh_directories.yml")
+    assert retcode == 0
+    print(output)
+    assert verify_output(output, "---INVOKING---", "touch test_fresh_directories_out.tmp")
+
+    print("===== table inside MS removed, step runs =====")
+    os.system("sleep 0.1; rm test_fresh_directories.ms.tmp/ANTENNA/table.f1")
+    retcode, output = run("stimela -b native run test_fresh_directories.yml")
+    assert retcode == 0
+    print(output)
+    assert verify_output(output, "---INVOKING---", "touch test_fresh_directories_out.tmp")
+
+    print("===== cleaning up =====")
+    os.system("rm -fr test_fresh_directories*.tmp")
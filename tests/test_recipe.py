@@ -1,3 +1,4 @@
+import json
 import os
 import re
 import stat
@@ -72,6 +73,48 @@ def test_test_nesting():
     print(output)
 
 
+def test_compiled_recipes():
+    os.system("rm -fr test_compiled_recipes*.tmp*")
+    os.system("cp test_nesting.yml test_compiled_recipes.tmp.yml")
+    command = (
+        "stimela -b native exec test_compiled_recipes.tmp.yml demo_recipe "
+        "-C opts.cache.recipes_dir test_compiled_recipes.tmp"
+    )
+
+    print("===== first run, recipe is compiled =====")
+    retcode, output = run(command)
+    assert retcode == 0
+    print(output)
+    assert not verify_output(output, "loaded compiled recipe")
+
+    print("===== second run, compiled recipe is loaded =====")
+    retcode, output = run(command)
+    assert retcode == 0
+    print(output)
+    assert verify_output(output, "loaded compiled recipe 'demo_recipe'")
+
+    print("===== recipe library changed, recipe is recompiled =====")
+    with open("test_compiled_recipes.tmp.yml", "a") as fileobj:
+        fileobj.write("\nextra_recipe:\n  steps:\n    s:\n      cab: echo\n      params:\n        a: x\n")
+    retcode, output = run(command)
+    assert retcode == 0
+    print(output)
+    assert not verify_output(output, "loaded compiled recipe")
+
+    print("===== compiled recipes disabled =====")
+    retcode, output = run(f"{command} -C opts.cache.recipes false")
+    assert retcode == 0
+    print(output)
+    assert not verify_output(output, "loaded compiled recipe")
+
+    print("===== unusable cache directory, recipe is compiled =====")
+    retcode, output = run(f"{command} -C opts.cache.recipes_dir test_compiled_recipes.tmp.yml/recipes")
+    assert retcode == 0
+    print(output)
+    assert verify_output(output, "not caching compiled recipe")
+    os.system("rm -fr test_compiled_recipes*.tmp*")
+
+
 def test_test_recipe():
     print("===== expecting an error since 'msname' parameter is missing =====")
     retcode = os.system("stimela -v -b native exec test_recipe.yml selfcal.image_name=bar")
@@ -124,6 +167,25 @@ def test_test_loop_recipe():
     assert retcode == 0
 
 
+def test_loop_assignments():
+    retcode, output = run("stimela -b native run test_loop_assignments.yml recipe")
+    print(output)
+    assert retcode == 0
+    # assignments must be re-evaluated whenever the loop variable changes
+    assert verify_output(
+        output,
+        "# label=item-a tag=first-item-a:a",
+        "# label=item-b tag=other-item-b:b",
+        "# label=item-c tag=other-item-c:c",
+    )
+
+    # equal values of different types substitute differently
+    retcode, output = run("stimela -b native run test_loop_assignments.yml typed_recipe")
+    print(output)
+    assert retcode == 0
+    assert verify_output(output, "# label=value-1 ", "# label=value-1.0 ", "# label=value-True ")
+
+
 def test_issue527_1():
     """Test that circular references are ignored in prevalidation"""
     print("===== expecting no errors =====")
@@ -160,6 +222,268 @@ def test_scatter():
     retcode = os.system("stimela -v -b native exec test_scatter.yml nested_loop")
     assert retcode == 0
 
+    print("===== expecting no errors now =====")
+    retcode = os.system("stimela -v -b native exec -C opts.max_workers 2 test_scatter.yml nested_loop")
+    assert retcode == 0
+
+
+def test_scatter_worker_budget():
+    os.system("rm -fr test_budget*.tmp && mkdir test_budget.tmp")
+    print("===== expecting no errors now =====")
+    retcode, output = run("stimela -b native exec -C opts.max_workers 3 test_scatter.yml budget_loop")
+    assert retcode == 0
+    print(output)
+    # the nested loops share the budget, so no more than 3 inner iterations ever run at the same time
+    with open("test_budget-counts.tmp") as fileobj:
+        counts = [int(line) for line in fileobj]
+    assert len(counts) == 12
+    assert max(counts) <= 3
+    # the outer iterations hold all tokens, so each inner loop only starts a single worker process: that's at most
+    # 1 top-level + 3 outer + 3 inner stimela processes, plus the shell it's run from (rather than 3 inner per outer)
+    with open("test_budget-procs.tmp") as fileobj:
+        procs = [int(line) for line in fileobj]
+    assert max(procs) <= 8
+    os.system("rm -fr test_budget*.tmp")
+
+
+def test_scatter_log_streaming():
+    print("===== expecting no errors now =====")
+    retcode, output = run("stimela -v -b native exec test_scatter.yml basic_loop")
+    assert retcode == 0
+    print(output)
+    # console output of each iteration is relayed with a per-iteration prefix
+    assert verify_output(output, r"\[basic_loop\.3\] [0-9: -]+ STIMELA\.basic_loop INFO: for loop iteration 3")
+    # each iteration gets its own copy of the loop state
+    for count in range(10):
+        prefix = rf"\[basic_loop\.{count}\] [0-9: -]+"
+        assert verify_output(output, rf"{prefix} STIMELA\.basic_loop\.echo DEBUG: command line is echo {count + 1} ")
+
+
+def test_scatter_threads():
+    print("===== expecting no errors now =====")
+    retcode, output = run("stimela -v -b native exec test_scatter.yml threaded_loop")
+    assert retcode == 0
+    print(output)
+    assert verify_output(output, "scattering over worker threads")
+    # console output of each thread is relayed with a per-iteration prefix, as for worker processes
+    for count in range(6):
+        prefix = rf"\[threaded_loop\.{count}\] [0-9: -]+"
+        assert verify_output(output, rf"{prefix} STIMELA\.threaded_loop\.echo DEBUG: command line is echo {count + 1} ")
+
+    print("===== expecting an error =====")
+    retcode, output = run("stimela -v -b native exec test_scatter.yml threaded_loop for_loop.scatter_mode=fibers")
+    assert retcode != 0
+
+
+def test_scatter_chunks():
+    print("===== expecting no errors now =====")
+    retcode, output = run(
+        "stimela -v -b native exec test_scatter.yml basic_loop for_loop.scatter=2 for_loop.chunk_size=3"
+    )
+    assert retcode == 0
+    print(output)
+    assert verify_output(output, "scattering in chunks of up to 3 iterations")
+    # iterations within a chunk still get their own loop state
+    for count in range(10):
+        prefix = rf"\[basic_loop\.{count}\] [0-9: -]+"
+        assert verify_output(output, rf"{prefix} STIMELA\.basic_loop\.echo DEBUG: command line is echo {count + 1} ")
+
+    print("===== expecting an error =====")
+    retcode, output = run("stimela -v -b native exec test_scatter.yml basic_loop for_loop.chunk_size=-1")
+    assert retcode != 0
+
+
+def test_scatter_multi_var_loops():
+    print("===== expecting no errors now =====")
+    retcode, output = run("stimela -v -b native exec test_scatter.yml product_loop")
+    assert retcode == 0
+    print(output)
+    # all combinations are scattered as one flat loop, and elements are nested by variable
+    assert verify_output(output, r"\[product_loop\.4\] [0-9: -]+ STIMELA\.product_loop INFO: for loop iteration 4")
+    assert verify_output(output, "for loop iteration 4: field = b,")
+    for field in "ab":
+        for spw in range(3):
+            assert verify_output(output, f"command line is echo {field}-{spw}")
+    assert verify_output(output, r"results: \[\['a0', 'a1', 'a2'\], \['b0', 'b1', 'b2'\]\]")
+
+    retcode, output = run("stimela -v -b native exec test_scatter.yml zip_loop")
+    assert retcode == 0
+    print(output)
+    assert verify_output(output, "for loop iteration 1: field = b,")
+    assert verify_output(output, r"results: \['a0', 'b1'\]")
+
+    print("===== expecting an error =====")
+    retcode, output = run("stimela -v -b native exec test_scatter.yml zip_loop fields=[a,b,c]")
+    assert retcode != 0
+    assert verify_output(output, "for_loop.mode=zip requires lists of equal length")
+
+
+def test_scatter_reduce():
+    os.system("rm -f test_reduce_loop.tmp")
+    for scatter in (-1, 0):
+        print("===== expecting no errors now =====")
+        retcode, output = run(f"stimela -v -b native exec test_scatter.yml reduce_loop for_loop.scatter={scatter}")
+        assert retcode == 0
+        print(output)
+        assert verify_output(output, "total: 30", "largest: 16")
+        # elements of each iteration are spilled to a JSON-lines file, in completion order
+        with open("test_reduce_loop.tmp") as fileobj:
+            entries = [json.loads(line) for line in fileobj]
+        assert sorted((entry["index"], entry["elements"]["square"]) for entry in entries) == [
+            (0, 1),
+            (1, 4),
+            (2, 9),
+            (3, 16),
+        ]
+    os.system("rm -f test_reduce_loop.tmp")
+
+
+def test_scatter_resources():
+    print("===== expecting no errors now =====")
+    retcode, output = run("stimela -v -b native exec test_scatter.yml throttled_loop")
+    assert retcode == 0
+    print(output)
+    # each iteration declares more cores than the node has, so they are run one at a time
+    assert verify_output(output, "holding back further iterations until resources are available")
+    assert verify_output(
+        output,
+        "command line is echo 1 ",
+        "command line is echo 2 ",
+        "command line is echo 3 ",
+        "command line is echo 4 ",
+    )
+
+
+def test_scatter_longest_first():
+    os.system("rm -fr test_longest_first.tmp")
+    command = "stimela -v -b native exec -C opts.cache.dir test_longest_first.tmp test_scatter.yml ordered_loop"
+
+    print("===== first run, no history: iterations are started in list order =====")
+    retcode, output = run(command)
+    assert retcode == 0
+    print(output)
+    assert verify_output(output, "command line is echo 0 ", "command line is echo 2 ", "command line is echo 1 ")
+
+    print("===== second run: iterations are started longest-first =====")
+    retcode, output = run(command)
+    assert retcode == 0
+    print(output)
+    assert verify_output(output, r"\(3/3 have durations from previous runs\)")
+    assert verify_output(output, "command line is echo 2 ", "command line is echo 1 ", "command line is echo 0 ")
+    os.system("rm -fr test_longest_first.tmp")
+
+
+def test_scatter_loop_cache():
+    os.system("rm -fr test_loop_cache*.tmp")
+    command = "stimela -b native exec -C opts.cache.dir test_loop_cache.tmp test_scatter.yml cached_loop"
+
+    print("===== first run: all iterations are run =====")
+    retcode, output = run(command)
+    assert retcode == 0
+    print(output)
+    assert verify_output(output, "0/3 iterations restored from the loop cache")
+
+    print("===== second run, with a value added: only the new iteration is run =====")
+    retcode, output = run(f"{command} args=[1,2,3,4]")
+    assert retcode == 0
+    print(output)
+    assert verify_output(output, "3/4 iterations restored from the loop cache")
+    assert verify_output(output, "for loop iteration 3: arg = 4")
+    assert not verify_output(output, "for loop iteration 0: arg = 1")
+
+    print("===== third run, without scattering, after an output was removed: only its iteration is run =====")
+    os.unlink("test_loop_cache-2.tmp")
+    retcode, output = run(f"{command} args=[1,2,3,4] for_loop.scatter=0")
+    assert retcode == 0
+    print(output)
+    assert verify_output(output, "3/4 iterations restored from the loop cache")
+    assert verify_output(output, "for loop iteration 1: arg = 2")
+    assert not verify_output(output, "for loop iteration 3: arg = 4")
+
+    print("===== reduced elements are restored from the loop cache too =====")
+    command = "stimela -v -b native exec -C opts.cache.dir test_loop_cache.tmp test_scatter.yml cached_reduce_loop"
+    for nrestored in (0, 4):
+        retcode, output = run(command)
+        assert retcode == 0
+        print(output)
+        assert verify_output(output, f"{nrestored}/4 iterations restored from the loop cache")
+        assert verify_output(output, "total: 30", "largest: 16")
+    os.system("rm -fr test_loop_cache*.tmp test_reduce_loop.tmp")
+
+
+def test_scatter_retries():
+    os.system("rm -f test_flaky_loop.tmp")
+    print("===== expecting an error, since the third iteration always fails =====")
+    retcode, output = run("stimela -b native exec test_scatter.yml flaky_loop")
+    assert retcode != 0
+    print(output)
+    # the second iteration succeeds on retry
+    assert verify_output(output, r"iteration 1 has failed, retrying in 0.5s \(retry 1/1\)")
+    assert verify_output(output, r"iteration 2 has failed, retrying in 0.5s \(retry 1/1\)")
+    assert verify_output(output, "1/3 jobs have failed")
+
+    os.system("rm -f test_flaky_loop.tmp")
+    print("===== expecting no errors, since one failure is allowed =====")
+    retcode, output = run("stimela -v -b native exec test_scatter.yml tolerant_loop")
+    assert retcode == 0
+    print(output)
+    assert verify_output(output, "1/3 jobs have failed, but up to 1 failures are allowed")
+    # outputs gathered from the loop leave out the failed iteration
+    assert verify_output(output, r"output 'results' is missing the elements of failed iteration\(s\) 2")
+    assert verify_output(output, r"output 'total' is reduced without the elements of failed iteration\(s\) 2")
+    assert verify_output(output, "total: 3", r"results: \[1, 2\]")
+    os.system("rm -f test_flaky_loop.tmp")
+
+    os.system("rm -f test_fresh_retry.tmp")
+    print("===== expecting no errors, since retries run in a fresh worker =====")
+    retcode, output = run("stimela -b native exec test_scatter.yml fresh_retry_loop")
+    assert retcode == 0
+    print(output)
+    assert verify_output(output, r"iteration 0 has failed, retrying in 0s \(retry 1/1\)")
+    os.system("rm -f test_fresh_retry.tmp")
+
+    print("===== expecting an error, since retries need a scattered loop =====")
+    retcode, output = run("stimela -b native exec test_scatter.yml flaky_loop for_loop.scatter=0")
+    assert retcode != 0
+    print(output)
+    assert verify_output(output, "for_loop.retries is only supported with for_loop.scatter")
+
+
+def test_scatter_broken_pool():
+    print("===== expecting no errors, since the worker pool is replaced once broken =====")
+    retcode, output = run("stimela -b native exec test_scatter.yml broken_pool_loop")
+    assert retcode == 0
+    print(output)
+    assert verify_output(output, "4/4 jobs have failed, but up to 4 failures are allowed", "worker process has died")
+    # the next loop gets a working pool
+    assert verify_output(output, "recipe 'echo' executed successfully")
+
+
+def test_scatter_speculative():
+    os.system("rm -f test_straggler_loop*.tmp")
+    print("===== expecting no errors, with the straggling iteration re-run speculatively =====")
+    retcode, output = run("stimela -b native exec test_scatter.yml straggler_loop")
+    assert retcode == 0
+    print(output)
+    assert verify_output(output, r"iteration\(s\) 3 running for", "starting a speculative copy")
+    assert verify_output(output, "completed by the speculative copy", "cancelling the other one")
+    # the speculative copy's output has been renamed to its final name
+    assert open("test_straggler_loop-4.tmp").read().strip() == "4"
+    assert not [name for name in os.listdir(".") if name.startswith("stimela-speculative")]
+    os.system("rm -f test_straggler_loop*.tmp")
+
+
+def test_parallel_steps():
+    print("===== expecting no errors now =====")
+    os.system("rm -f test-parallel-steps.tmp")
+    retcode, output = run("stimela -v -b native exec -j 3 test_parallel_steps.yml parallel_recipe")
+    assert retcode == 0
+    print(output)
+    assert verify_output(output, "step 'sleep-b' depends on no other steps")
+    assert verify_output(output, "step 'echo-touched' depends on touch")
+    assert verify_output(output, "step 'echo-previous' depends on echo-touched")
+    os.system("rm -f test-parallel-steps.tmp")
+
 
 def _run_stderr(command):
     """Runs command, captures merged stderr+stdout, returns tuple of exit code, output"""
@@ -241,3 +565,34 @@ def test_permission_check_outputs(tmp_path):
     print("===== expecting error for non-writable output parent =====")
     retcode, output = _run_stderr(f"stimela -b native exec {recipe_path} out-file={new_file}")
     assert retcode != 0
+
+
+def test_resume():
+    os.system("rm -fr test_resume*.tmp")
+    print("===== expecting an error in the last step =====")
+    retcode, output = run("stimela -b native run test_resume.yml")
+    assert retcode != 0
+    print(output)
+    assert verify_output(output, "---INVOKING---", "touch test_resume.tmp")
+
+    print("===== resuming, expecting completed steps to be restored =====")
+    retcode, output = run(
+        "stimela -b native run test_resume.yml path=test_resume.tmp "
+        "-C opts.log.dir test_resume_logs2.tmp --resume test_resume_logs1.tmp"
+    )
+    assert retcode == 0
+    print(output)
+    assert not verify_output(output, "---INVOKING---", "touch test_resume.tmp")
+    assert not verify_output(output, "---INVOKING---", "echo")
+    assert verify_output(output, "step 'echo' was completed by the resumed run")
+    assert verify_output(output, "---INVOKING---", "ls test_resume.tmp")
+
+    print("===== resuming the resumed run, expecting all steps to be restored =====")
+    retcode, output = run(
+        "stimela -b native run test_resume.yml path=test_resume.tmp "
+        "-C opts.log.dir test_resume_logs3.tmp --resume test_resume_logs2.tmp"
+    )
+    assert retcode == 0
+    print(output)
+    assert not verify_output(output, "---INVOKING---")
+    os.system("rm -fr test_resume*.tmp")
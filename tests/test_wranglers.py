@@ -1,3 +1,12 @@
+import logging
+import re
+
+from omegaconf import OmegaConf
+
+from stimela.kitchen import wranglers
+from stimela.kitchen.cab import Cab, get_cab_schema
+from stimela.utils import xrun_asyncio
+
 from .test_recipe import change_test_dir as change_test_dir
 from .test_recipe import run, verify_output
 
@@ -51,3 +60,89 @@ def test_wrangler_parse():
     assert retcode == 0
     print(output)
     assert verify_output(output, "The bloody cheetah ate 22 dogs!")
+
+
+def test_wrangler_matcher():
+    # only patterns whose required literals occur in a line are run, so results must match running every pattern
+    from .bench_wranglers import WRANGLERS, reference_apply_wranglers, synthetic_log
+
+    conf = OmegaConf.merge(
+        get_cab_schema(),
+        # the first wrangler modifies lines so that a later one matches
+        dict(
+            name="matcher",
+            command="true",
+            management=dict(wranglers={"lazy (dog|cow)": "REPLACE:WARNING: lazy", **WRANGLERS}),
+        ),
+    )
+    cabstat = Cab(**conf).reset_status()
+    with open("test_wranglers.txt") as fileobj:
+        lines = fileobj.read().splitlines()
+    lines += synthetic_log(2000) + ["trailing backslash\\", "ends in [bold]markup[/bold]"]
+    for line in lines:
+        assert cabstat.apply_wranglers(line, logging.INFO) == reference_apply_wranglers(cabstat, line, logging.INFO)
+
+    assert wranglers.required_literals(re.compile(r"brown (fox|cow)")) == ("brown ",)
+    assert wranglers.required_literals(re.compile(r"ABORTING|\*\*\* Error")) == ("*** Error", "ABORTING")
+    assert wranglers.required_literals(re.compile(r"(?i)error")) is None
+    assert wranglers.required_literals(re.compile(r"(ab)?\d+")) is None
+
+
+def test_output_overflow():
+    print("===== expecting no errors =====")
+    retcode, output = run("stimela -b native run test_wranglers.yml test_output_overflow")
+    assert retcode == 0
+    # output of the first step is logged in full, and in order
+    count_output = output.split("test_output_overflow.count_drop")[0]
+    assert re.findall(r"# (\d+)\s", count_output) == [str(i) for i in range(1, 20001)]
+    # output of the second step may be dropped, but it is still seen by its wranglers
+    assert verify_output(output, "The last line read was 20000")
+
+
+def test_output_rate_limit():
+    print("===== expecting no errors =====")
+    retcode, output = run("stimela -b native run test_wranglers.yml test_output_rate_limit")
+    assert retcode == 0
+    # the console only shows some of the lines, and summarizes the rest
+    for step_output in output.split("test_output_rate_limit.count_logfile", 1):
+        assert 100 <= len(re.findall(r"# (\d+)\s", step_output)) < 20000
+        assert verify_output(step_output, "lines suppressed")
+    # the log file has all lines, unless the limit applies to it
+    with open("test-logs/logs/log-test_output_rate_limit.count.txt") as logfile:
+        assert len(re.findall(r"# (\d+)\n", logfile.read())) == 20000
+    with open("test-logs/logs/log-test_output_rate_limit.count_logfile.txt") as logfile:
+        log = logfile.read()
+        assert 100 <= len(re.findall(r"# (\d+)\n", log)) < 20000
+        assert "lines suppressed" in log
+
+    print("===== expecting no errors =====")
+    retcode, output = run("stimela -b native run test_wranglers.yml test_output_rate_limit_pause")
+    assert retcode == 0
+    # the summary is shown once the second is up, rather than when the next line comes in
+    assert verify_output(output, "lines suppressed", "# all-counted")
+
+
+def test_binary_output():
+    print("===== expecting no errors =====")
+    retcode, output = run("stimela -b native run test_wranglers.yml test_binary_output")
+    assert retcode == 0
+    assert verify_output(output, r"134,464 bytes truncated\]", "bad �� bytes", "no newline")
+
+
+def test_line_splitter():
+    splitter = xrun_asyncio.LineSplitter(max_length=8)
+    data = "short\n\nan overly long line\naünïcödé\n".encode() + b"\xff\nlast"
+    # feed a byte at a time, to split lines across chunks
+    lines = []
+    for i in range(len(data)):
+        lines += splitter.feed(data[i : i + 1])
+    lines += splitter.close()
+    assert lines == [
+        "short",
+        "",
+        "an overl … [11 bytes truncated]",
+        "aünïc� … [4 bytes truncated]",
+        "�",
+        "last",
+    ]
+    assert splitter.close() == []
@@ -0,0 +1,63 @@
+import asyncio
+import time
+
+import pytest
+from omegaconf import OmegaConf
+
+from stimela import task_stats
+from stimela.exceptions import StimelaCabRuntimeError
+from stimela.kitchen.cab import Cab, get_cab_schema
+from stimela.utils.xrun_asyncio import axrun, xrun
+
+from .test_recipe import change_test_dir as change_test_dir
+
+
+@pytest.fixture(autouse=True)
+def subtask():
+    # commands are run as part of a task
+    with task_stats.declare_subtask("test"):
+        yield
+
+
+def make_cabstat(wranglers):
+    conf = OmegaConf.merge(get_cab_schema(), dict(name="test", command="echo", management=dict(wranglers=wranglers)))
+    return Cab(**conf).reset_status()
+
+
+def test_axrun_concurrent():
+    cabstats = [make_cabstat({rf"^(?P<word{i}>\w+) done$": f"PARSE_OUTPUT:word{i}:str"}) for i in range(2)]
+
+    async def run_both():
+        return await asyncio.gather(
+            axrun("sh", ["-c", "sleep 2 && echo first done"], shell=False, cabstat=cabstats[0]),
+            axrun("sh", ["-c", "sleep 2 && echo second done"], shell=False, cabstat=cabstats[1]),
+        )
+
+    start = time.time()
+    results = asyncio.new_event_loop().run_until_complete(run_both())
+    # both commands run at once
+    assert time.time() - start < 3.5
+    assert results == [(0, cabstats[0]), (0, cabstats[1])]
+    assert cabstats[0].outputs == dict(word0="first")
+    assert cabstats[1].outputs == dict(word1="second")
+
+
+def test_axrun_cancel():
+    async def run_and_cancel():
+        task = asyncio.ensure_future(axrun("sleep", ["30"], shell=False))
+        await asyncio.sleep(1)
+        task.cancel()
+        await task
+
+    start = time.time()
+    with pytest.raises(StimelaCabRuntimeError, match="interrupted"):
+        asyncio.new_event_loop().run_until_complete(run_and_cancel())
+    # the process is interrupted, rather than waited on
+    assert time.time() - start < 10
+
+
+def test_xrun_wrapper():
+    assert xrun("true", [], return_errcode=True) == 0
+    assert xrun("false", [], return_errcode=True) == 1
+    with pytest.raises(StimelaCabRuntimeError, match="error code 1"):
+        xrun("false", [])